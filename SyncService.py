@@ -162,21 +162,15 @@ class SyncServiceRunner:
     def load_config(self):
         """Load configuration from config.json and .env"""
         try:
-            # Load from config.json
-            if self.config_file.exists():
-                with open(self.config_file, 'r') as f:
-                    config = json.load(f)
-                    print(f"📄 Configuration loaded from {self.config_file}")
-            else:
+            if str(self.project_dir) not in sys.path:
+                sys.path.insert(0, str(self.project_dir))
+            from sync import config as shared_config
+
+            if not self.config_file.exists():
                 # Create default configuration
-                config = {
-                    "ip": "192.168.1.53",
-                    "port": 8000,
-                    "dsn": "pktc",
-                    "auto_start": True,
-                    "log_level": "INFO",
-                    "all_ips": ["192.168.1.53", "172.25.240.1", "127.0.0.1"]
-                }
+                config = dict(shared_config.DEFAULTS,
+                              ip="192.168.1.53",
+                              all_ips=["192.168.1.53", "172.25.240.1", "127.0.0.1"])
                 
                 # Try to detect local IP
                 try:
@@ -192,10 +186,12 @@ class SyncServiceRunner:
                     pass
                 
                 # Save default config
-                with open(self.config_file, 'w') as f:
-                    json.dump(config, f, indent=2)
+                shared_config.save(config, self.config_file)
                 print(f"📝 Default configuration created at {self.config_file}")
             
+            config = shared_config.get_config(self.config_file)
+            print(f"📄 Configuration loaded from {self.config_file}")
+            
             # Load environment variables from .env file
             env_file = self.project_dir / ".env"
             if env_file.exists():
@@ -207,10 +203,6 @@ class SyncServiceRunner:
                             key, value = line.split('=', 1)
                             os.environ[key.strip()] = value.strip()
             
-            # Add database credentials with fallback
-            config["db_uid"] = os.getenv("DB_UID", "dba")
-            config["db_pwd"] = os.getenv("DB_PWD", "(*$^)")
-            
             return config
             
         except Exception as e:
@@ -221,9 +213,7 @@ class SyncServiceRunner:
                 "dsn": "pktc",
                 "auto_start": True,
                 "log_level": "INFO",
-                "all_ips": ["127.0.0.1"],
-                "db_uid": "dba",
-                "db_pwd": "(*$^)"
+                "all_ips": ["127.0.0.1"]
             }
     
     def print_banner(self):
@@ -236,7 +226,9 @@ class SyncServiceRunner:
         print(f"📅 Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"🌐 Server IP: {self.config.get('ip', 'Unknown')}")
         print(f"🔌 Server Port: {self.config.get('port', 8000)}")
-        print(f"🗄️ Database DSN: {self.config.get('dsn', 'Unknown')}")
+        print(f"🗄️ Database DSN: {self.config.get('dsn', 'Unknown')} ({self.config.get('backend', 'sqlanywhere')})")
+        if self.config.get('stores'):
+            print(f"🏬 Stores: {', '.join(self.config['stores'])}")
         print("=" * 60)
     
     def check_prerequisites(self):
@@ -267,19 +259,22 @@ class SyncServiceRunner:
     def start_sync_heartbeat(self):
         """Start the database heartbeat service"""
         def heartbeat_worker():
-            # Try to import sqlanydb, skip if not available
+            # Skip the heartbeat if the configured database driver is not installed
             try:
-                import sqlanydb
-                DSN = self.config.get('dsn', 'pktc')
-                
+                from sync import sql_helper
+                if not sql_helper.backend_available():
+                    raise ImportError(self.config.get('backend', 'sqlanywhere'))
+
                 while self.running:
                     try:
-                        conn = sqlanydb.connect(DSN=DSN, UID="dba", PWD="(*$^)")
-                        cur = conn.cursor()
-                        cur.execute("SELECT 1")
-                        cur.close()
-                        conn.close()
-                        print(f"💓 DB heartbeat OK @ {datetime.now().strftime('%H:%M:%S')}")
+                        # one short-lived connection per store: the pools (and their
+                        # breakers and heartbeat) live in the Django process
+                        for store in sql_helper.store_names():
+                            error = sql_helper.probe(store)
+                            if error is not None:
+                                print(f"💔 Heartbeat failed [{store}]: {error}")
+                            else:
+                                print(f"💓 DB heartbeat OK [{store}] @ {datetime.now().strftime('%H:%M:%S')}")
                     except Exception as e:
                         print(f"💔 Heartbeat failed: {e}")
                     
@@ -290,7 +285,7 @@ class SyncServiceRunner:
                         time.sleep(1)
             
             except ImportError:
-                print("⚠️  sqlanydb not available - skipping database heartbeat")
+                print("⚠️  Database driver not available - skipping database heartbeat")
                 print("💡 Install SAP SQL Anywhere client if you need database connectivity")
         
         print("💓 Starting database heartbeat service...")
@@ -512,6 +507,13 @@ class SyncServiceRunner:
                         print(f"⚡ SQL [{timestamp}]: Executing database insert")
                         print(f"   🔧 {params_part}")
                 
+                elif 'SLOW QUERY' in line:
+                    db_operations += 1
+                    detail = line.split('SLOW QUERY ')[1]
+                    print(f"🐢 SLOW [{timestamp}]: {detail.split(' sql=')[0]}")
+                    if ' sql=' in detail:
+                        print(f"   🔧 {detail.split(' sql=')[1]}")
+
                 elif 'Database connection established!' in line:
                     print(f"🔌 DB [{timestamp}]: Database connection successful")
                 
@@ -39,8 +39,11 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",        # MUST be top
     "django.middleware.security.SecurityMiddleware",
+    "sync.middleware.CompressionMiddleware",        # gzip/deflate/br/zstd by Accept-Encoding
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
+    "sync.middleware.QueryContextMiddleware",       # request id for SQL timings
+    "sync.middleware.DatabaseUnavailableMiddleware",  # 503 + Retry-After when DB is down
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
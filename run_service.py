@@ -1,9 +1,11 @@
 # run_service.py
 import time
 import logging
-import sqlanydb
 from datetime import datetime
 
+from sync.config import get_config
+from sync.backends import get_backend
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 DSN = "pktc"
@@ -12,7 +14,8 @@ def main():
     logging.info("SyncService started")
     while True:
         try:
-            conn = sqlanydb.connect(DSN=DSN, UID="dba", PWD="sql")
+            cfg = get_config()
+            conn = get_backend(cfg).connect(cfg.get("dsn", DSN), UID="dba", PWD="sql")
             cur = conn.cursor()
             cur.execute("SELECT 1")
             cur.close()
@@ -23,4 +26,4 @@ def main():
         time.sleep(30)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,10 +4,11 @@ Configuration Setup Helper
 Interactive configuration setup for Django SyncService
 """
 
-import json
 import socket
 from pathlib import Path
 
+from sync import config as shared_config
+
 def get_local_ip():
     """Get the local IP address"""
     try:
@@ -39,18 +40,10 @@ def setup_config():
     # Get current config or create default
     config_file = Path("config.json")
     if config_file.exists():
-        with open(config_file, 'r') as f:
-            config = json.load(f)
+        config = shared_config.load_raw(config_file)
         print("Found existing configuration")
     else:
-        config = {
-            "ip": "127.0.0.1",
-            "port": 8000,
-            "dsn": "pktc",
-            "auto_start": True,
-            "log_level": "INFO",
-            "all_ips": []
-        }
+        config = dict(shared_config.DEFAULTS, all_ips=[])
     
     # Get local IP
     local_ip = get_local_ip()
@@ -125,8 +118,7 @@ def setup_config():
     config["all_ips"] = list(set(config["all_ips"]))  # Remove duplicates
     
     # Save configuration
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=2)
+    shared_config.save(config, config_file)
     
     print(f"\nConfiguration saved to {config_file}")
     print(f"Server will be accessible at:")
@@ -1,6 +1,22 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
 class SyncConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sync'
+
+    def ready(self):
+        argv = sys.argv
+        if len(argv) > 1 and argv[0].endswith("manage.py") and argv[1] != "runserver":
+            return      # migrate, shell, test … have no use for a warm pool
+        if "runserver" in argv and "--noreload" not in argv and os.environ.get("RUN_MAIN") != "true":
+            return      # autoreloader parent – the child process does the serving
+        from . import sql_helper
+        sql_helper.warm_pool()
+        sql_helper.start_heartbeat()
+        from .views import catalog_files, changelog_feed
+        catalog_files.start()
+        changelog_feed.start()
@@ -0,0 +1,86 @@
+"""
+Database backends for sql_helper.
+
+config.json picks one with ``"backend"``:
+    "sqlanywhere" (default) - the production SQL Anywhere server via sqlanydb + DSN
+    "sqlite"                - a local SQLite file with the same schema, for load
+                              testing and profiling without a SQL Anywhere server
+"""
+
+import importlib
+
+BACKENDS = {
+    "sqlanywhere": "sync.backends.sqlanywhere.SQLAnywhereBackend",
+    "sqlite": "sync.backends.sqlite.SQLiteBackend",
+}
+
+class BaseBackend:
+    """What sql_helper needs from a database driver"""
+
+    name = None
+
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    def available(self):
+        """True if the driver can be imported on this machine"""
+        return True
+
+    def connect(self, dsn, **kwargs):
+        """Open a new DB-API connection for ``dsn``"""
+        raise NotImplementedError
+
+    def cancel(self, conn):
+        """Abort whatever ``conn`` is running, from another thread.
+
+        Uses the driver's cancel() when it has one, otherwise closes the
+        connection so the blocked call errors out. Returns "cancelled" or "closed".
+        """
+        cancel = getattr(conn, "cancel", None)
+        if callable(cancel):
+            cancel()
+            return "cancelled"
+        conn.close()
+        return "closed"
+
+    def driver_errors(self):
+        """The driver's DB-API ``Error`` class(es): failures of the database, not of the input"""
+        return ()
+
+    def missing_table(self, error):
+        """True if ``error`` says a statement referred to a table that does not exist"""
+        return False
+
+    def make_reader(self, conn):
+        """Turn a fresh connection into a read-only, snapshot-isolated reader"""
+
+    def begin_snapshot(self, conn):
+        """Start the consistent snapshot a reader's next statements will see.
+
+        The pool rolls the transaction back when the connection is returned.
+        """
+
+    def row_hash(self, columns):
+        """SQL expression: a BIGINT hash of ``columns`` for the catalog change
+        signature (summed over a table, so any edited value moves the sum)"""
+        raise NotImplementedError(f"{self.name} has no row hash")
+
+    def changelog_ddl(self, tables):
+        """Statements creating the sync_changelog table and, for every
+        ``table -> key column`` in ``tables``, the triggers that log changed keys"""
+        raise NotImplementedError(f"{self.name} has no change-capture installer")
+
+    def changelog_drop_ddl(self, tables):
+        """Statements removing those triggers (the changelog table is kept)"""
+        raise NotImplementedError(f"{self.name} has no change-capture installer")
+
+def get_backend(cfg):
+    """Instantiate the backend named in config (a ServiceConfig or dict)"""
+    name = (cfg.get("backend") or "sqlanywhere").lower()
+    try:
+        dotted = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown database backend {name!r} (choose from {', '.join(BACKENDS)})")
+    module_name, cls_name = dotted.rsplit(".", 1)
+    cls = getattr(importlib.import_module(module_name), cls_name)
+    return cls(cfg.get(name) or {})
@@ -0,0 +1,111 @@
+from . import BaseBackend
+
+_connection_class = None
+
+def _prepared_connection_class():
+    """sqlanydb.Connection whose cursors keep their prepared statement.
+
+    sqlanydb prepares the SQL again on every execute(). PreparedCursor
+    re-executes the same SQL by resetting the statement handle it already
+    has and binding the new parameters, so a cursor the pool's statement
+    cache hands out again skips the prepare.
+    """
+    global _connection_class
+    if _connection_class is None:
+        import sqlanydb
+
+        class PreparedCursor(sqlanydb.Cursor):
+            _operation = None
+
+            def new_statement(self, operation):
+                # _Cursor__stmt: the handle, None once freed (no error raised, unlike .stmt)
+                if operation == self._operation and self._Cursor__stmt and self.api.sqlany_reset(self.stmt):
+                    self.description = None
+                    self.converter = None
+                    self.rowcount = -1
+                    return
+                self._operation = None
+                super().new_statement(operation)
+                self._operation = operation
+
+            def free_statement(self):
+                self._operation = None
+                super().free_statement()
+
+        class PreparedConnection(sqlanydb.Connection):
+            def cursor(self):
+                self.messages = []
+                cur = PreparedCursor(self)
+                self.cursors.add(cur)
+                return cur
+
+        _connection_class = PreparedConnection
+    return _connection_class
+
+class SQLAnywhereBackend(BaseBackend):
+    name = "sqlanywhere"
+
+    def available(self):
+        try:
+            import sqlanydb  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    def driver_errors(self):
+        try:
+            import sqlanydb
+        except ImportError:
+            return ()
+        return (sqlanydb.Error,)
+
+    def missing_table(self, error):
+        # sqlanydb errors carry (message, SQLCODE); -141 is "Table '...' not found"
+        args = getattr(error, "args", ())
+        return len(args) > 1 and args[1] == -141
+
+    def connect(self, dsn, **kwargs):
+        # what sqlanydb.connect() does, with the prepared-statement cursors
+        return _prepared_connection_class()((), dict(DSN=dsn, **kwargs))
+
+    def make_reader(self, conn):
+        # Needs "SET OPTION PUBLIC.allow_snapshot_isolation = 'On'" once on the database.
+        # The snapshot starts with the first read of each transaction, which the pool
+        # ends with a rollback on release, so readers neither block nor wait on writers.
+        conn.autocommit = False
+        cur = conn.cursor()
+        cur.execute("SET TEMPORARY OPTION isolation_level = 'snapshot'")
+        cur.close()
+
+    def row_hash(self, columns):
+        # STRING() turns NULL into "", so a row with NULLs still hashes
+        values = ", '|', ".join(columns)
+        return f"CAST(HEXTOINT(LEFT(HASH(STRING('|', {values}), 'MD5'), 7)) AS BIGINT)"
+
+    def changelog_ddl(self, tables):
+        ddl = ["""CREATE TABLE IF NOT EXISTS sync_changelog (
+                      seq        BIGINT NOT NULL DEFAULT AUTOINCREMENT PRIMARY KEY,
+                      tbl        VARCHAR(30) NOT NULL,
+                      op         CHAR(1) NOT NULL,
+                      code       VARCHAR(30) NULL,
+                      changed_at TIMESTAMP NOT NULL DEFAULT CURRENT TIMESTAMP
+                  )"""]
+        for table, key in tables.items():
+            ddl.append(f"""
+                CREATE OR REPLACE TRIGGER sync_changelog_{table} AFTER INSERT, UPDATE, DELETE ON {table}
+                REFERENCING OLD AS old_row NEW AS new_row
+                FOR EACH ROW
+                BEGIN
+                    IF INSERTING OR UPDATING THEN
+                        INSERT INTO sync_changelog (tbl, op, code)
+                        VALUES ('{table}', IF INSERTING THEN 'I' ELSE 'U' ENDIF, new_row.{key});
+                    END IF;
+                    IF DELETING OR (UPDATING AND old_row.{key} <> new_row.{key}) THEN
+                        INSERT INTO sync_changelog (tbl, op, code)
+                        VALUES ('{table}', IF DELETING THEN 'D' ELSE 'U' ENDIF, old_row.{key});
+                    END IF;
+                END""")
+        return ddl
+
+    def changelog_drop_ddl(self, tables):
+        return [f"DROP TRIGGER IF EXISTS {table}.sync_changelog_{table}" for table in tables]
@@ -0,0 +1,210 @@
+"""
+SQLite stand-in for SQL Anywhere.
+
+Emulates just the parts of sqlanydb/SQL Anywhere the views rely on: qmark
+parameters (native), TODAY(), a settable ``conn.autocommit`` and the acc_*
+schema. Each DSN maps to its own file, ``<dir>/<dsn>.sqlite3``.
+
+Seed a benchmark database with:
+    python -m sync.backends.sqlite pktc --products 150000 --batches 1
+"""
+
+import os
+import zlib
+import random
+import sqlite3
+import argparse
+from datetime import date
+
+from . import BaseBackend
+
+PROJECT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS acc_users (
+    id   VARCHAR(30) PRIMARY KEY,
+    pass VARCHAR(60)
+);
+CREATE TABLE IF NOT EXISTS acc_master (
+    code       VARCHAR(30) PRIMARY KEY,
+    name       VARCHAR(120),
+    place      VARCHAR(120),
+    super_code VARCHAR(10)
+);
+CREATE INDEX IF NOT EXISTS acc_master_super_code ON acc_master (super_code);
+CREATE TABLE IF NOT EXISTS acc_product (
+    code VARCHAR(30) PRIMARY KEY,
+    name VARCHAR(120)
+);
+CREATE TABLE IF NOT EXISTS acc_productbatch (
+    productcode VARCHAR(30),
+    barcode     VARCHAR(40),
+    quantity    NUMERIC,
+    salesprice  NUMERIC,
+    bmrp        NUMERIC,
+    cost        NUMERIC
+);
+CREATE INDEX IF NOT EXISTS acc_productbatch_productcode ON acc_productbatch (productcode);
+CREATE TABLE IF NOT EXISTS acc_purchaseordermaster (
+    slno      INTEGER PRIMARY KEY,
+    orderno   INTEGER,
+    supplier  VARCHAR(30),
+    otype     VARCHAR(2),
+    userid    VARCHAR(30),
+    orderdate DATE
+);
+CREATE TABLE IF NOT EXISTS acc_purchaseorderdetails (
+    slno       INTEGER PRIMARY KEY,
+    masterslno INTEGER,
+    barcode    VARCHAR(40),
+    qty        NUMERIC,
+    rate       NUMERIC,
+    mrp        NUMERIC
+);
+CREATE INDEX IF NOT EXISTS acc_purchaseorderdetails_masterslno ON acc_purchaseorderdetails (masterslno);
+"""
+
+def _today():
+    return date.today().isoformat()
+
+def _row_hash(*values):
+    return zlib.crc32("|".join("" if v is None else str(v) for v in values).encode())
+
+class SQLiteConnection:
+    """sqlite3 connection with sqlanydb's ``autocommit`` attribute"""
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    @property
+    def autocommit(self):
+        return self._raw.isolation_level is None
+
+    @autocommit.setter
+    def autocommit(self, on):
+        if on and self._raw.in_transaction:
+            self._raw.commit()
+        self._raw.isolation_level = None if on else "DEFERRED"
+
+    def cursor(self):
+        return self._raw.cursor()
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        self._raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+class SQLiteBackend(BaseBackend):
+    name = "sqlite"
+
+    def path_for(self, dsn):
+        if dsn == ":memory:" or dsn.endswith((".sqlite3", ".db")):
+            return dsn
+        directory = self.options.get("dir") or PROJECT_DIR
+        return os.path.join(directory, f"{dsn}.sqlite3")
+
+    def driver_errors(self):
+        return (sqlite3.Error,)
+
+    def missing_table(self, error):
+        return isinstance(error, sqlite3.OperationalError) and "no such table" in str(error)
+
+    def connect(self, dsn, **kwargs):
+        raw = sqlite3.connect(self.path_for(dsn), timeout=30, check_same_thread=False,
+                              isolation_level="DEFERRED")
+        raw.create_function("TODAY", 0, _today, deterministic=False)
+        raw.create_function("sync_row_hash", -1, _row_hash, deterministic=True)
+        raw.execute("PRAGMA journal_mode=WAL")
+        raw.executescript(SCHEMA)
+        return SQLiteConnection(raw)
+
+    def cancel(self, conn):
+        conn.interrupt()
+        return "cancelled"
+
+    def make_reader(self, conn):
+        conn.execute("PRAGMA query_only = ON")
+
+    def begin_snapshot(self, conn):
+        # WAL readers see the database as of their transaction's first read
+        conn.execute("BEGIN")
+
+    def row_hash(self, columns):
+        return f"sync_row_hash({', '.join(columns)})"
+
+    def changelog_ddl(self, tables):
+        ddl = ["""CREATE TABLE IF NOT EXISTS sync_changelog (
+                      seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+                      tbl        VARCHAR(30) NOT NULL,
+                      op         CHAR(1) NOT NULL,
+                      code       VARCHAR(30),
+                      changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                  )"""]
+        for table, key in tables.items():
+            ddl += [
+                f"""CREATE TRIGGER IF NOT EXISTS sync_changelog_{table}_ins AFTER INSERT ON {table}
+                    BEGIN INSERT INTO sync_changelog (tbl, op, code) VALUES ('{table}', 'I', NEW.{key}); END""",
+                # a key change logs both the old and the new key
+                f"""CREATE TRIGGER IF NOT EXISTS sync_changelog_{table}_upd AFTER UPDATE ON {table}
+                    BEGIN INSERT INTO sync_changelog (tbl, op, code)
+                          SELECT '{table}', 'U', NEW.{key} UNION SELECT '{table}', 'U', OLD.{key}; END""",
+                f"""CREATE TRIGGER IF NOT EXISTS sync_changelog_{table}_del AFTER DELETE ON {table}
+                    BEGIN INSERT INTO sync_changelog (tbl, op, code) VALUES ('{table}', 'D', OLD.{key}); END""",
+            ]
+        return ddl
+
+    def changelog_drop_ddl(self, tables):
+        return [f"DROP TRIGGER IF EXISTS sync_changelog_{table}_{event}"
+                for table in tables for event in ("ins", "upd", "del")]
+
+# ------------------ demo / benchmark data ------------------
+def seed(conn, products=1000, batches=1, masters=50, users=(("dba", "sql"),), rng=None):
+    """Fill an empty database with synthetic masters, products and batches"""
+    rng = rng or random.Random(42)
+    cur = conn.cursor()
+    cur.executemany("INSERT OR REPLACE INTO acc_users (id, pass) VALUES (?, ?)", list(users))
+    cur.executemany(
+        "INSERT OR REPLACE INTO acc_master (code, name, place, super_code) VALUES (?, ?, ?, ?)",
+        [(f"S{i:05d}", f"Supplier {i}", f"Place {i % 37}", "SUNCR") for i in range(masters)])
+    cur.executemany(
+        "INSERT OR REPLACE INTO acc_product (code, name) VALUES (?, ?)",
+        [(f"P{i:07d}", f"Product {i}") for i in range(products)])
+    cur.execute("DELETE FROM acc_productbatch")
+    rows = []
+    for i in range(products):
+        for b in range(rng.randint(0, 2 * batches) if batches > 1 else batches):
+            cost = round(rng.uniform(1, 500), 2)
+            rows.append((f"P{i:07d}", f"89{i:09d}{b:02d}", rng.randint(0, 500),
+                         round(cost * 1.2, 2), round(cost * 1.35, 2), cost))
+    cur.executemany(
+        "INSERT INTO acc_productbatch (productcode, barcode, quantity, salesprice, bmrp, cost) "
+        "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    cur.close()
+    return len(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create and seed a SQLite stand-in database")
+    parser.add_argument("dsn", nargs="?", default="pktc", help="DSN name or .sqlite3 path")
+    parser.add_argument("--dir", help="directory for <dsn>.sqlite3 (default: project root)")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=1, help="average batches per product")
+    parser.add_argument("--masters", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    backend = SQLiteBackend({"dir": args.dir} if args.dir else {})
+    conn = backend.connect(args.dsn)
+    n = seed(conn, args.products, args.batches, args.masters)
+    conn.close()
+    print(f"Seeded {backend.path_for(args.dsn)}: {args.masters} masters, "
+          f"{args.products} products, {n} batches")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Circuit breaker in front of the database.
+
+closed     - calls go through; N consecutive failures open the circuit
+open       - calls fail fast with CircuitOpen until reset_timeout has passed
+half_open  - at most ``half_open_probes`` calls are let through as probes;
+             one success closes the circuit, one failure re-opens it
+"""
+
+import math
+import time
+import logging
+import threading
+
+BREAKER_DEFAULTS = {
+    "failure_threshold": 5,      # consecutive failures that open the circuit
+    "reset_timeout": 15,         # seconds to stay open before probing
+    "half_open_probes": 2,       # concurrent probes allowed while half-open
+    "heartbeat_interval": 30,    # in-process DB heartbeat, also probes while open (0 = off)
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+class CircuitOpen(Exception):
+    """The database is considered down; retry after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after, last_error=None):
+        self.retry_after = retry_after
+        self.last_error = last_error
+        super().__init__(f"Database unavailable, retry in {retry_after}s"
+                         + (f" ({last_error})" if last_error else ""))
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=15, half_open_probes=2, **_ignored):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.half_open_probes = max(1, int(half_open_probes))
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._last_error = None
+        self._rejected = 0
+        self._trips = 0
+
+    def _retry_after(self, now):
+        return max(1, int(math.ceil(self._opened_at + self.reset_timeout - now)))
+
+    def before_call(self):
+        """Raise CircuitOpen, or admit the call (possibly as a half-open probe)"""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    self._rejected += 1
+                    raise CircuitOpen(self._retry_after(now), self._last_error)
+                self._state = HALF_OPEN
+                self._probes = 0
+                logging.info("Circuit breaker half-open – probing the database")
+            if self._probes >= self.half_open_probes:
+                self._rejected += 1
+                raise CircuitOpen(1, self._last_error)
+            self._probes += 1
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logging.info("✅ Circuit breaker closed – database reachable again")
+            self._state = CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self, error=None):
+        now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            self._last_error = str(error) if error else self._last_error
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = now
+                self._probes = 0
+                self._trips += 1
+                logging.warning("Circuit breaker OPEN after %s consecutive failures: %s",
+                                self._failures, self._last_error)
+            elif self._state == OPEN:
+                self._opened_at = now
+
+    def release_probe(self):
+        """A half-open probe ended without telling us anything (e.g. pool timeout)"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "retry_after": self._retry_after(now) if self._state == OPEN else 0,
+                "rejected": self._rejected,
+                "trips": self._trips,
+                "last_error": self._last_error,
+            }
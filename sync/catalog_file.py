@@ -0,0 +1,274 @@
+"""
+Prebuilt SQLite copies of the catalog for full device refreshes.
+
+Devices load the catalog into a local SQLite store anyway, so the server can
+hand them that store ready-made: a background thread periodically writes
+masters and products to ``<dir>/<store>/v<version>-<hash>.sqlite3`` (with
+indexes on code and barcode) and /data-download/sqlite sends the current file
+as it is, through the WSGI server's file wrapper (sendfile where available).
+A request costs no query and no serialization.
+
+By default there is no refresher thread: a request that finds the file older
+than ``max_age`` gets it as it is and starts a rebuild in the background.
+The version only moves when the file's sha256 does, and files survive a
+restart. Settings are in the "catalog_file" section of config.json.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from decimal import Decimal
+
+from . import instrumentation
+from .config import get_config
+from .singleflight import SingleFlight
+from .sql_helper import get_read_connection, store_names
+
+CATALOG_FILE_DEFAULTS = {
+    "enabled": True,
+    "dir": "",                             # default: catalog_files/ next to config.json
+    "refresh_interval": 0,                 # seconds between background rebuilds, 0 = on use (see max_age)
+    "max_age": 300,                        # refresh_interval 0: age at which a request triggers a rebuild
+    "keep": 2,                             # versions left on disk for downloads still in progress
+    "cache_control": "private, no-cache",
+}
+
+SQLITE_MEDIA_TYPE = "application/vnd.sqlite3"
+PROJECT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# indexes are created after the rows are in: one sort instead of a b-tree insert per row
+INDEXES = {"masters": ("code",), "products": ("code", "barcode")}
+_HASH_CHUNK = 1 << 20
+
+class CatalogFile:
+    __slots__ = ("store", "version", "sha256", "path", "size", "built_at", "checked_at")
+
+    def __init__(self, store, version, sha256, path):
+        self.store = store
+        self.version = version
+        self.sha256 = sha256
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.built_at = os.path.getmtime(path)
+        self.checked_at = self.built_at        # last build that found the same contents
+
+    @property
+    def etag(self):
+        return f'"{self.sha256[:32]}"'
+
+    @property
+    def filename(self):
+        return f"catalog-{self.store}-v{self.version}.sqlite3"
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_CHUNK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _parse_name(name):
+    """(version, sha256 prefix) from "v<version>-<hash>.sqlite3", or None"""
+    stem, ext = os.path.splitext(name)
+    version, _, digest = stem.partition("-")
+    if ext != ".sqlite3" or not version.startswith("v") or not version[1:].isdigit() or not digest:
+        return None
+    return int(version[1:]), digest
+
+class CatalogFiles:
+    """The current catalog file of every store, built by ``build()`` or the refresher thread.
+
+    ``tables`` maps table name -> (SQL, column names), in the order they are
+    written; the SQL runs on one read connection, so the file is consistent.
+    ``params(table)``, if given, returns the parameters of a table's SQL.
+    """
+
+    def __init__(self, tables, batch_size=5000, params=None):
+        self.tables = tables
+        self.params = params or (lambda table: ())
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._current = {}
+        self._flights = SingleFlight("catalog-file")
+        self._thread = None
+        self._rebuilding = set()
+        self._counters = {"builds": 0, "unchanged_builds": 0, "failures": 0, "served": 0, "not_modified": 0}
+
+    def bump(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _dir(self, store):
+        opts = get_config().section("catalog_file", CATALOG_FILE_DEFAULTS)
+        return os.path.join(opts["dir"] or os.path.join(PROJECT_DIR, "catalog_files"), store)
+
+    def _on_disk(self, store):
+        """The newest complete file left by an earlier run"""
+        directory = self._dir(store)
+        best = None
+        for name in os.listdir(directory) if os.path.isdir(directory) else ():
+            parsed = _parse_name(name)
+            if parsed is not None and (best is None or parsed[0] > best[0]):
+                best = parsed + (name,)
+        if best is None:
+            return None
+        path = os.path.join(directory, best[2])
+        sha = _file_sha256(path)
+        if not sha.startswith(best[1]):
+            logging.warning("⚠️ Ignoring damaged catalog file %s", path)
+            return None
+        return CatalogFile(store, best[0], sha, path)
+
+    def current(self, store):
+        """The store's catalog file, building the first one if there is none yet"""
+        f = self._current.get(store)
+        if f is None:
+            f = self._flights.do(("load", store), lambda: self._load(store))
+        else:
+            opts = get_config().section("catalog_file", CATALOG_FILE_DEFAULTS)
+            if float(opts["refresh_interval"]) <= 0 and time.time() - f.checked_at > float(opts["max_age"]):
+                self._rebuild_soon(store)
+        return f
+
+    def _rebuild_soon(self, store):
+        """Rebuild in the background; the caller keeps serving the current file"""
+        with self._lock:
+            if store in self._rebuilding:
+                return
+            self._rebuilding.add(store)
+
+        def _run():
+            try:
+                self.build(store)
+            except Exception as e:
+                logging.warning("⚠️ Catalog file build for %s failed: %s", store, e)
+            finally:
+                with self._lock:
+                    self._rebuilding.discard(store)
+
+        threading.Thread(target=_run, name="catalog-file-rebuild", daemon=True).start()
+
+    def discard(self, f):
+        """Forget ``f`` (its file is gone), so current() picks up the newest one"""
+        with self._lock:
+            if self._current.get(f.store) is f:
+                del self._current[f.store]
+
+    def _load(self, store):
+        f = self._on_disk(store)
+        if f is None:
+            return self.build(store)
+        with self._lock:
+            self._current.setdefault(store, f)
+        return self._current[store]
+
+    def build(self, store):
+        return self._flights.do(store, lambda: self._build(store))
+
+    def _write(self, store, path):
+        out = sqlite3.connect(path)
+        try:
+            out.execute("PRAGMA journal_mode = OFF")
+            out.execute("PRAGMA synchronous = OFF")
+            counts = {}
+            with get_read_connection(store=store) as conn:
+                for table, (sql, columns) in self.tables.items():
+                    out.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+                    insert = f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})"
+                    cur = conn.execute(sql, self.params(table))
+                    counts[table] = 0
+                    while True:
+                        rows = cur.fetchmany(self.batch_size)
+                        if not rows:
+                            break
+                        # SQL Anywhere hands back Decimals, which sqlite3 cannot bind
+                        out.executemany(insert, ([float(v) if isinstance(v, Decimal) else v for v in r]
+                                                 for r in rows))
+                        counts[table] += len(rows)
+            for table, columns in INDEXES.items():
+                if table in self.tables:
+                    for column in columns:
+                        out.execute(f"CREATE INDEX {table}_{column} ON {table} ({column})")
+            out.commit()
+        finally:
+            out.close()
+        return counts
+
+    def _build(self, store):
+        directory = self._dir(store)
+        os.makedirs(directory, exist_ok=True)
+        tmp = os.path.join(directory, f".building-{os.getpid()}-{threading.get_ident()}.sqlite3")
+        started = time.monotonic()
+        try:
+            with instrumentation.bound_context((f"catalog-file {store}", "catalog_file")):
+                counts = self._write(store, tmp)
+            sha = _file_sha256(tmp)
+        except Exception:
+            self.bump("failures")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        old = self._current.get(store) or self._on_disk(store)
+        if old is not None and old.sha256 == sha:
+            os.remove(tmp)
+            old.checked_at = time.time()
+            with self._lock:
+                self._counters["builds"] += 1
+                self._counters["unchanged_builds"] += 1
+                self._current[store] = old
+            return old
+        version = old.version + 1 if old is not None else 1
+        path = os.path.join(directory, f"v{version}-{sha[:16]}.sqlite3")
+        os.replace(tmp, path)
+        f = CatalogFile(store, version, sha, path)
+        with self._lock:
+            self._counters["builds"] += 1
+            self._current[store] = f
+        logging.info("🗄️ Catalog file %s v%s built in %.1f s (%s bytes, %s)", store, version,
+                     time.monotonic() - started, f.size,
+                     ", ".join(f"{n} {table}" for table, n in counts.items()))
+        self._prune(store)
+        return f
+
+    def _prune(self, store):
+        keep = max(1, int(get_config().section("catalog_file", CATALOG_FILE_DEFAULTS)["keep"]))
+        directory = self._dir(store)
+        versions = sorted((p[0], name) for name in os.listdir(directory)
+                          for p in [_parse_name(name)] if p is not None)
+        for _, name in versions[:-keep]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass        # still open for a download (Windows); next build retries
+
+    def start(self):
+        """Background refresher for every store; no-op when disabled, on use
+        (refresh_interval 0) or already running"""
+        opts = get_config().section("catalog_file", CATALOG_FILE_DEFAULTS)
+        interval = float(opts["refresh_interval"])
+        if not opts["enabled"] or interval <= 0 or self._thread is not None:
+            return self._thread
+
+        def _refresh():
+            while True:
+                for name in store_names():
+                    try:
+                        self.build(name)
+                    except Exception as e:
+                        logging.warning("⚠️ Catalog file build for %s failed: %s", name, e)
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=_refresh, name="catalog-file", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stats(self, store=None):
+        """Counters, plus the current file of ``store`` (of every store when None)"""
+        with self._lock:
+            return dict(self._counters, files={
+                name: {"version": f.version, "sha256": f.sha256, "bytes": f.size,
+                       "age": round(time.time() - f.built_at, 1)}
+                for name, f in self._current.items() if store is None or name == store})
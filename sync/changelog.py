@@ -0,0 +1,184 @@
+"""
+Trigger-based change capture for the catalog tables.
+
+The schema has no change tracking of its own, so the optional installer adds a
+``sync_changelog`` table and triggers on acc_master, acc_product and
+acc_productbatch that log the key (master or product code) of every inserted,
+updated or deleted row:
+
+    python -m sync.changelog install [--store NAME]
+    python -m sync.changelog status
+    python -m sync.changelog uninstall
+
+With ``"changelog": {"enabled": true}`` the server polls that table and hands
+each batch of changed codes to a callback, which refetches just those rows for
+delta sync and drops the store's cached catalog snapshots. A sync then costs
+in proportion to what changed, not to the size of the catalog.
+
+Entries are read in ``seq`` order. A transaction that commits after a later
+one can be read past, so the delta tracker still does a slow full rescan
+(``delta_sync.fed_refresh_interval``) as a safety net.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import threading
+
+from .backends import get_backend
+from .config import get_config
+from .sql_helper import get_connection, get_read_connection, store_names
+
+CHANGELOG_DEFAULTS = {
+    "enabled": False,           # poll sync_changelog (install the triggers first)
+    "poll_interval": 5,         # seconds between polls
+    "batch_size": 5000,         # entries read per poll
+    "keep_entries": 100000,     # consumed entries kept before they are purged
+}
+
+# captured table -> its catalog part and the column logged as ``code``
+CAPTURED_TABLES = {
+    "acc_master": ("masters", "code"),
+    "acc_product": ("products", "code"),
+    "acc_productbatch": ("products", "productcode"),
+}
+
+SQL_CHANGES = "SELECT seq, tbl, code FROM sync_changelog WHERE seq > ? ORDER BY seq"
+SQL_LAST_SEQ = "SELECT MAX(seq) FROM sync_changelog"
+SQL_PURGE = "DELETE FROM sync_changelog WHERE seq <= ?"
+
+def _ddl_tables():
+    return {table: key for table, (_, key) in CAPTURED_TABLES.items()}
+
+def install(store=None):
+    backend = get_backend(get_config())
+    with get_connection(store=store) as conn:
+        for statement in backend.changelog_ddl(_ddl_tables()):
+            conn.execute(statement)
+        conn.commit()
+    logging.info("✅ Change capture installed on %s", ", ".join(CAPTURED_TABLES))
+
+def uninstall(store=None):
+    backend = get_backend(get_config())
+    with get_connection(store=store) as conn:
+        for statement in backend.changelog_drop_ddl(_ddl_tables()):
+            conn.execute(statement)
+        conn.commit()
+    logging.info("✅ Change capture triggers removed (sync_changelog kept)")
+
+def installed(store=None):
+    """Last changelog seq (0 when empty), or None if the table does not exist"""
+    try:
+        with get_read_connection(store=store) as conn:
+            return int(conn.execute(SQL_LAST_SEQ).fetchone()[0] or 0)
+    except Exception as e:
+        if get_backend(get_config()).missing_table(e):
+            return None
+        raise
+
+class ChangelogFeed:
+    """Polls each store's changelog and calls ``on_change(store, codes)`` with
+    ``{"masters": {codes}, "products": {codes}}`` for every batch of entries;
+    ``on_follow(store)`` once it starts following a store"""
+
+    def __init__(self, on_change, on_follow=None):
+        self.on_change = on_change
+        self.on_follow = on_follow
+        self._lock = threading.Lock()
+        self._positions = {}            # store -> last seq handed to on_change
+        self._thread = None
+        self._counters = {"polls": 0, "entries": 0, "batches": 0, "purged": 0, "errors": 0}
+
+    def _bump(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def poll(self, store):
+        """Read and apply one batch; returns the number of entries, or None if
+        the store has no changelog"""
+        opts = get_config().section("changelog", CHANGELOG_DEFAULTS)
+        position = self._positions.get(store)
+        if position is None:
+            # start at the head: anything older is covered by the first full scan
+            position = installed(store)
+            if position is None:
+                return None
+            self._positions[store] = position
+            logging.info("📜 Following the %s changelog from seq %s", store, position)
+            if self.on_follow is not None:
+                self.on_follow(store)
+        with get_read_connection(store=store) as conn:
+            rows = conn.execute(SQL_CHANGES, (position,)).fetchmany(int(opts["batch_size"]))
+        self._bump("polls")
+        if not rows:
+            return 0
+        codes = {}
+        for seq, table, code in rows:
+            part = CAPTURED_TABLES.get(table)
+            if part is not None:
+                codes.setdefault(part[0], set()).add(code)
+        self.on_change(store, codes)
+        self._positions[store] = rows[-1][0]
+        self._bump("entries", len(rows))
+        self._bump("batches")
+        self._purge(store, rows[-1][0] - int(opts["keep_entries"]))
+        return len(rows)
+
+    def _purge(self, store, upto):
+        if upto <= 0:
+            return
+        with get_connection(store=store) as conn:
+            cur = conn.execute(SQL_PURGE, (upto,))
+            purged = max(cur.rowcount or 0, 0)
+            conn.commit()
+        self._bump("purged", purged)
+
+    def start(self):
+        """Poll every store in a background thread; no-op when disabled or running"""
+        if not get_config().section("changelog", CHANGELOG_DEFAULTS)["enabled"] or self._thread is not None:
+            return self._thread
+
+        def _follow():
+            missing = set()
+            while True:
+                opts = get_config().section("changelog", CHANGELOG_DEFAULTS)
+                for name in store_names():
+                    try:
+                        # drain a backlog in consecutive batches before sleeping
+                        while (n := self.poll(name)) and n >= int(opts["batch_size"]):
+                            pass
+                        if n is None and name not in missing:
+                            missing.add(name)
+                            logging.warning("⚠️ No sync_changelog for %s – run: python -m sync.changelog install",
+                                            name)
+                    except Exception as e:
+                        self._bump("errors")
+                        logging.warning("⚠️ Changelog poll for %s failed: %s", name, e)
+                time.sleep(float(opts["poll_interval"]))
+
+        self._thread = threading.Thread(target=_follow, name="changelog-feed", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stats(self, store=None):
+        with self._lock:
+            return dict(self._counters, enabled=self._thread is not None,
+                        positions={k: v for k, v in self._positions.items() if store is None or k == store})
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Install or remove change capture on the catalog tables")
+    parser.add_argument("action", choices=("install", "uninstall", "status"))
+    parser.add_argument("--store", help="store name from config.json (default: the default store)")
+    args = parser.parse_args(argv)
+    if args.action == "install":
+        install(args.store)
+    elif args.action == "uninstall":
+        uninstall(args.store)
+    seq = installed(args.store)
+    print("sync_changelog: " + ("not installed" if seq is None else f"present, last seq {seq}"))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
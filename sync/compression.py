@@ -0,0 +1,137 @@
+"""
+Accept-Encoding negotiation and streaming compression.
+
+gzip and deflate come from zlib; brotli ("br") and zstd are used when the
+``brotli`` / ``zstandard`` packages are installed. Streamed bodies are
+compressed chunk by chunk with a sync flush after each one, so devices
+still receive data as soon as it is produced.
+"""
+
+import re
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# "compression" section of config.json
+COMPRESSION_DEFAULTS = {
+    "enabled": True,
+    "min_size": 1024,                               # smaller bodies go out as they are
+    "encodings": ["zstd", "br", "gzip", "deflate"],  # server preference, first available wins ties
+    "levels": {"gzip": 6, "deflate": 6, "br": 5, "zstd": 3},
+    "content_types": ["application/json", "application/msgpack", "application/cbor", "text/"],
+}
+
+class _ZlibCompressor:
+    def __init__(self, level, wbits):
+        self._c = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._c.compress(data)
+
+    def flush(self):
+        return self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._c.flush()
+
+class _BrotliCompressor:
+    def __init__(self, level):
+        self._c = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._c = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._c.compress(data)
+
+    def flush(self):
+        return self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._c.flush()
+
+CODECS = {
+    "gzip": lambda level: _ZlibCompressor(level, 16 + zlib.MAX_WBITS),
+    "deflate": lambda level: _ZlibCompressor(level, zlib.MAX_WBITS),   # zlib-wrapped, as HTTP means it
+}
+if brotli is not None:
+    CODECS["br"] = _BrotliCompressor
+if zstandard is not None:
+    CODECS["zstd"] = _ZstdCompressor
+
+_DEFAULT_LEVELS = COMPRESSION_DEFAULTS["levels"]
+_TOKEN = re.compile(r"^\s*([A-Za-z0-9*_-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?")
+
+def available():
+    return list(CODECS)
+
+def negotiate(accept_encoding, preference=None):
+    """Best available encoding for an Accept-Encoding header, or None for identity"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        m = _TOKEN.match(part)
+        if m:
+            try:
+                weights[m.group(1).lower()] = float(m.group(2)) if m.group(2) else 1.0
+            except ValueError:
+                continue
+    best, best_q = None, 0.0
+    for name in preference or COMPRESSION_DEFAULTS["encodings"]:
+        if name not in CODECS:
+            continue
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def level_for(encoding, levels=None):
+    return int((levels or {}).get(encoding, _DEFAULT_LEVELS.get(encoding, 6)))
+
+def compress_bytes(data, encoding, level=None):
+    c = CODECS[encoding](level_for(encoding) if level is None else level)
+    return c.compress(data) + c.finish()
+
+def compress_stream(chunks, encoding, level=None):
+    """Compress an iterable of byte chunks, flushing after each one"""
+    c = CODECS[encoding](level_for(encoding) if level is None else level)
+    for chunk in chunks:
+        out = c.compress(chunk) + c.flush()
+        if out:
+            yield out
+    yield c.finish()
+
+# ------------------ ETags of encoded variants ------------------
+# A compressed body is a different representation, so its strong ETag gets
+# the encoding appended ("<hash>-gzip"); base_etag() undoes that for
+# If-None-Match comparisons.
+def variant_etag(etag, encoding):
+    if not encoding or not etag.endswith('"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+def base_etag(etag):
+    for name in ("gzip", "deflate", "br", "zstd"):
+        suffix = f'-{name}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
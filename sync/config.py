@@ -0,0 +1,156 @@
+"""
+Shared access to config.json for the Django app, SyncService.py and setup_config.py.
+
+The file is parsed once and re-read only when its mtime/size changes; the
+stat() itself is throttled to once every CHECK_INTERVAL seconds, so the
+request path normally pays nothing but a clock read.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+CONFIG_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.json"))
+CHECK_INTERVAL = 3.0
+
+DEFAULTS = {
+    "ip": "127.0.0.1",
+    "port": 8000,
+    "dsn": "pktc",
+    "auto_start": True,
+    "log_level": "INFO",
+    "all_ips": [],
+}
+
+class ServiceConfig:
+    """Typed, read-only snapshot of config.json"""
+
+    def __init__(self, raw, version=0, mtime=None):
+        self.raw = raw
+        self.version = version
+        self.mtime = mtime
+        self.ip = str(raw.get("ip", DEFAULTS["ip"]))
+        self.port = int(raw.get("port", DEFAULTS["port"]))
+        self.dsn = str(raw.get("dsn", DEFAULTS["dsn"]))
+        self.auto_start = bool(raw.get("auto_start", DEFAULTS["auto_start"]))
+        self.log_level = str(raw.get("log_level", DEFAULTS["log_level"])).upper()
+        self.all_ips = tuple(raw.get("all_ips", DEFAULTS["all_ips"]))
+        # "stores": {"name": "DSN" | {"dsn": ..., "pool": {...}, "read_pool": {...}}};
+        # without it the process serves a single store named after "dsn"
+        stores = raw.get("stores") or {self.dsn: self.dsn}
+        self.stores = {str(name): (dict(v) if isinstance(v, dict) else {"dsn": str(v)})
+                       for name, v in stores.items()}
+        default_store = str(raw.get("default_store") or next(iter(self.stores)))
+        self.default_store = default_store if default_store in self.stores else next(iter(self.stores))
+
+    def store(self, name=None):
+        """Settings of one store (``dsn`` plus optional section overrides); KeyError if unknown"""
+        return self.stores[name or self.default_store]
+
+    def store_section(self, store, name, defaults=None):
+        """Like section(), with the store's own overrides for that section applied on top"""
+        merged = self.section(name, defaults)
+        merged.update(self.stores.get(store or self.default_store, {}).get(name) or {})
+        return merged
+
+    def section(self, name, defaults=None):
+        """Return a config sub-section (e.g. "pool") merged over its defaults"""
+        merged = dict(defaults or {})
+        merged.update(self.raw.get(name) or {})
+        return merged
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def as_dict(self):
+        return json.loads(json.dumps(self.raw))
+
+def load_raw(path=CONFIG_PATH):
+    """Parse config.json into a plain dict (empty dict if the file is missing)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save(config, path=CONFIG_PATH):
+    """Write a config dict back to disk; running processes pick it up on their next check"""
+    if isinstance(config, ServiceConfig):
+        config = config.raw
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp, path)
+    cache = _caches.get(os.path.abspath(path))
+    if cache is not None:
+        cache.invalidate()
+
+class ConfigCache:
+    """Holds the current ServiceConfig for one file and refreshes it on change"""
+
+    def __init__(self, path=CONFIG_PATH, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._config = None
+        self._stamp = None
+        self._next_check = 0.0
+        self._version = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def get(self):
+        now = time.monotonic()
+        if self._config is not None and now < self._next_check:
+            return self._config
+        with self._lock:
+            if self._config is not None and now < self._next_check:
+                return self._config
+            self._next_check = now + self.check_interval
+            stamp = self._stat()
+            if self._config is not None and stamp == self._stamp:
+                return self._config
+            try:
+                raw = load_raw(self.path)
+            except (OSError, ValueError) as e:
+                if self._config is None:
+                    raise
+                # half-written file or a typo – keep serving the last good copy
+                logging.warning("config.json reload failed, keeping previous config: %s", e)
+                return self._config
+            self._version += 1
+            self._stamp = stamp
+            self._config = ServiceConfig(raw, self._version, stamp[0] if stamp else None)
+            if self._version > 1:
+                logging.info("config.json changed – reloaded (version %s)", self._version)
+            return self._config
+
+    def invalidate(self):
+        with self._lock:
+            self._next_check = 0.0
+            self._stamp = None
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_config(path=CONFIG_PATH):
+    """Current ServiceConfig for ``path`` (defaults to the project's config.json)"""
+    key = os.path.abspath(path)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.setdefault(key, ConfigCache(key))
+    return cache.get()
@@ -0,0 +1,470 @@
+"""
+Delta sync: only the catalog rows that changed since a device's version.
+
+The tracker keeps the latest scanned catalog of each store (rows keyed by
+master code and by product code + barcode) and, for each of the last
+``keep_versions`` versions, which keys changed on the way to the next one.
+``/data-download?since=<version>`` composes those steps into inserted,
+updated and deleted rows. If ``since`` is no longer retained, or the delta
+would be nearly as big as the catalog, the device gets the full catalog.
+
+Every version sent to a device, and every ``since`` it asks with, goes into a
+small on-disk registry (device -> version). Compaction uses it to merge steps
+at versions no device is on, and to drop steps older than every device.
+Version numbers continue across restarts, but the deltas themselves are kept
+in memory, so the first sync after a restart is a full one.
+
+A device that knows nothing about its version (after a reset) can reconcile
+instead: products are spread over a fixed number of buckets by code, each
+bucket hashed as the sum of its row hashes, and only the rows of buckets whose
+hash differs from the device's are sent. Bucket hashes are computed once per
+bucket count and then updated from each version's changed rows.
+"""
+
+import os
+import json
+import time
+import logging
+import zlib
+import hashlib
+import threading
+from array import array
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .config import get_config
+from .singleflight import SingleFlight
+from .sql_helper import get_read_connection
+
+DELTA_SYNC_DEFAULTS = {
+    "enabled": True,
+    "keep_versions": 20,        # steps kept per store; an older ?since= gets the full catalog
+    "refresh_interval": 30,     # seconds a scan is reused before the catalog is scanned again
+    "fed_refresh_interval": 3600,   # the same while the changelog feed keeps the store current
+    "max_delta_ratio": 0.5,     # full catalog when a delta would carry more than this share of rows
+    "compact_interval": 600,    # seconds between compactions
+    "registry": "",             # device registry file, default device_versions.json next to config.json
+}
+
+SUBSET_CHUNK = 100             # codes per refetch statement, padded so the SQL text never changes
+PROJECT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+class DeviceRegistry:
+    """store -> device -> last version sent / acknowledged, plus each store's
+    latest version number, kept in a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except (OSError, ValueError) as e:
+            logging.warning("⚠️ Device registry %s unreadable, starting empty: %s", path, e)
+            data = {}
+        self._devices = data.get("devices", {})
+        self._versions = data.get("versions", {})
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"versions": self._versions, "devices": self._devices}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def last_version(self, store):
+        return int(self._versions.get(store, 0))
+
+    def set_version(self, store, version):
+        with self._lock:
+            self._versions[store] = version
+            self._save()
+
+    def record(self, store, device, acked=None, sent=None):
+        with self._lock:
+            entry = self._devices.setdefault(store, {}).setdefault(device, {})
+            if acked is not None:
+                entry["acked"] = acked
+            if sent is not None:
+                entry["sent"] = sent
+            entry["seen"] = datetime.now().isoformat(timespec="seconds")
+            self._save()
+
+    def versions_in_use(self, store):
+        with self._lock:
+            return {v for entry in self._devices.get(store, {}).values()
+                    for v in (entry.get("acked"), entry.get("sent")) if v is not None}
+
+    def devices(self, store):
+        with self._lock:
+            return len(self._devices.get(store, {}))
+
+class Step:
+    """Keys changed from one version to the next: table -> {key: existed before}"""
+    __slots__ = ("from_version", "to_version", "changes")
+
+    def __init__(self, from_version, to_version, changes):
+        self.from_version = from_version
+        self.to_version = to_version
+        self.changes = changes
+
+def _merge(changes, later):
+    """Fold a later step into ``changes``: the first "existed before" of a key wins"""
+    for table, keys in later.items():
+        merged = changes.setdefault(table, {})
+        for key, existed in keys.items():
+            merged.setdefault(key, existed)
+    return changes
+
+# ------------------ bucket hashes ------------------
+# A device computes the same values from the rows it holds: bucket = CRC-32 of
+# the UTF-8 code mod n; row hash = first 8 bytes (big-endian) of the SHA-256 of
+# the row's values as a compact JSON array, numbers in canonical form; bucket
+# hash = sum of its row hashes mod 2**64. Sums make single-row updates cheap.
+_MASK = (1 << 64) - 1
+_encode_row = DjangoJSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+def _canonical(value):
+    """Numbers as the device sees them, whatever type the driver returned:
+    integral values as integers (12.00 -> 12), the rest as the shortest
+    decimal that reads back as the same double (Decimal("12.50") -> 12.5)"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, Decimal)):
+        return value
+    if isinstance(value, int):
+        return value
+    f = float(value)
+    return int(value) if f.is_integer() else f
+
+def bucket_of(code, n):
+    return zlib.crc32(str(code).encode()) % n
+
+def row_hash(row):
+    encoded = _encode_row([_canonical(v) for v in row])
+    return int.from_bytes(hashlib.sha256(encoded.encode()).digest()[:8], "big")
+
+def _update_buckets(sums, n, changed, old, new):
+    sums = array("Q", sums)
+    for key in changed:
+        b = bucket_of(key[0], n)
+        if key in old:
+            sums[b] = (sums[b] - row_hash(old[key])) & _MASK
+        if key in new:
+            sums[b] = (sums[b] + row_hash(new[key])) & _MASK
+    return sums
+
+def bucket_hex(sums):
+    return [f"{h:016x}" for h in sums]
+
+def root_hash(hexes):
+    """SHA-256 of the concatenated hex bucket hashes"""
+    return hashlib.sha256("".join(hexes).encode()).hexdigest()
+
+class StoreCatalog:
+    __slots__ = ("store", "version", "rows", "steps", "scanned_at", "compacted_at", "groups", "buckets")
+
+    def __init__(self, store, version, rows):
+        now = time.monotonic()
+        self.store = store
+        self.version = version
+        self.rows = rows                # table -> {key: row}, in scan order
+        self.steps = deque()
+        self.scanned_at = now
+        self.compacted_at = now
+        self.groups = {}                # table -> {first key value: set of keys}, built by apply()
+        self.buckets = {}               # (table, bucket count) -> array of bucket hashes
+
+class DeltaTracker:
+    """``tables`` maps table -> (SQL, column names, key column names, subset SQL).
+
+    The subset SQL is the same query restricted to ``<first key> IN ({})``; it
+    lets apply() refetch just the rows a changelog reported. ``params(table)``,
+    if given, returns the parameters both take ahead of the IN list.
+    """
+
+    def __init__(self, tables, batch_size=5000, params=None):
+        self.tables = tables
+        self.params = params or (lambda table: ())
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._catalogs = {}
+        self._registry = None
+        self._flights = SingleFlight("delta-scan")
+        self._writer = threading.Lock()    # one scan or apply() per tracker at a time
+        self._fed = set()
+        self._counters = {"scans": 0, "versions": 0, "deltas": 0, "full": 0, "compactions": 0,
+                          "applied": 0}
+
+    def _opts(self):
+        return get_config().section("delta_sync", DELTA_SYNC_DEFAULTS)
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            with self._lock:
+                if self._registry is None:
+                    path = self._opts()["registry"] or os.path.join(PROJECT_DIR, "device_versions.json")
+                    self._registry = DeviceRegistry(path)
+        return self._registry
+
+    def _scan(self, store):
+        rows = {}
+        with get_read_connection(store=store) as conn:
+            for table, (sql, columns, key_columns, _) in self.tables.items():
+                key_idx = [columns.index(k) for k in key_columns]
+                table_rows = rows[table] = {}
+                cur = conn.execute(sql, self.params(table))
+                while True:
+                    batch = cur.fetchmany(self.batch_size)
+                    if not batch:
+                        break
+                    for r in batch:
+                        table_rows[tuple(r[i] for i in key_idx)] = tuple(r)
+        return rows
+
+    def _refresh(self, store):
+        with self._writer:
+            return self._refresh_locked(store)
+
+    def _refresh_locked(self, store):
+        rows = self._scan(store)
+        with self._lock:
+            self._counters["scans"] += 1
+            cat = self._catalogs.get(store)
+        if cat is None:
+            cat = StoreCatalog(store, self.registry.last_version(store) + 1, rows)
+            self.registry.set_version(store, cat.version)
+            with self._lock:
+                self._catalogs[store] = cat
+                self._counters["versions"] += 1
+            return cat
+
+        changes = {}
+        for table, new in rows.items():
+            old = cat.rows.get(table, {})
+            changed = {key: True for key, row in old.items() if new.get(key) != row}
+            changed.update((key, False) for key in new.keys() - old.keys())
+            if changed:
+                changes[table] = changed
+        with self._lock:
+            cat.scanned_at = time.monotonic()
+            cat.groups = {}
+        self._commit(cat, changes, rows)
+        return cat
+
+    def _commit(self, cat, changes, rows):
+        """Make ``rows`` the next version if anything changed"""
+        opts = self._opts()
+        if changes:
+            buckets = {}
+            for (table, n), sums in list(cat.buckets.items()):
+                buckets[table, n] = _update_buckets(sums, n, changes.get(table, {}),
+                                                    cat.rows[table], rows[table])
+            with self._lock:
+                cat.buckets = buckets
+                cat.steps.append(Step(cat.version, cat.version + 1, changes))
+                cat.version += 1
+                cat.rows = rows
+                self._counters["versions"] += 1
+                while len(cat.steps) > max(1, int(opts["keep_versions"])):
+                    cat.steps.popleft()
+            self.registry.set_version(cat.store, cat.version)
+            logging.info("🔀 Catalog %s v%s: %s changed rows", cat.store, cat.version,
+                         sum(len(k) for k in changes.values()))
+        if time.monotonic() - cat.compacted_at >= float(opts["compact_interval"]):
+            self.compact(cat.store)
+
+    def current(self, store):
+        """The store's catalog, rescanned when older than ``refresh_interval``
+        (``fed_refresh_interval`` while a changelog feed applies changes)"""
+        opts = self._opts()
+        interval = float(opts["fed_refresh_interval" if store in self._fed else "refresh_interval"])
+        cat = self._catalogs.get(store)
+        if cat is None or time.monotonic() - cat.scanned_at >= interval:
+            cat = self._flights.do(store, lambda: self._refresh(store))
+        return cat
+
+    def set_fed(self, store, fed=True):
+        """Whether a changelog feed keeps ``store`` current through apply()"""
+        if fed:
+            self._fed.add(store)
+        else:
+            self._fed.discard(store)
+
+    def _fetch(self, store, codes):
+        fetched = {}
+        with get_read_connection(store=store) as conn:
+            for table, wanted in codes.items():
+                _, columns, key_columns, subset_sql = self.tables[table]
+                key_idx = [columns.index(k) for k in key_columns]
+                sql = subset_sql.format(", ".join("?" * SUBSET_CHUNK))
+                params = tuple(self.params(table))
+                wanted = sorted(c for c in wanted if c is not None)
+                table_rows = fetched[table] = {}
+                for start in range(0, len(wanted), SUBSET_CHUNK):
+                    chunk = wanted[start:start + SUBSET_CHUNK]
+                    chunk += [chunk[-1]] * (SUBSET_CHUNK - len(chunk))
+                    for r in conn.execute(sql, params + tuple(chunk)).fetchall():
+                        table_rows[tuple(r[i] for i in key_idx)] = tuple(r)
+        return fetched
+
+    def apply(self, store, codes):
+        """Fold the current rows for ``codes`` (table -> first-key values, e.g. the
+        product codes a changelog reported) into a new version, without a full scan.
+
+        Returns False when the store has not been scanned yet; its first
+        request does that.
+        """
+        if store not in self._catalogs:
+            return False
+        codes = {t: set(c) for t, c in codes.items() if c and t in self.tables}
+        with self._writer:
+            cat = self._catalogs[store]
+            fresh = self._fetch(store, codes)
+            rows = dict(cat.rows)
+            changes = {}
+            for table, wanted in codes.items():
+                old, new = cat.rows[table], fresh[table]
+                groups = cat.groups.get(table)
+                if groups is None:
+                    groups = cat.groups[table] = {}
+                    for key in old:
+                        groups.setdefault(key[0], set()).add(key)
+                changed = {key: True for code in wanted for key in groups.get(code, ())
+                           if new.get(key) != old[key]}
+                changed.update((key, False) for key in new.keys() - old.keys())
+                if not changed:
+                    continue
+                table_rows = rows[table] = dict(old)
+                for key in changed:
+                    if key in new:
+                        table_rows[key] = new[key]
+                        groups.setdefault(key[0], set()).add(key)
+                    else:
+                        del table_rows[key]
+                        groups[key[0]].discard(key)
+                changes[table] = changed
+            self.bump("applied")
+            self._commit(cat, changes, rows)
+        return True
+
+    def buckets(self, store, table, n):
+        """(version, array of ``n`` bucket hashes) for ``table``"""
+        cat = self.current(store)
+        with self._lock:
+            version, rows, sums = cat.version, cat.rows, cat.buckets.get((table, n))
+        if sums is None:
+            sums = array("Q", [0]) * n
+            for key, row in rows[table].items():
+                b = bucket_of(key[0], n)
+                sums[b] = (sums[b] + row_hash(row)) & _MASK
+            with self._lock:
+                if cat.rows is rows:
+                    cat.buckets[table, n] = sums
+        return version, sums
+
+    def bucket_rows(self, store, table, n, wanted, version):
+        """Rows of ``table`` in the ``wanted`` buckets, or None if ``version`` is no longer current"""
+        cat = self._catalogs[store]
+        with self._lock:
+            if cat.version != version:
+                return None
+            rows = cat.rows[table]
+        return [row for key, row in rows.items() if bucket_of(key[0], n) in wanted]
+
+    def compact(self, store):
+        """Merge steps that end at a version no device is on; drop steps below every device"""
+        cat = self._catalogs.get(store)
+        if cat is None:
+            return
+        in_use = self.registry.versions_in_use(store)
+        with self._lock:
+            steps = list(cat.steps)
+            oldest = min(in_use, default=cat.version)
+            steps = [s for s in steps if s.to_version > oldest]
+            merged = []
+            for step in steps:
+                prev = merged[-1] if merged else None
+                if prev is not None and prev.to_version == step.from_version and prev.to_version not in in_use:
+                    merged[-1] = Step(prev.from_version, step.to_version,
+                                      _merge(_merge({}, prev.changes), step.changes))
+                else:
+                    merged.append(step)
+            removed = len(cat.steps) - len(merged)
+            cat.steps = deque(merged)
+            cat.compacted_at = time.monotonic()
+            self._counters["compactions"] += 1
+        if removed:
+            logging.info("🗜️ Compacted catalog %s deltas: %s steps left", store, len(merged))
+
+    @staticmethod
+    def _changes_since(steps, version, since):
+        """Composed changes from ``since`` to ``version``, or None if not retained"""
+        if since == version:
+            return {}
+        changes, at = None, since
+        for step in steps:
+            if changes is None:
+                if step.from_version != since:
+                    continue
+                changes = {}
+            if step.from_version != at:
+                return None
+            _merge(changes, step.changes)
+            at = step.to_version
+        return changes if at == version else None
+
+    def payload(self, store, since, device, tables, row_dict):
+        """The ?since= response body for ``tables`` (table -> payload key): a
+        delta, or the full catalog.
+
+        ``row_dict(table, row)`` turns a stored row into what is sent.
+        """
+        opts = self._opts()
+        cat = self.current(store)
+        with self._lock:
+            version, rows, steps = cat.version, cat.rows, list(cat.steps)
+        changes = self._changes_since(steps, version, since) if since > 0 else None
+        if changes is not None:
+            touched = sum(len(changes.get(t, ())) for t in tables)
+            total = sum(len(rows[t]) for t in tables)
+            if total and touched > float(opts["max_delta_ratio"]) * total:
+                changes = None
+        if changes is None:
+            payload = {"status": "success", "mode": "full", "version": version}
+            for table, name in tables.items():
+                payload[name] = [row_dict(table, r) for r in rows[table].values()]
+            self.bump("full")
+        else:
+            payload = {"status": "success", "mode": "delta", "since": since, "version": version}
+            for table, name in tables.items():
+                current = rows[table]
+                key_columns = self.tables[table][2]
+                part = payload[name] = {"inserted": [], "updated": [], "deleted": []}
+                for key, existed in changes.get(table, {}).items():
+                    row = current.get(key)
+                    if row is not None:
+                        part["updated" if existed else "inserted"].append(row_dict(table, row))
+                    elif existed:
+                        part["deleted"].append(dict(zip(key_columns, key)))
+            self.bump("deltas")
+        self.registry.record(store, device, acked=since if since > 0 else None, sent=version)
+        return payload
+
+    def bump(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self, store=None):
+        """Counters, plus the tracked catalog of ``store`` (of every store when None)"""
+        with self._lock:
+            stores = {name: {"version": c.version, "steps": len(c.steps),
+                             "rows": {t: len(r) for t, r in c.rows.items()},
+                             "age": round(time.monotonic() - c.scanned_at, 1)}
+                      for name, c in self._catalogs.items() if store is None or name == store}
+        for name, entry in stores.items():
+            entry["devices"] = self.registry.devices(name)
+        return dict(self._counters, stores=stores)
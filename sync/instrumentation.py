@@ -0,0 +1,346 @@
+"""
+Per-statement timing (and statement deadlines) for every cursor handed out by sql_helper.
+
+Each executed statement is reduced to a fingerprint (literals replaced by
+"?", whitespace collapsed) and its time - execute plus every fetch until the
+cursor moves on - is folded into per-fingerprint aggregates. Statements
+slower than ``slow_query_ms`` are written to the "sync.slow_query" logger
+with their parameters redacted.
+"""
+
+import os
+import re
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+
+from .watchdog import watchdog, StatementTimeout
+
+INSTRUMENTATION_DEFAULTS = {
+    "enabled": True,
+    "slow_query_ms": 500,        # statements at/above this go to the slow-query log
+    "slow_log_file": "",         # optional extra file for the slow-query log (relative: next to config.json)
+    "samples": 1024,             # latencies kept per fingerprint for percentiles
+    "recent": 200,               # most recent statements kept for /query-stats?recent=1
+}
+
+slow_log = logging.getLogger("sync.slow_query")
+PROJECT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# ------------------ request context ------------------
+_local = threading.local()
+
+def start_request(label, request_id=None):
+    """Tag statements run by this thread with a request id; returns the id"""
+    request_id = request_id or uuid.uuid4().hex[:12]
+    _local.request = f"{request_id} {label}"
+    _local.endpoint = None
+    return request_id
+
+def set_endpoint(name):
+    """Name of the view being served; selects its statement deadline"""
+    _local.endpoint = name
+
+def end_request():
+    _local.request = None
+    _local.endpoint = None
+
+def current_request():
+    return getattr(_local, "request", None)
+
+def current_endpoint():
+    return getattr(_local, "endpoint", None)
+
+def request_context():
+    """Snapshot of this thread's request tag and endpoint, for work done later"""
+    return current_request(), current_endpoint()
+
+@contextmanager
+def bound_context(ctx):
+    """Run with a context from request_context(), e.g. inside a streaming response
+    whose body is produced after the middleware has ended the request"""
+    previous = request_context()
+    _local.request, _local.endpoint = ctx
+    try:
+        yield
+    finally:
+        _local.request, _local.endpoint = previous
+
+def bind_iter(chunks, ctx):
+    """Yield from the generator ``chunks`` with ``ctx`` bound while each item is
+    produced (and while it is closed), e.g. a StreamingHttpResponse body that
+    runs after the middleware has ended the request"""
+    try:
+        while True:
+            with bound_context(ctx):
+                try:
+                    item = next(chunks)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        with bound_context(ctx):
+            chunks.close()
+
+# ------------------ fingerprints ------------------
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    fp = _STRING.sub("?", sql)
+    fp = _NUMBER.sub("?", fp)
+    fp = _SPACE.sub(" ", fp).strip()
+    return _IN_LIST.sub("(?+)", fp)
+
+def _redact(params):
+    if not params:
+        return "()"
+    return f"<{len(params)} redacted>"
+
+# ------------------ aggregates ------------------
+class _Aggregate:
+    __slots__ = ("count", "errors", "total", "max", "rows", "samples")
+
+    def __init__(self, samples):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=samples)
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+class QueryStats:
+    """Thread-safe per-fingerprint latency aggregates plus a ring of recent statements"""
+
+    def __init__(self, samples=1024, recent=200, slow_query_ms=500):
+        self.samples = samples
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self._by_fp = {}
+        self._recent = deque(maxlen=recent)
+        self._slow = 0
+        self._since = time.time()
+
+    def record(self, sql, seconds, rows, error=False, params=None):
+        fp = fingerprint(sql)
+        ms = seconds * 1000.0
+        request = current_request()
+        with self._lock:
+            agg = self._by_fp.get(fp)
+            if agg is None:
+                agg = self._by_fp[fp] = _Aggregate(self.samples)
+            agg.count += 1
+            agg.total += ms
+            agg.max = max(agg.max, ms)
+            agg.rows += max(rows, 0)
+            agg.samples.append(ms)
+            if error:
+                agg.errors += 1
+            self._recent.append({"fingerprint": fp, "ms": round(ms, 2), "rows": rows,
+                                 "error": error, "request": request, "at": time.time()})
+            slow = self.slow_query_ms > 0 and ms >= self.slow_query_ms
+            if slow:
+                self._slow += 1
+        if slow:
+            slow_log.warning("SLOW QUERY %.1f ms rows=%s request=%s sql=%s params=%s",
+                             ms, rows, request or "-", fp, _redact(params))
+
+    def snapshot(self, recent=False):
+        with self._lock:
+            rows = []
+            for fp, agg in self._by_fp.items():
+                ordered = sorted(agg.samples)
+                rows.append({
+                    "fingerprint": fp,
+                    "count": agg.count,
+                    "errors": agg.errors,
+                    "rows": agg.rows,
+                    "total_ms": round(agg.total, 2),
+                    "avg_ms": round(agg.total / agg.count, 2),
+                    "p50_ms": round(_percentile(ordered, 50), 2),
+                    "p95_ms": round(_percentile(ordered, 95), 2),
+                    "p99_ms": round(_percentile(ordered, 99), 2),
+                    "max_ms": round(agg.max, 2),
+                })
+            out = {
+                "since": self._since,
+                "slow_query_ms": self.slow_query_ms,
+                "slow_queries": self._slow,
+                "queries": sorted(rows, key=lambda r: r["total_ms"], reverse=True),
+            }
+            if recent:
+                out["recent"] = list(self._recent)
+        return out
+
+    def reset(self):
+        with self._lock:
+            self._by_fp.clear()
+            self._recent.clear()
+            self._slow = 0
+            self._since = time.time()
+
+# ------------------ cursor wrapper ------------------
+class InstrumentedCursor:
+    """Wraps a DB-API cursor: reports each statement to a QueryStats and
+    enforces the current endpoint's statement deadline.
+
+    A statement stays "open" from execute() until its result is exhausted, a
+    fetchone() has read its row, or the next execute(), close() or finish(),
+    so time spent fetching is charged to it and counts against its deadline
+    as well. fetchone() is for single-row lookups; iterate or use fetchmany()
+    to read a longer result under the deadline.
+    """
+
+    ITER_BATCH = 500
+
+    def __init__(self, cursor, stats=None, cancel=None, timeout_for=None):
+        self._cursor = cursor
+        self._stats = stats
+        self._cancel = cancel
+        self._timeout_for = timeout_for
+        self._sql = None
+        self._params = None
+        self._elapsed = 0.0
+        self._rows = 0
+        self._timer = None
+        self._limit = 0
+
+    def _begin(self, sql, params):
+        self.finish()
+        self._sql = sql
+        self._params = params
+        self._elapsed = 0.0
+        self._rows = 0
+        if self._timeout_for is not None:
+            endpoint = current_endpoint()
+            self._limit = self._timeout_for(endpoint)
+            if self._limit > 0:
+                self._timer = watchdog.arm(time.monotonic() + self._limit, self._cancel, endpoint)
+
+    def _disarm(self):
+        timer, self._timer = self._timer, None
+        return timer is not None and watchdog.disarm(timer)
+
+    @property
+    def finished(self):
+        """No statement open: nothing armed, nothing left to record"""
+        return self._sql is None
+
+    def finish(self):
+        """Close out the current statement: stop its deadline and record it"""
+        self._disarm()
+        if self._sql is None:
+            return
+        sql, self._sql = self._sql, None
+        if self._stats is not None:
+            self._stats.record(sql, self._elapsed, self._rows, params=self._params)
+
+    def _failed(self, exc, started):
+        timer = self._timer
+        fired = self._disarm()
+        sql, self._sql = self._sql, None
+        if self._stats is not None and sql is not None:
+            self._stats.record(sql, self._elapsed + time.perf_counter() - started, self._rows,
+                               error=True, params=self._params)
+        if fired:
+            raise StatementTimeout(timer.endpoint, self._limit) from exc
+
+    def _call(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._failed(e, started)
+            raise
+        self._elapsed += time.perf_counter() - started
+        return result
+
+    def execute(self, sql, params=()):
+        self._begin(sql, params)
+        result = self._call(self._cursor.execute, sql, params)
+        self._count_affected()
+        return self if result is self._cursor else result
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self._begin(sql, seq_of_params[0] if seq_of_params else None)
+        result = self._call(self._cursor.executemany, sql, seq_of_params)
+        self._count_affected()
+        return self if result is self._cursor else result
+
+    def _count_affected(self):
+        # result sets are counted as they are fetched; DML reports rowcount
+        if self._cursor.description is None:
+            rowcount = getattr(self._cursor, "rowcount", -1) or 0
+            if rowcount > 0:
+                self._rows += rowcount
+            self.finish()
+
+    def fetchone(self):
+        row = self._call(self._cursor.fetchone)
+        if row is not None:
+            self._rows += 1
+        self.finish()
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._call(self._cursor.fetchmany, *args)
+        self._rows += len(rows)
+        if not rows:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._call(self._cursor.fetchall)
+        self._rows += len(rows)
+        self.finish()
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.ITER_BATCH)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self.finish()
+        self._cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+# ------------------ module-level registry ------------------
+_stats = None
+_stats_lock = threading.Lock()
+_file_handler = None
+
+def configure(options):
+    """(Re)build the registry from the "instrumentation" config section"""
+    global _stats, _file_handler
+    with _stats_lock:
+        _stats = QueryStats(int(options["samples"]), int(options["recent"]),
+                            float(options["slow_query_ms"]))
+        path = options.get("slow_log_file")
+        if path and _file_handler is None:
+            # the service runner and run_service start in different directories
+            _file_handler = logging.FileHandler(os.path.join(PROJECT_DIR, path), encoding="utf-8")
+            _file_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+            slow_log.addHandler(_file_handler)
+    return _stats
+
+def get_stats():
+    return _stats
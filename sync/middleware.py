@@ -0,0 +1,95 @@
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+
+from . import compression, instrumentation
+from .config import get_config
+from .breaker import CircuitOpen
+from .sql_helper import PoolTimeout, driver_errors
+from .watchdog import StatementTimeout
+
+
+class QueryContextMiddleware:
+    """Tags every SQL statement run while serving a request with that request's id"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.request_id = instrumentation.start_request(
+            f"{request.method} {request.path}", request.headers.get("X-Request-ID"))
+        try:
+            response = self.get_response(request)
+        finally:
+            instrumentation.end_request()
+        response["X-Request-ID"] = request.request_id
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # the view name selects the statement deadline (config.json "statement_timeouts")
+        instrumentation.set_endpoint(getattr(view_func, "__name__", None))
+        return None
+
+
+class DatabaseUnavailableMiddleware:
+    """Turns "database down" / "pool exhausted" into an immediate 503 with Retry-After,
+    a cancelled long-running statement into a 504 and other driver errors into a JSON 500"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, StatementTimeout):
+            return JsonResponse({"detail": f"Query timed out after {exception.seconds:g}s"}, status=504)
+        if isinstance(exception, CircuitOpen):
+            retry_after, detail = exception.retry_after, "Database unavailable"
+        elif isinstance(exception, PoolTimeout):
+            retry_after, detail = 1, "Server busy"
+        elif isinstance(exception, driver_errors()):
+            return JsonResponse({"detail": f"Database error: {exception}"}, status=500)
+        else:
+            return None
+        response = JsonResponse({"detail": f"{detail}, retry in {retry_after}s"}, status=503)
+        response["Retry-After"] = str(retry_after)
+        return response
+
+
+class CompressionMiddleware:
+    """Compresses JSON/text responses with the best encoding the client accepts.
+
+    Streaming responses are compressed on the fly; responses that already
+    carry a Content-Encoding (e.g. precompressed catalog snapshots) are left alone.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        opts = get_config().section("compression", compression.COMPRESSION_DEFAULTS)
+        if not opts["enabled"] or response.status_code != 200 or response.has_header("Content-Encoding"):
+            return response
+        content_type = response.get("Content-Type", "")
+        if not any(content_type.startswith(t) for t in opts["content_types"]):
+            return response
+        if not response.streaming and len(response.content) < int(opts["min_size"]):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding", ""), opts["encodings"])
+        if encoding is None:
+            return response
+        level = compression.level_for(encoding, opts["levels"])
+        if response.streaming:
+            response.streaming_content = compression.compress_stream(response.streaming_content, encoding, level)
+            if response.has_header("Content-Length"):
+                del response["Content-Length"]
+        else:
+            response.content = compression.compress_bytes(response.content, encoding, level)
+            response["Content-Length"] = str(len(response.content))
+        if response.has_header("ETag"):
+            response["ETag"] = compression.variant_etag(response["ETag"], encoding)
+        response["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,197 @@
+"""
+Wire formats for /data-download and /upload-orders.
+
+JSON is the default. MessagePack (``pip install msgpack``) and CBOR
+(``pip install cbor2``) are offered when installed and chosen with the
+``Accept`` header for responses and ``Content-Type`` for request bodies.
+
+    python -m sync.serializers --products 150000    # encode/decode/size benchmark
+"""
+
+import json
+import struct
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+class UnsupportedMediaType(ValueError):
+    """Request body in a format this server cannot decode."""
+
+class NotAcceptable(ValueError):
+    """Accept only names formats this server cannot encode (their library is not installed)."""
+
+class Codec:
+    media_type = None
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def array_header(self, n):
+        """Bytes that open an array of ``n`` items encoded one by one with dumps()"""
+        raise NotImplementedError
+
+    def map_header(self, n):
+        raise NotImplementedError
+
+class JSONCodec(Codec):
+    media_type = JSON
+    _encode = DjangoJSONEncoder().encode
+
+    def dumps(self, obj):
+        return self._encode(obj).encode()
+
+    def loads(self, data):
+        return json.loads(data)
+
+class MsgPackCodec(Codec):
+    media_type = MSGPACK
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def array_header(self, n):
+        return msgpack.Packer().pack_array_header(n)
+
+    def map_header(self, n):
+        return msgpack.Packer().pack_map_header(n)
+
+def _cbor_head(major, n):
+    if n < 24:
+        return bytes([major << 5 | n])
+    for info, fmt in ((24, ">B"), (25, ">H"), (26, ">I"), (27, ">Q")):
+        if n < 1 << (8 * struct.calcsize(fmt)):
+            return bytes([major << 5 | info]) + struct.pack(fmt, n)
+    raise OverflowError(n)
+
+class CBORCodec(Codec):
+    media_type = CBOR
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj)
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+    def array_header(self, n):
+        return _cbor_head(4, n)
+
+    def map_header(self, n):
+        return _cbor_head(5, n)
+
+CODECS = {JSON: JSONCodec()}
+if msgpack is not None:
+    CODECS[MSGPACK] = MsgPackCodec()
+if cbor2 is not None:
+    CODECS[CBOR] = CBORCodec()
+
+# other spellings clients send
+_ALIASES = {"application/x-msgpack": MSGPACK, "application/vnd.msgpack": MSGPACK}
+
+def _media(value):
+    media = value.split(";", 1)[0].strip().lower()
+    return _ALIASES.get(media, media)
+
+def for_response(accept):
+    """Codec for an Accept header: the highest-q available type, JSON otherwise.
+
+    NotAcceptable when the header asks for MessagePack/CBOR without a
+    library for them and accepts nothing else (no JSON, no wildcard).
+    """
+    best, best_q = CODECS[JSON], 0.0
+    missing, fallback = [], not accept
+    for part in (accept or "").split(","):
+        media = _media(part)
+        q = 1.0
+        for param in part.split(";")[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codec = CODECS.get(media)
+        if codec is not None and q > best_q:
+            best, best_q = codec, q
+        elif codec is None and q > 0:
+            if media in (MSGPACK, CBOR):
+                missing.append(media)
+            else:
+                fallback = True      # */*, or a type old clients send that JSON has always answered
+    if best_q == 0 and missing and not fallback:
+        raise NotAcceptable(", ".join(missing))
+    return best
+
+def for_request(content_type):
+    """Codec for a request Content-Type; JSON when absent"""
+    media = _media(content_type or "") or JSON
+    if media in ("text/plain", "application/x-www-form-urlencoded"):
+        media = JSON     # old clients post JSON without a proper Content-Type
+    codec = CODECS.get(media)
+    if codec is None:
+        raise UnsupportedMediaType(media)
+    return codec
+
+# ------------------ benchmark ------------------
+def main(argv=None):
+    import time
+    import random
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(description="Compare JSON / MessagePack / CBOR on a synthetic catalog")
+    parser.add_argument("--products", type=int, default=150000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(42)
+    rows = []
+    for i in range(args.products):
+        cost = round(rng.uniform(1, 500), 2)
+        rows.append({"code": f"P{i:07d}", "name": f"Product {i}", "barcode": f"89{i:09d}00",
+                     "quantity": float(rng.randint(0, 500)), "salesprice": round(cost * 1.2, 2),
+                     "bmrp": round(cost * 1.35, 2), "cost": cost})
+    keys = list(rows[0])
+    payloads = {
+        "rows": {"status": "success", "product_data": rows},
+        "columnar": {"status": "success", "product_data": {
+            "columns": keys, "data": [[r[k] for r in rows] for k in keys]}},
+    }
+
+    print(f"{'codec':<22}{'shape':<10}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    for media, codec in CODECS.items():
+        for shape, payload in payloads.items():
+            enc, dec = [], []
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                data = codec.dumps(payload)
+                enc.append(time.perf_counter() - t)
+                t = time.perf_counter()
+                codec.loads(data)
+                dec.append(time.perf_counter() - t)
+            print(f"{media:<22}{shape:<10}{len(data):>12}"
+                  f"{statistics.median(enc) * 1000:>12.1f}{statistics.median(dec) * 1000:>12.1f}")
+    missing = [name for name, mod in (("msgpack", msgpack), ("cbor2", cbor2)) if mod is None]
+    if missing:
+        print(f"(not installed: {', '.join(missing)})")
+
+if __name__ == "__main__":
+    main()
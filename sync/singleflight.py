@@ -0,0 +1,138 @@
+"""
+Single-flight coalescing of identical catalog builds.
+
+The first request for a key becomes the leader: its chunk generator is run
+once on a builder thread and every chunk is kept on the flight. Requests
+for the same key that arrive while it is in flight read the same chunks
+from the start, so the database sees one scan per burst instead of one per
+device. A flight ends when the generator is exhausted; the next request
+starts a fresh one. If every reader goes away the build is abandoned.
+
+``do()`` is the same for a plain function call whose result is shared.
+"""
+
+import logging
+import threading
+
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self._cond = threading.Condition()
+
+    def _run(self, chunks, on_done):
+        try:
+            for chunk in chunks:
+                with self._cond:
+                    if self.readers == 0:
+                        raise GeneratorExit
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except GeneratorExit:
+            logging.info("Catalog build %s abandoned – no readers left", self.key)
+            self.error = ConnectionAbortedError("catalog build abandoned")
+        except Exception as e:
+            self.error = e
+        finally:
+            chunks.close()
+            on_done(self)
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def reader(self):
+        """Iterate every chunk of the flight, waiting for the builder as needed.
+
+        The caller registers the reader (``readers += 1``) before starting it.
+        """
+        i = 0
+        try:
+            while True:
+                with self._cond:
+                    while i >= len(self.chunks) and not self.done:
+                        self._cond.wait()
+                    if i < len(self.chunks):
+                        chunk = self.chunks[i]
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        return
+                i += 1
+                yield chunk
+        finally:
+            with self._cond:
+                self.readers -= 1
+
+class SingleFlight:
+    def __init__(self, name="single-flight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._leaders = 0
+        self._followers = 0
+
+    def _finish(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def join(self, key, produce):
+        """Reader over the in-flight build for ``key``, starting one with ``produce()``
+        if there is none. ``produce()`` is called on the joining (leader's)
+        thread; the generator it returns is then drained on the builder thread.
+
+        Returns (reader, leader).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key)
+                self._leaders += 1
+            else:
+                self._followers += 1
+            with flight._cond:
+                flight.readers += 1
+        if leader:
+            threading.Thread(target=flight._run, args=(produce(), self._finish),
+                             name=f"{self.name}-build", daemon=True).start()
+        return flight.reader(), leader
+
+    def do(self, key, fn):
+        """Run ``fn()`` once for everyone asking for ``key`` at the same time.
+
+        The first caller runs it on its own thread; the others wait and get the
+        same result (or exception).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key)
+                self._leaders += 1
+            else:
+                self._followers += 1
+        if leader:
+            try:
+                flight.chunks.append(fn())
+            except Exception as e:
+                flight.error = e
+            finally:
+                self._finish(flight)
+                with flight._cond:
+                    flight.done = True
+                    flight._cond.notify_all()
+        else:
+            with flight._cond:
+                while not flight.done:
+                    flight._cond.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.chunks[0]
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "builds": self._leaders, "coalesced": self._followers}
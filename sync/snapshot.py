@@ -0,0 +1,206 @@
+"""
+Versioned in-process snapshots of serialized catalog payloads.
+
+A snapshot is the complete response body (kept as its chunks) plus a strong
+ETag (sha256 of the body) and a version number that only moves when the
+content does. Whether a snapshot is still good is decided by the policy in
+the "catalog_cache" section of config.json:
+
+    "ttl"     - rebuild after ``ttl`` seconds
+    "change"  - rebuild when the store's change signature (changelog position
+                or a checksum of the catalog) differs; it is re-checked at
+                most every ``check_interval`` s
+
+Either way a snapshot is never served for longer than ``max_age`` seconds.
+Snapshots are kept least-recently-used first up to ``max_entries`` and
+``max_bytes`` (bodies plus their compressed variants). Versions come from one
+counter for the whole cache, so a key rebuilt after eviction never goes back
+to an older version number.
+
+Rebuilds are single-flight: one caller builds, concurrent callers wait for it.
+"""
+
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from . import compression
+from .singleflight import SingleFlight
+
+CATALOG_CACHE_DEFAULTS = {
+    "enabled": True,
+    "policy": "ttl",                       # "ttl" or "change"
+    "ttl": 300,                            # seconds a snapshot is served before a rebuild ("ttl")
+    "check_interval": 15,                  # seconds between change-signature checks ("change")
+    "max_age": 3600,                       # seconds after which a snapshot is rebuilt whatever the policy
+    "cache_control": "private, no-cache",  # devices keep the body but revalidate with If-None-Match
+    "chunk_size": 262144,                  # bytes per checksummed chunk in ?manifest=1
+    "max_entries": 64,                     # snapshots kept (one per store, part, format, codec, selection)
+    "max_bytes": 268435456,                # bodies plus compressed variants kept, least recently used go first
+}
+
+class Snapshot:
+    __slots__ = ("key", "version", "sha256", "etag", "chunks", "size", "built_at", "signature", "checked_at",
+                 "variants", "manifests")
+
+    def __init__(self, key, version, sha256, chunks, signature=None):
+        now = time.monotonic()
+        self.key = key
+        self.version = version
+        self.sha256 = sha256
+        self.etag = f'"{sha256[:32]}"'
+
+        self.chunks = chunks
+        self.size = sum(len(c) for c in chunks)
+        self.built_at = now
+        self.signature = signature
+        self.checked_at = now
+        self.variants = {}          # encoding -> precompressed body
+        self.manifests = {}         # chunk size -> sha256 of each chunk of the body
+
+    def body(self):
+        return b"".join(self.chunks)
+
+    def footprint(self):
+        return self.size + sum(len(b) for b in list(self.variants.values()))
+
+    def manifest(self, chunk_size):
+        """sha256 (hex) of every ``chunk_size`` slice of the body, computed once"""
+        sums = self.manifests.get(chunk_size)
+        if sums is None:
+            body = memoryview(self.body())
+            sums = self.manifests[chunk_size] = [hashlib.sha256(body[i:i + chunk_size]).hexdigest()
+                                                 for i in range(0, len(body), chunk_size)]
+        return sums
+
+    def slice(self, start, end):
+        """Body bytes ``start``..``end`` (inclusive), without joining the whole body"""
+        out, offset = [], 0
+        for chunk in self.chunks:
+            lo, hi = max(start - offset, 0), min(end + 1 - offset, len(chunk))
+            if lo < hi:
+                out.append(chunk[lo:hi])
+            offset += len(chunk)
+            if offset > end:
+                break
+        return b"".join(out)
+
+class SnapshotCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots = OrderedDict()     # least recently used first
+        self._version = 0
+        self._limits = (CATALOG_CACHE_DEFAULTS["max_entries"], CATALOG_CACHE_DEFAULTS["max_bytes"])
+        self._flights = SingleFlight("snapshot")
+        self._counters = {"hits": 0, "builds": 0, "unchanged_builds": 0, "not_modified": 0,
+                          "compressions": 0, "evictions": 0}
+
+    def bump(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    @staticmethod
+    def _watches_changes(opts, signature):
+        return opts["policy"] == "change" and signature is not None
+
+    def _fresh(self, snap, opts, signature):
+        now = time.monotonic()
+        if now - snap.built_at >= float(opts["max_age"]):
+            return False
+        if self._watches_changes(opts, signature):
+            if now - snap.checked_at < float(opts["check_interval"]):
+                return True
+            current = self._flights.do(("signature", snap.key), signature)
+            snap.checked_at = time.monotonic()
+            return current == snap.signature
+        return now - snap.built_at < float(opts["ttl"])
+
+    def get(self, key, opts, build, signature=None):
+        """Current snapshot for ``key``, rebuilt with ``build()`` (an iterable of
+        body chunks) when the policy says it is stale"""
+        self._limits = (max(1, int(opts["max_entries"])), max(0, int(opts["max_bytes"])))
+        snap = self._snapshots.get(key)
+        if snap is not None and self._fresh(snap, opts, signature):
+            with self._lock:
+                self._counters["hits"] += 1
+                if key in self._snapshots:
+                    self._snapshots.move_to_end(key)
+            return snap
+        if not self._watches_changes(opts, signature):
+            signature = None        # "ttl" never compares it
+        return self._flights.do(key, lambda: self._build(key, build, signature))
+
+    def _build(self, key, build, signature):
+        sig = signature() if signature is not None else None
+        digest = hashlib.sha256()
+        chunks = []
+        for chunk in build():
+            if chunk:
+                digest.update(chunk)
+                chunks.append(chunk)
+        sha256 = digest.hexdigest()
+        with self._lock:
+            self._counters["builds"] += 1
+            old = self._snapshots.get(key)
+            if old is not None and old.sha256 == sha256:
+                self._counters["unchanged_builds"] += 1
+                version = old.version
+            else:
+                self._version += 1
+                version = self._version
+            snap = self._snapshots[key] = Snapshot(key, version, sha256, chunks, sig)
+            self._snapshots.move_to_end(key)
+            if old is not None and old.sha256 == sha256:
+                snap.variants = old.variants
+                snap.manifests = old.manifests
+            self._trim_locked()
+        if version != (old.version if old is not None else None):
+            logging.info("📦 Catalog snapshot %s v%s built (%s bytes)", key, version, snap.size)
+        return snap
+
+    def variant(self, snap, encoding, level):
+        """The snapshot body compressed with ``encoding``, compressed once and kept with it"""
+        body = snap.variants.get(encoding)
+        if body is None:
+            def _compress():
+                data = snap.variants.get(encoding)
+                if data is None:
+                    data = snap.variants[encoding] = compression.compress_bytes(snap.body(), encoding, level)
+                    with self._lock:
+                        self._counters["compressions"] += 1
+                        self._trim_locked()
+                return data
+            body = self._flights.do((snap.key, snap.version, encoding), _compress)
+        return body
+
+    def _trim_locked(self):
+        """Drop least recently used snapshots beyond the limits; the newest always stays"""
+        max_entries, max_bytes = self._limits
+        total = sum(s.footprint() for s in self._snapshots.values())
+        while len(self._snapshots) > 1 and (len(self._snapshots) > max_entries or total > max_bytes):
+            _, old = self._snapshots.popitem(last=False)
+            total -= old.footprint()
+            self._counters["evictions"] += 1
+
+    def invalidate(self, key=None, store=None):
+        """Drop one snapshot, every snapshot of a store (keys start with it), or all"""
+        with self._lock:
+            if key is not None:
+                self._snapshots.pop(key, None)
+            elif store is not None:
+                for k in [k for k in self._snapshots if k[0] == store]:
+                    del self._snapshots[k]
+            else:
+                self._snapshots.clear()
+
+    def stats(self, store=None):
+        """Counters, plus the snapshots of ``store`` (all of them when None)"""
+        with self._lock:
+            snaps = {k: s for k, s in self._snapshots.items() if store is None or k[0] == store}
+            return dict(self._counters, bytes=sum(s.footprint() for s in snaps.values()), snapshots={
+                "/".join(map(str, k)): {"version": s.version, "etag": s.etag, "bytes": s.size,
+                                        "age": round(time.monotonic() - s.built_at, 1),
+                                        "variants": {e: len(b) for e, b in s.variants.items()}}
+                for k, s in snaps.items()})
@@ -1,21 +1,968 @@
-import sqlanydb
-import os
-import json
+import sys
+import math
+import time
+import queue
 import logging
+import threading
+from array import array
+from decimal import Decimal
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from .config import get_config
+from .backends import get_backend
+from . import instrumentation
+from .instrumentation import InstrumentedCursor, INSTRUMENTATION_DEFAULTS
+from .breaker import CircuitBreaker, CircuitOpen, BREAKER_DEFAULTS
+from .watchdog import watchdog, StatementTimeout, STATEMENT_TIMEOUT_DEFAULTS
+
+try:
+    import numpy as np      # optional: fetch_columnar(numpy=True) returns ndarrays
+except ImportError:
+    np = None
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.json")
+# defaults for the "pool" section of config.json
+POOL_DEFAULTS = {
+    "min_size": 2,               # connections kept open (and pre-warmed at startup)
+    "max_size": 10,              # hard upper bound, borrowers wait beyond this
+    "acquire_timeout": 10,       # seconds a borrower waits for a free connection
+    "idle_timeout": 300,         # idle connections above min_size are closed after this
+    "max_lifetime": 3600,        # connections older than this are recycled
+    "validate_after": 5,         # "SELECT 1" on checkout if idle longer than this
+    "maintenance_interval": 30,  # how often the reaper thread runs
+    "statement_cache_size": 32,  # prepared statements kept per connection (0 = off)
+}
 
-def _get_config():
-    with open(CONFIG_PATH, encoding="utf-8") as f:
-        return json.load(f)
+# "read_pool" section: read-only snapshot connections for catalog reads (data_download)
+READ_POOL_DEFAULTS = dict(POOL_DEFAULTS, min_size=1, max_size=4)
 
-def get_connection():
-    cfg = _get_config()
-    dsn = cfg.get("dsn", "pktc")
+def _connect(dsn, reader=False):
+    cfg = get_config()
     logging.info("Attempting connection with DSN: %s", dsn)
-    conn = sqlanydb.connect(DSN=dsn)   # <-- let DSN supply credentials
-    logging.info("Database connection established!")
-    return conn
\ No newline at end of file
+    backend = get_backend(cfg)
+    conn = backend.connect(dsn)   # <-- let DSN supply credentials
+    if reader:
+        try:
+            backend.make_reader(conn)
+        except Exception:
+            conn.close()
+            raise
+    logging.info("Database connection established!" if not reader else "Read-only snapshot connection established!")
+    return conn
+
+def _begin_snapshot(raw):
+    get_backend(get_config()).begin_snapshot(raw)
+
+def _cancel(raw):
+    return get_backend(get_config()).cancel(raw)
+
+def _statement_timeout(endpoint):
+    limits = get_config().section("statement_timeouts", STATEMENT_TIMEOUT_DEFAULTS)
+    return float(limits.get(endpoint or "default", limits.get("default", 0)) or 0)
+
+def backend_available():
+    return get_backend(get_config()).available()
+
+def driver_errors():
+    return get_backend(get_config()).driver_errors()
+
+def row_hash_sql(*columns):
+    return get_backend(get_config()).row_hash(columns)
+
+# ------------------ connection pool ------------------
+class PoolTimeout(Exception):
+    """No connection became free within acquire_timeout."""
+
+# ------------------ per-connection statement cache ------------------
+class StatementStats:
+    """Hit/miss/eviction counters shared by every statement cache of one pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def bump(self, hit=0, miss=0, evicted=0):
+        with self._lock:
+            self.hits += hit
+            self.misses += miss
+            self.evictions += evicted
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+class StatementCache:
+    """LRU of cursors keyed by SQL text.
+
+    Each fixed statement keeps its own cursor, re-executed with new
+    parameters. On SQL Anywhere that cursor holds the prepared statement
+    handle (backends.sqlanywhere.PreparedCursor), so a hit skips the
+    prepare; sqlite3 keeps its own per-connection statement cache, so there
+    a hit only saves the cursor.
+    """
+
+    def __init__(self, new_cursor, size, stats):
+        self._new_cursor = new_cursor
+        self._size = size
+        self._stats = stats
+        self._cursors = OrderedDict()
+
+    def cursor_for(self, sql):
+        """The statement's cursor, or None when the cache is off"""
+        if self._size <= 0:
+            return None
+        cur = self._cursors.get(sql)
+        if cur is not None:
+            self._cursors.move_to_end(sql)
+            self._stats.bump(hit=1)
+            return cur
+        self._stats.bump(miss=1)
+        cur = self._cursors[sql] = self._new_cursor()
+        if len(self._cursors) > self._size:
+            _, old = self._cursors.popitem(last=False)
+            self._stats.bump(evicted=1)
+            try:
+                old.close()
+            except Exception:
+                pass
+        return cur
+
+    def __len__(self):
+        return len(self._cursors)
+
+    def finish(self):
+        """Close out the open statement on every instrumented cursor"""
+        for cur in self._cursors.values():
+            finish = getattr(cur, "finish", None)
+            if finish is not None:
+                finish()
+
+    def clear(self):
+        for cur in self._cursors.values():
+            try:
+                cur.close()
+            except Exception:
+                pass
+        self._cursors.clear()
+
+class PooledConnection:
+    """What get_connection() hands out: the driver connection plus per-connection state.
+
+    Anything not defined here (cursor(), commit(), autocommit, ...) goes
+    straight to the driver connection.
+    """
+
+    def __init__(self, raw, statement_cache_size=0, statement_stats=None, query_stats=None,
+                 cancel=None, timeout_for=None):
+        now = time.monotonic()
+        self.raw = raw
+        self.created = now
+        self.last_used = now
+        self.query_stats = query_stats
+        self.cancel = (lambda: cancel(raw)) if cancel is not None and timeout_for is not None else None
+        self.timeout_for = timeout_for if self.cancel is not None else None
+        self.cursors = []           # opened during the current borrow
+        self.executed = []          # the ones execute() opened (cache off)
+        self.statements = StatementCache(self._new_cursor, statement_cache_size,
+                                         statement_stats or StatementStats())
+
+    def execute(self, sql, params=()):
+        """Run a fixed statement through the statement cache and return its cursor.
+
+        The cursor belongs to the cache – read from it, don't close it, and
+        read the result before running the same SQL again on this connection.
+        """
+        cur = self.statements.cursor_for(sql)
+        if cur is None:
+            self._close_finished()
+            cur = self.cursor()
+            self.executed.append(cur)
+        cur.execute(sql, params)
+        return cur
+
+    def _close_finished(self):
+        """Without the cache every execute() opens a cursor: close the ones whose
+        statement is over (result read, or no result set) instead of keeping
+        them all until release"""
+        keep = []
+        for cur in self.executed:
+            if getattr(cur, "finished", cur.description is None):
+                self.cursors.remove(cur)
+                try:
+                    cur.close()
+                except Exception:
+                    pass
+            else:
+                keep.append(cur)
+        self.executed = keep
+
+    def _new_cursor(self):
+        cur = self.raw.cursor()
+        if self.query_stats is not None or self.timeout_for is not None:
+            cur = InstrumentedCursor(cur, self.query_stats, self.cancel, self.timeout_for)
+        return cur
+
+    def cursor(self):
+        """A cursor of the current borrow, closed when the connection is released"""
+        cur = self._new_cursor()
+        self.cursors.append(cur)
+        return cur
+
+    def close_cursors(self):
+        """Close every cursor of the current borrow and finish the cached ones;
+        for instrumented cursors that records the last statement and disarms
+        its deadline"""
+        self.statements.finish()
+        cursors, self.cursors, self.executed = self.cursors, [], []
+        for cur in cursors:
+            try:
+                cur.close()
+            except Exception:
+                pass
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.close_cursors()
+        self.statements.clear()
+        self.raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def __setattr__(self, name, value):
+        if name in ("raw", "created", "last_used", "cursors", "executed", "statements", "query_stats", "cancel",
+                    "timeout_for"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.raw, name, value)
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of DB-API connections.
+
+    Idle connections are handed out LIFO so the hot ones stay hot and the
+    cold ones age out through idle eviction.
+    """
+
+    def __init__(self, connect, min_size=2, max_size=10, acquire_timeout=10,
+                 idle_timeout=300, max_lifetime=3600, validate_after=5,
+                 maintenance_interval=30, statement_cache_size=32, query_stats=None,
+                 breaker=None, cancel=None, timeout_for=None, on_checkout=None):
+        self._connect = connect
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size), self.min_size)
+        self.acquire_timeout = float(acquire_timeout)
+        self.idle_timeout = float(idle_timeout)
+        self.max_lifetime = float(max_lifetime)
+        self.validate_after = float(validate_after)
+        self.maintenance_interval = float(maintenance_interval)
+        self.statement_cache_size = max(0, int(statement_cache_size))
+        self.statement_stats = StatementStats()
+        self.query_stats = query_stats
+        self.breaker = breaker
+        self._cancel = cancel
+        self._timeout_for = timeout_for
+        self.on_checkout = on_checkout      # e.g. start a read snapshot
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._in_use = 0
+        self._opening = 0
+        self._waiting = 0
+        self._closed = False
+        self._reaper = None
+        self._started = time.monotonic()
+
+        # statistics
+        self._acquired = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._connects = 0
+        self._connect_failures = 0
+        self._recycled = 0
+        self._evicted_idle = 0
+        self._failed_validations = 0
+        self._recent_connects = deque()   # monotonic stamps, last 60 s
+
+    # ---------- open / close ----------
+    def _open(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._connect_failures += 1
+            raise
+        now = time.monotonic()
+        with self._cond:
+            self._connects += 1
+            self._recent_connects.append(now)
+        return PooledConnection(conn, self.statement_cache_size, self.statement_stats, self.query_stats,
+                                self._cancel, self._timeout_for)
+
+    @staticmethod
+    def _close(pc):
+        try:
+            pc.close()
+        except Exception:
+            pass
+
+    def _expired(self, pc, now):
+        return self.max_lifetime > 0 and now - pc.created > self.max_lifetime
+
+    @staticmethod
+    def _is_alive(pc):
+        try:
+            cur = pc.raw.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    # ---------- checkout / return ----------
+    def acquire(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+        pc = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    pc = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use + len(self._idle) + self._opening < self.max_size:
+                    self._opening += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"No database connection free after {timeout:.1f}s "
+                                      f"({self._in_use}/{self.max_size} in use)")
+                if not waited:
+                    waited = True
+                    self._waits += 1
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._acquired += 1
+            if waited:
+                wait = time.monotonic() - started
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+        self._ensure_reaper()
+
+        if pc is None:
+            try:
+                pc = self._open()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+                    if pc is None:
+                        self._cond.notify()
+                    else:
+                        self._in_use += 1
+            return pc
+
+        now = time.monotonic()
+        stale = False
+        if self._expired(pc, now):
+            with self._cond:
+                self._recycled += 1
+            stale = True
+        elif self.validate_after >= 0 and now - pc.last_used > self.validate_after and not self._is_alive(pc):
+            with self._cond:
+                self._failed_validations += 1
+            logging.warning("Pooled connection failed validation – replacing it")
+            stale = True
+
+        if stale:
+            self._close(pc)
+            try:
+                pc = self._open()
+            except Exception:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        return pc
+
+    def release(self, pc, discard=False):
+        pc.close_cursors()
+        if not discard:
+            try:
+                pc.raw.rollback()       # never leak a half-done transaction to the next borrower
+            except Exception:
+                discard = True
+        now = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed or self._expired(pc, now):
+                if not discard and not self._closed:
+                    self._recycled += 1
+                keep = False
+            else:
+                pc.last_used = now
+                self._idle.append(pc)
+                keep = True
+            self._cond.notify()
+        if not keep:
+            self._close(pc)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        breaker = self.breaker
+        if breaker is not None:
+            breaker.before_call()           # CircuitOpen while the database is down
+        try:
+            pc = self.acquire(timeout)
+        except PoolTimeout:
+            if breaker is not None:
+                breaker.release_probe()     # busy, not down
+            raise
+        except Exception as e:
+            if breaker is not None:
+                breaker.record_failure(e)
+            raise
+        try:
+            if self.on_checkout is not None:
+                self.on_checkout(pc.raw)
+            yield pc
+        except BaseException as e:
+            broken = isinstance(e, Exception) and not self._is_alive(pc)
+            if breaker is not None:
+                if broken and not isinstance(e, StatementTimeout):
+                    breaker.record_failure(e)
+                else:
+                    breaker.record_success()
+            self.release(pc, discard=broken)
+            raise
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            self.release(pc)
+
+    def ping(self):
+        """Heartbeat probe: SELECT 1 on a pooled connection, bypassing the breaker.
+
+        Returns True/False, or None when the pool is too busy to tell.
+        """
+        try:
+            pc = self.acquire()
+        except PoolTimeout:
+            return None
+        except Exception as e:
+            if self.breaker is not None:
+                self.breaker.record_failure(e)
+            return False
+        ok = self._is_alive(pc)
+        self.release(pc, discard=not ok)
+        if self.breaker is not None:
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure("heartbeat SELECT 1 failed")
+        return ok
+
+    # ---------- warm-up / maintenance ----------
+    def warm(self):
+        """Open connections until min_size are available."""
+        opened = 0
+        while True:
+            with self._cond:
+                if self._closed or self._in_use + len(self._idle) + self._opening >= self.min_size:
+                    break
+                self._opening += 1
+            pc = None
+            try:
+                pc = self._open()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+                    if pc is not None:
+                        self._idle.appendleft(pc)
+                    self._cond.notify()
+            opened += 1
+        self._ensure_reaper()
+        return opened
+
+    def maintain(self):
+        now = time.monotonic()
+        doomed = []
+        with self._cond:
+            keep = deque()
+            total = self._in_use + len(self._idle)
+            # oldest-used connections sit on the left
+            for pc in self._idle:
+                if self._expired(pc, now):
+                    doomed.append(pc)
+                    self._recycled += 1
+                    total -= 1
+                elif (self.idle_timeout > 0 and now - pc.last_used > self.idle_timeout
+                      and total > self.min_size):
+                    doomed.append(pc)
+                    self._evicted_idle += 1
+                    total -= 1
+                else:
+                    keep.append(pc)
+            self._idle = keep
+            while self._recent_connects and now - self._recent_connects[0] > 60:
+                self._recent_connects.popleft()
+        for pc in doomed:
+            self._close(pc)
+        try:
+            self.warm()
+        except Exception as e:
+            logging.warning("Pool refill failed: %s", e)
+
+    def _ensure_reaper(self):
+        if self._reaper is not None or self.maintenance_interval <= 0:
+            return
+        with self._cond:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_loop, name="sql-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.maintenance_interval)
+            if self._closed:
+                return
+            try:
+                self.maintain()
+            except Exception as e:
+                logging.warning("Pool maintenance error: %s", e)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._cond.notify_all()
+        for pc in idle:
+            self._close(pc)
+
+    # ---------- statistics ----------
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            while self._recent_connects and now - self._recent_connects[0] > 60:
+                self._recent_connects.popleft()
+            window = min(60.0, max(now - self._started, 1.0))
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "opening": self._opening,
+                "waiting": self._waiting,
+                "acquired": self._acquired,
+                "waits": self._waits,
+                "wait_time_total_ms": round(self._wait_total * 1000, 1),
+                "wait_time_avg_ms": round(self._wait_total * 1000 / self._waits, 1) if self._waits else 0.0,
+                "wait_time_max_ms": round(self._wait_max * 1000, 1),
+                "timeouts": self._timeouts,
+                "connects": self._connects,
+                "connect_failures": self._connect_failures,
+                "connects_per_sec": round(len(self._recent_connects) / window, 3),
+                "recycled": self._recycled,
+                "evicted_idle": self._evicted_idle,
+                "failed_validations": self._failed_validations,
+                "statement_cache": dict(self.statement_stats.as_dict(), size=self.statement_cache_size),
+            }
+
+# ------------------ per-store pools ------------------
+class UnknownStore(KeyError):
+    """The store named in a request/token is not configured."""
+
+def _pool_options(cfg, store, section, defaults):
+    # keys the pool doesn't know (retired settings, typos) are ignored
+    return {k: v for k, v in cfg.store_section(store, section, defaults).items() if k in defaults}
+
+class StorePools:
+    """Write pool, read-only pool, breaker and statistics for one store (DSN)"""
+
+    def __init__(self, name):
+        cfg = get_config()
+        self.name = name
+        instr = cfg.section("instrumentation", INSTRUMENTATION_DEFAULTS)
+        self.query_stats = instrumentation.configure(instr) if instr["enabled"] else None
+        self.breaker = CircuitBreaker(**cfg.store_section(name, "breaker", BREAKER_DEFAULTS))
+        # DSN is looked up per connect, so an edited config.json applies to new connections
+        self.pool = ConnectionPool(lambda: _connect(self.dsn), query_stats=self.query_stats,
+                                   breaker=self.breaker, cancel=_cancel, timeout_for=_statement_timeout,
+                                   **_pool_options(cfg, name, "pool", POOL_DEFAULTS))
+        self.read_pool = ConnectionPool(lambda: _connect(self.dsn, reader=True),
+                                        query_stats=self.query_stats, breaker=self.breaker,
+                                        cancel=_cancel, timeout_for=_statement_timeout,
+                                        on_checkout=_begin_snapshot,
+                                        **_pool_options(cfg, name, "read_pool", READ_POOL_DEFAULTS))
+
+    @property
+    def dsn(self):
+        return get_store_dsn(self.name)
+
+    def warm(self):
+        return self.pool.warm(), self.read_pool.warm()
+
+def get_store_dsn(name=None):
+    cfg = get_config()
+    name = name or cfg.default_store
+    if name not in cfg.stores:
+        raise UnknownStore(name)
+    return cfg.stores[name]["dsn"]
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(name=None):
+    """Pools of store ``name`` (default store if None), created on first use"""
+    cfg = get_config()
+    name = name or cfg.default_store
+    pools = _stores.get(name)
+    if pools is None:
+        if name not in cfg.stores:
+            raise UnknownStore(name)
+        with _stores_lock:
+            pools = _stores.get(name)
+            if pools is None:
+                pools = _stores[name] = StorePools(name)
+    return pools
+
+def store_names():
+    return list(get_config().stores)
+
+def get_pool(store=None):
+    return get_store(store).pool
+
+def get_read_pool(store=None):
+    """Read-only snapshot pool; shares the breaker and statistics of the store's main pool"""
+    return get_store(store).read_pool
+
+@contextmanager
+def get_connection(timeout=None, store=None):
+    """Borrow a pooled connection: ``with get_connection(store=...) as conn: ...``"""
+    with get_pool(store).connection(timeout) as conn:
+        yield conn
+
+@contextmanager
+def get_read_connection(timeout=None, store=None):
+    """Borrow a read-only connection; every statement in the block sees one snapshot"""
+    with get_read_pool(store).connection(timeout) as conn:
+        yield conn
+
+def warm_pool(background=True):
+    def _warm():
+        for name in store_names():
+            try:
+                opened, opened_readers = get_store(name).warm()
+                logging.info("Connection pool for %s warmed (%s opened, %s read-only)",
+                             name, opened, opened_readers)
+            except Exception as e:
+                logging.warning("Connection pool warm-up for %s failed: %s", name, e)
+    if background:
+        threading.Thread(target=_warm, name="sql-pool-warm", daemon=True).start()
+    else:
+        _warm()
+
+def ping(store=None):
+    return get_pool(store).ping()
+
+def probe(store=None):
+    """SELECT 1 on a fresh connection that is closed right after, outside any pool.
+
+    For processes that only watch the database (the service runner); the
+    Django process has its own pooled heartbeat. Returns None or the error.
+    """
+    try:
+        conn = _connect(get_store_dsn(store))
+    except Exception as e:
+        return e
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        cur.close()
+        return None
+    except Exception as e:
+        return e
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def start_heartbeat():
+    """DB heartbeat thread for this process; it also probes each store's breaker while open"""
+    opts = get_config().section("breaker", BREAKER_DEFAULTS)
+    interval = float(opts["heartbeat_interval"])
+    if interval <= 0:
+        return None
+
+    def _beat():
+        while True:
+            wait = interval
+            for name in store_names():
+                pool = get_pool(name)
+                ok = pool.ping()
+                if ok is False:
+                    # probe sooner while a breaker is open so recovery is noticed quickly
+                    wait = min(wait, pool.breaker.reset_timeout)
+                    logging.warning("💔 DB heartbeat failed for %s: %s", name, pool.breaker.stats()["last_error"])
+            time.sleep(wait)
+
+    thread = threading.Thread(target=_beat, name="sql-heartbeat", daemon=True)
+    thread.start()
+    return thread
+
+def pool_stats(store=None):
+    pools = get_store(store)
+    return dict(pools.pool.stats(), store=pools.name, breaker=pools.breaker.stats(),
+                read_pool=pools.read_pool.stats())
+
+def query_stats(recent=False, store=None):
+    pools = get_store(store)
+    if pools.query_stats is None:
+        out = {"enabled": False, "queries": []}
+    else:
+        out = dict(pools.query_stats.snapshot(recent), enabled=True)
+    out["store"] = pools.name
+    out["statement_timeouts"] = watchdog.stats()
+    return out
+
+# ------------------ background prefetch ------------------
+class PrefetchCursor:
+    """Runs one query on its own pooled connection in a background thread.
+
+    Batches are handed over through a bounded queue, so a second query is
+    fetched while the caller is still busy with the first. Behaves like a
+    cursor for ``description`` and ``fetchmany()``; close() when done.
+    """
+
+    _DONE = object()
+
+    def __init__(self, borrowed, conn, sql, params, batch_size, depth, ctx):
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._ready = threading.Event()
+        self._stop = False
+        self._exhausted = False
+        self._error = None
+        self._description = None
+        self._thread = threading.Thread(target=self._run, name="sql-prefetch", daemon=True,
+                                        args=(borrowed, conn, sql, params, batch_size, ctx))
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop:
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, borrowed, conn, sql, params, batch_size, ctx):
+        error = None
+        with instrumentation.bound_context(ctx):
+            try:
+                cur = conn.execute(sql, params)
+                self._description = cur.description
+                self._ready.set()
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not self._put(rows) or not rows:
+                        break
+            except Exception as e:
+                error = e
+            try:
+                # hands the connection back (and tells the breaker) like a with-block would
+                if error is None:
+                    borrowed.__exit__(None, None, None)
+                else:
+                    borrowed.__exit__(type(error), error, error.__traceback__)
+            except Exception:
+                pass
+        if error is not None:
+            self._error = error
+            self._ready.set()
+            self._put(self._DONE)
+
+    @property
+    def description(self):
+        self._ready.wait()
+        if self._description is None and self._error is not None:
+            raise self._error
+        return self._description
+
+    def fetchmany(self, size=None):
+        if self._exhausted:
+            return []
+        rows = self._queue.get()
+        if rows is self._DONE:
+            self._exhausted = True
+            raise self._error
+        if not rows:
+            self._exhausted = True
+        return rows
+
+    def close(self):
+        self._stop = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+def prefetch(sql, params=(), store=None, batch_size=None, depth=8, wait=0):
+    """Start ``sql`` on a second read-only connection of ``store``.
+
+    Returns a PrefetchCursor, or None if no connection is free within
+    ``wait`` seconds (the caller then runs the query itself, sequentially).
+    """
+    borrowed = get_read_pool(store).connection(wait)
+    try:
+        conn = borrowed.__enter__()
+    except PoolTimeout:
+        return None
+    return PrefetchCursor(borrowed, conn, sql, params, batch_size or FETCH_BATCH_SIZE, depth,
+                          instrumentation.request_context())
+
+# ------------------ columnar fetch ------------------
+FETCH_BATCH_SIZE = 5000
+
+# column kinds: "f" float64 (NULL -> NaN), "i" int64 (NULL not allowed),
+# "s" interned str (NULL kept as None), "o" any Python object
+_NUMERIC = (int, float, Decimal)
+
+def _infer_kind(value):
+    if isinstance(value, bool) or not isinstance(value, _NUMERIC):
+        return "s" if isinstance(value, str) or value is None else "o"
+    return "f"
+
+class ColumnarResult:
+    """A result set stored column by column.
+
+    Numeric columns are ``array('d')``/``array('q')`` (or NumPy arrays, sharing
+    the same buffer), text columns are lists of interned strings, so 150k rows
+    cost a few MB instead of 150k tuples plus their boxed values.
+    """
+
+    def __init__(self, columns, kinds, data, length):
+        self.columns = columns
+        self.kinds = kinds
+        self.data = data
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def rows(self):
+        """Iterate rows as tuples again (NaN -> None for float columns)"""
+        cols = []
+        for name in self.columns:
+            col = self.data[name]
+            if self.kinds[name] == "f":
+                col = [None if math.isnan(v) else v for v in col]
+            elif np is not None and isinstance(col, np.ndarray):
+                col = col.tolist()
+            cols.append(col)
+        return zip(*cols)
+
+    def select(self, columns):
+        """The same rows with only ``columns`` (no copy of the data)"""
+        columns = list(columns)
+        return ColumnarResult(columns, {c: self.kinds[c] for c in columns},
+                              {c: self.data[c] for c in columns}, self.length)
+
+    def nbytes(self):
+        """Approximate memory held by the columns (strings are shared, counted once)"""
+        total, seen = 0, set()
+        for name in self.columns:
+            col = self.data[name]
+            if isinstance(col, array):
+                total += col.itemsize * len(col)
+            elif np is not None and isinstance(col, np.ndarray):
+                total += col.nbytes
+            else:
+                total += sys.getsizeof(col)
+                for v in col:
+                    if id(v) not in seen:
+                        seen.add(id(v))
+                        total += sys.getsizeof(v)
+        return total
+
+def fetch_columnar(cursor, kinds=None, batch_size=FETCH_BATCH_SIZE, numpy=False):
+    """Drain an executed cursor in fetchmany batches into a ColumnarResult.
+
+    ``kinds`` maps column name -> "f"/"i"/"s"/"o"; unnamed columns are inferred
+    from the first non-NULL value. ``numpy=True`` turns numeric columns into
+    ndarrays (falls back to arrays when NumPy is not installed).
+    """
+    columns = [d[0] for d in cursor.description]
+    kinds = dict(kinds or {})
+    data = {}
+    length = 0
+    intern = sys.intern
+    nan = float("nan")
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for idx, name in enumerate(columns):
+            values = [r[idx] for r in batch]
+            kind = kinds.get(name)
+            if kind is None:
+                first = next((v for v in values if v is not None), None)
+                if first is None:
+                    # all NULL so far: pad and decide on a later batch
+                    data.setdefault(name, [None] * length).extend(values)
+                    continue
+                kind = kinds[name] = _infer_kind(first)
+                pending = data.pop(name, [])
+                data[name] = array("d", [nan] * len(pending)) if kind == "f" else pending
+            col = data.get(name)
+            if col is None:
+                col = data[name] = array("d") if kind == "f" else array("q") if kind == "i" else []
+            if kind == "f":
+                col.extend(nan if v is None else float(v) for v in values)
+            elif kind == "i":
+                col.extend(int(v) for v in values)
+            elif kind == "s":
+                col.extend(None if v is None else intern(str(v)) for v in values)
+            else:
+                col.extend(values)
+        length += len(batch)
+    for name in columns:
+        kinds.setdefault(name, "o")
+        col = data.get(name)
+        if col is None:
+            col = data[name] = array("d") if kinds[name] == "f" else array("q") if kinds[name] == "i" else []
+        if numpy and np is not None and isinstance(col, array):
+            data[name] = np.frombuffer(col, dtype=np.float64 if kinds[name] == "f" else np.int64)
+    return ColumnarResult(columns, kinds, data, length)
@@ -1,3 +1,911 @@
-from django.test import TestCase
+"""
+Behaviour tests against the SQLite stand-in backend (sync/backends/sqlite.py).
 
-# Create your tests here.
+Each test class seeds its own database in a temporary directory and points
+the app at it with a config.json of its own, so no SQL Anywhere server (and
+no Django database) is needed.
+"""
+
+import os
+import json
+import zlib
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from django.test import Client, SimpleTestCase
+
+from decimal import Decimal
+
+from . import changelog, compression, config, delta, instrumentation, serializers, sql_helper, views
+from .breaker import CircuitBreaker, CircuitOpen
+from .singleflight import SingleFlight
+from .snapshot import CATALOG_CACHE_DEFAULTS, SnapshotCache
+from .backends.sqlite import SQLiteBackend, seed
+from .watchdog import StatementTimeout, watchdog
+
+def _close_stores():
+    for pools in list(sql_helper._stores.values()):
+        pools.pool.close()
+        pools.read_pool.close()
+    sql_helper._stores.clear()
+
+class CatalogTestCase(SimpleTestCase):
+    """A seeded store "pktc" on the sqlite backend; ``settings`` are config.json overrides"""
+    products, batches, masters = 60, 2, 5
+    settings = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.dir = tempfile.mkdtemp()
+        raw = {
+            "dsn": "pktc",
+            "backend": "sqlite",
+            "sqlite": {"dir": cls.dir},
+            "pool": {"min_size": 0, "max_size": 4},
+            "read_pool": {"min_size": 0, "max_size": 4},
+            "instrumentation": {"enabled": False},
+            "download": {"batch_size": 7},
+            "catalog_cache": {"enabled": False},
+            "catalog_file": {"dir": os.path.join(cls.dir, "catalog")},
+            "delta_sync": {"registry": os.path.join(cls.dir, "device_versions.json")},
+        }
+        for name, value in cls.settings.items():
+            raw[name] = dict(raw.get(name, {}), **value) if isinstance(value, dict) else value
+        path = os.path.join(cls.dir, "config.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(raw, f)
+        cls._config = mock.patch.dict(config._caches, {os.path.abspath(config.CONFIG_PATH): config.ConfigCache(path)})
+        cls._config.start()
+        _close_stores()
+        cls.reseed()
+
+    @classmethod
+    def tearDownClass(cls):
+        _close_stores()
+        views.catalog_files._current.clear()
+        views.catalog_cache.invalidate()
+        views._super_codes.clear()
+        views.catalog_deltas._catalogs.clear()
+        views.catalog_deltas._registry = None
+        cls._config.stop()
+        shutil.rmtree(cls.dir, ignore_errors=True)
+        super().tearDownClass()
+
+    @classmethod
+    def connect(cls):
+        """A writer connection of its own, outside the pools"""
+        return SQLiteBackend({"dir": cls.dir}).connect("pktc")
+
+    @classmethod
+    def execute(cls, *statements):
+        """Run and commit ``statements`` (SQL or (SQL, params)) on a writer connection"""
+        conn = cls.connect()
+        try:
+            for statement in statements:
+                sql, params = (statement, ()) if isinstance(statement, str) else statement
+                conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    @classmethod
+    def reseed(cls):
+        conn = cls.connect()
+        seed(conn, cls.products, cls.batches, cls.masters)
+        conn.close()
+
+    def setUp(self):
+        patcher = mock.patch.object(views, "JWT_SECRET", "test-secret")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = Client()
+        token = self.client.post("/login", json.dumps({"userid": "dba", "password": "sql"}),
+                                 content_type="application/json").json()["token"]
+        self.auth = {"HTTP_AUTHORIZATION": "Bearer " + token}
+
+    def get(self, path, **headers):
+        return self.client.get(path, **dict(self.auth, **headers))
+
+    def get_json(self, path, **headers):
+        response = self.get(path, **headers)
+        self.assertEqual(response.status_code, 200, response)
+        return json.loads(response.getvalue() if response.streaming else response.content)
+
+def _grouped(rows):
+    """format=rows products regrouped into the format=nested shape"""
+    products = {}
+    for row in rows:
+        product = products.setdefault(row["code"], {"code": row["code"], "name": row["name"], "batches": []})
+        if row["barcode"] is not None:
+            product["batches"].append([row["barcode"], row["quantity"], row["salesprice"],
+                                       row["bmrp"], row["cost"]])
+    return sorted(products.values(), key=lambda p: p["code"])
+
+class MergeBatchesTests(SimpleTestCase):
+
+    def test_batches_follow_their_product(self):
+        products = iter([("A", "a"), ("B", "b"), ("C", "c")])
+        batches = iter([("A", "a1", 1), ("A", "a2", 2), ("C", "c1", 3)])
+        merged = list(views._merge_batches(products, batches, ("code", "name")))
+        self.assertEqual([p["batches"] for p in merged], [[["a1", 1], ["a2", 2]], [], [["c1", 3]]])
+
+    def test_no_batch_columns(self):
+        merged = list(views._merge_batches(iter([("A", "a")]), None, ("code", "name")))
+        self.assertEqual(merged, [{"code": "A", "name": "a"}])
+
+class NestedDownloadTests(CatalogTestCase):
+
+    def test_nested_matches_rows(self):
+        rows = self.get_json("/data-download?stream=0")
+        nested = self.get_json("/data-download?stream=0&format=nested")
+        self.assertEqual(nested["product_data"], _grouped(rows["product_data"]))
+        self.assertEqual(nested["master_data"], rows["master_data"])
+
+    def test_orphan_batch_is_left_out(self):
+        self.execute("INSERT INTO acc_productbatch (productcode, barcode, quantity, salesprice, bmrp, cost) "
+                     "VALUES ('P0000002Z', 'orphan', 1, 1, 1, 1)")
+        self.addCleanup(self.execute, "DELETE FROM acc_productbatch WHERE barcode = 'orphan'")
+        rows = self.get_json("/data-download?stream=0")
+        nested = self.get_json("/data-download?stream=0&format=nested")
+        self.assertEqual(nested["product_data"], _grouped(rows["product_data"]))
+
+    def test_product_added_between_scans(self):
+        """Heads and batches are read in one snapshot: a product (and batch) written
+        after the heads scan started is in neither, instead of an orphan batch that
+        would stall the merge and strip every later product of its batches"""
+        before = self.get_json("/data-download?stream=0&format=nested")["product_data"]
+        execute = sql_helper.PooledConnection.execute
+        written = threading.Event()
+        self.addCleanup(self.execute, "DELETE FROM acc_product WHERE code = 'P0000003A'",
+                        "DELETE FROM acc_productbatch WHERE barcode = 'late'")
+
+        def write_after_heads(conn, sql, params=()):
+            if "JOIN acc_productbatch" in sql:
+                written.wait(5)
+            cur = execute(conn, sql, params)
+            if "FROM acc_product p ORDER BY" in sql and not written.is_set():
+                self.execute("INSERT INTO acc_product (code, name) VALUES ('P0000003A', 'Late')",
+                             "INSERT INTO acc_productbatch (productcode, barcode, quantity, salesprice, bmrp, cost) "
+                             "VALUES ('P0000003A', 'late', 1, 1, 1, 1)")
+                written.set()
+            return cur
+
+        with mock.patch.object(sql_helper.PooledConnection, "execute", write_after_heads):
+            during = self.get_json("/data-download?stream=0&format=nested")["product_data"]
+        self.assertTrue(written.is_set())
+        self.assertEqual(during, before)
+
+class ChangelogTests(CatalogTestCase):
+    settings = {"changelog": {"keep_entries": 1}}
+
+    def tearDown(self):
+        changelog.uninstall()
+        self.execute("DROP TABLE IF EXISTS sync_changelog")
+
+    def test_install_and_follow(self):
+        self.assertIsNone(changelog.installed())
+        changelog.install()
+        self.assertEqual(changelog.installed(), 0)
+        seen = []
+        feed = changelog.ChangelogFeed(lambda store, codes: seen.append((store, codes)))
+        self.assertEqual(feed.poll("pktc"), 0)
+        self.execute("UPDATE acc_product SET name = 'Renamed' WHERE code = 'P0000001'",
+                     "UPDATE acc_master SET place = 'Moved' WHERE code = 'S00001'")
+        self.assertEqual(feed.poll("pktc"), 2)
+        self.assertEqual(seen, [("pktc", {"products": {"P0000001"}, "masters": {"S00001"}})])
+        self.assertEqual(feed.stats()["purged"], 1)
+
+    def test_uninstall_keeps_the_table(self):
+        changelog.install()
+        changelog.uninstall()
+        self.execute("UPDATE acc_product SET name = 'Renamed' WHERE code = 'P0000001'")
+        self.assertEqual(changelog.installed(), 0)
+
+    def test_installed_raises_other_errors(self):
+        changelog.install()
+        locked = sqlite3.OperationalError("database is locked")
+        with mock.patch.object(sql_helper.PooledConnection, "execute", side_effect=locked):
+            with self.assertRaises(sqlite3.OperationalError):
+                changelog.installed()
+
+class DeltaSyncTests(CatalogTestCase):
+    settings = {"delta_sync": {"refresh_interval": 0}}
+
+    def test_changes_since_a_version(self):
+        full = self.get_json("/data-download?since=0", HTTP_X_DEVICE_ID="tab-1")
+        self.assertEqual(full["mode"], "full")
+        self.addCleanup(self.reseed)
+        self.addCleanup(self.execute, "DELETE FROM acc_product WHERE code = 'P9999999'")
+        repriced, emptied = sorted({r["code"] for r in full["product_data"] if r["barcode"]})[:2]
+        self.execute(("UPDATE acc_productbatch SET salesprice = 12.5 WHERE productcode = ?", (repriced,)),
+                     ("DELETE FROM acc_productbatch WHERE productcode = ?", (emptied,)),
+                     "INSERT INTO acc_product (code, name) VALUES ('P9999999', 'New')")
+        changed = self.get_json(f"/data-download?since={full['version']}", HTTP_X_DEVICE_ID="tab-1")
+        self.assertEqual(changed["mode"], "delta")
+        self.assertEqual(changed["version"], full["version"] + 1)
+        products = changed["product_data"]
+        # a product without batches is one LEFT JOIN row with a NULL barcode
+        self.assertEqual(sorted((r["code"], r["barcode"]) for r in products["inserted"]),
+                         [(emptied, None), ("P9999999", None)])
+        self.assertTrue(products["updated"])
+        self.assertTrue(all(r["code"] == repriced and r["salesprice"] == 12.5 for r in products["updated"]))
+        self.assertTrue(products["deleted"])
+        self.assertTrue(all(r["code"] == emptied for r in products["deleted"]))
+        self.assertEqual(changed["master_data"], {"inserted": [], "updated": [], "deleted": []})
+
+    def test_format_with_since(self):
+        self.assertEqual(self.get_json("/data-download?since=0&format=rows")["mode"], "full")
+        for fmt in ("nested", "columnar"):
+            with self.subTest(format=fmt):
+                self.assertEqual(self.get(f"/data-download?since=0&format={fmt}").status_code, 400)
+
+    def test_unknown_version_gets_the_full_catalog(self):
+        payload = self.get_json("/data-download?since=999999")
+        self.assertEqual(payload["mode"], "full")
+        self.assertEqual(len(payload["master_data"]), self.masters)
+
+    def test_version_headers(self):
+        """X-Catalog-Version is only ever a version since= accepts"""
+        response = self.get("/data-download?since=0")
+        self.assertEqual(response["X-Catalog-Version"], str(json.loads(response.content)["version"]))
+        response = self.get("/data-download/sqlite")
+        self.assertNotIn("X-Catalog-Version", response)
+        self.assertTrue(response["X-Catalog-File-Version"].isdigit())
+        b"".join(response.streaming_content)
+
+def _device_hashes(rows, n):
+    """Bucket hashes computed the way the README tells devices to"""
+    sums = [0] * n
+    for row in rows:
+        values = [row[k] for k in ("code", "name", "barcode", "quantity", "salesprice", "bmrp", "cost")]
+        values = [v if not isinstance(v, (int, float)) else int(v) if float(v).is_integer() else float(v)
+                  for v in values]
+        encoded = json.dumps(values, separators=(",", ":"), ensure_ascii=False).encode()
+        b = zlib.crc32(row["code"].encode()) % n
+        sums[b] = (sums[b] + int.from_bytes(hashlib.sha256(encoded).digest()[:8], "big")) % 2 ** 64
+    return [f"{h:016x}" for h in sums]
+
+class ReconcileTests(CatalogTestCase):
+    settings = {"delta_sync": {"refresh_interval": 0}, "reconcile": {"buckets": 16}}
+
+    def test_row_hash_canonical_numbers(self):
+        self.assertEqual(delta.row_hash(["P1", Decimal("12.50"), Decimal("3.00")]),
+                         delta.row_hash(["P1", 12.5, 3]))
+        self.assertEqual(delta.row_hash(["P1", 3.0, None]), delta.row_hash(["P1", 3, None]))
+        self.assertNotEqual(delta.row_hash(["P1", 12.5]), delta.row_hash(["P1", "12.5"]))
+
+    def test_device_hashes_match(self):
+        rows = self.get_json("/data-download?stream=0")["product_data"]
+        server = self.get_json("/data-download/reconcile")
+        self.assertEqual(server["hashes"], _device_hashes(rows, 16))
+        self.assertEqual(server["root"], delta.root_hash(server["hashes"]))
+
+    def test_only_differing_buckets_are_sent(self):
+        rows = self.get_json("/data-download?stream=0")["product_data"]
+        self.addCleanup(self.reseed)
+        self.execute("UPDATE acc_productbatch SET quantity = quantity + 1 WHERE productcode = 'P0000004'",
+                     "UPDATE acc_productbatch SET salesprice = 20 WHERE productcode = 'P0000005'")
+        reply = self.client.post("/data-download/reconcile", json.dumps({"hashes": _device_hashes(rows, 16)}),
+                                 content_type="application/json", **self.auth).json()
+        buckets = {zlib.crc32(code.encode()) % 16 for code in ("P0000004", "P0000005")}
+        self.assertEqual(set(reply["differing"]), buckets)
+        kept = [r for r in rows if zlib.crc32(r["code"].encode()) % 16 not in buckets]
+        self.assertEqual(_device_hashes(kept + reply["product_data"], 16),
+                         self.get_json("/data-download/reconcile")["hashes"])
+
+class SuperCodeTests(CatalogTestCase):
+    """The full-catalog paths (SQLite file, deltas) send download.super_code's masters"""
+    settings = {"download": {"super_code": "OTHER"}, "delta_sync": {"refresh_interval": 0}}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.execute("INSERT INTO acc_master (code, name, place, super_code) VALUES ('X1', 'Other 1', 'Here', 'OTHER')")
+
+    def test_catalog_file(self):
+        response = self.get("/data-download/sqlite")
+        self.assertEqual(response.status_code, 200)
+        path = os.path.join(self.dir, "download.sqlite3")
+        with open(path, "wb") as f:
+            f.writelines(response.streaming_content)
+        conn = sqlite3.connect(path)
+        try:
+            self.assertEqual(conn.execute("SELECT code FROM masters").fetchall(), [("X1",)])
+        finally:
+            conn.close()
+
+    def test_known_super_code(self):
+        masters = self.get_json("/data-download/masters?super_code=SUNCR&stream=0")["master_data"]
+        self.assertEqual(len(masters), self.masters)
+
+    def test_unknown_super_code(self):
+        response = self.get("/data-download/masters?super_code=NOPE")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Unknown super_code", response.json()["detail"])
+
+    def test_deltas(self):
+        full = self.get_json("/data-download?since=0")
+        self.assertEqual([m["code"] for m in full["master_data"]], ["X1"])
+        self.addCleanup(self.execute, "UPDATE acc_master SET place = 'Here' WHERE code = 'X1'")
+        self.execute("UPDATE acc_master SET place = 'There' WHERE code = 'X1'")
+        self.assertTrue(views.catalog_deltas.apply("pktc", {"masters": {"X1", "S00001"}}))
+        changed = self.get_json(f"/data-download?since={full['version']}")
+        self.assertEqual(changed["master_data"]["updated"], [{"code": "X1", "name": "Other 1", "place": "There"}])
+        self.assertEqual(changed["master_data"]["inserted"], [])
+
+class SelectionTests(CatalogTestCase):
+    """?fields= and ?in_stock= are part of the SQL, not a filter over the full rows"""
+
+    def test_fields(self):
+        data = self.get_json("/data-download?stream=0&fields=code,quantity,place")
+        self.assertEqual(set(data["master_data"][0]), {"code", "place"})
+        self.assertEqual(set(data["product_data"][0]), {"code", "quantity"})
+        full = self.get_json("/data-download?stream=0")
+        self.assertEqual(data["product_data"],
+                         [{"code": r["code"], "quantity": r["quantity"]} for r in full["product_data"]])
+
+    def test_in_stock(self):
+        self.addCleanup(self.reseed)
+        self.execute("UPDATE acc_productbatch SET quantity = 0 WHERE productcode < 'P0000010'")
+        full = self.get_json("/data-download/products?stream=0")["product_data"]
+        rows = self.get_json("/data-download/products?stream=0&in_stock=1")["product_data"]
+        self.assertEqual(rows, [r for r in full if r["quantity"]])
+        heads = self.get_json("/data-download/products?stream=0&in_stock=true&fields=code,name")["product_data"]
+        self.assertEqual([h["code"] for h in heads], sorted({r["code"] for r in rows}))
+        with mock.patch.object(sql_helper.PooledConnection, "execute", autospec=True,
+                               side_effect=sql_helper.PooledConnection.execute) as execute:
+            self.get_json("/data-download/products?stream=0&in_stock=1&fields=code")
+        self.assertTrue(any("quantity > 0" in call.args[1] for call in execute.call_args_list))
+
+    def test_bad_selection(self):
+        for query in ("fields=code,colour", "fields=,", "in_stock=maybe", "fields=place"):
+            with self.subTest(query=query):
+                response = self.get("/data-download/products?" + query)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("detail", response.json())
+
+class ETagTests(CatalogTestCase):
+    settings = {"catalog_cache": {"enabled": True},
+                "compression": {"enabled": True, "min_size": 1024, "encodings": ["gzip", "deflate"]}}
+
+    def setUp(self):
+        super().setUp()
+        views.catalog_cache.invalidate()
+
+    def test_not_modified(self):
+        first = self.get("/data-download?stream=0")
+        etag = first["ETag"]
+        response = self.get("/data-download", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+        # a variant ETag revalidates the same body
+        gzip_etag = self.get("/data-download", HTTP_ACCEPT_ENCODING="gzip")["ETag"]
+        self.assertEqual(self.get("/data-download", HTTP_IF_NONE_MATCH=gzip_etag).status_code, 304)
+        self.assertEqual(self.get("/data-download", HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        self.assertGreaterEqual(views.catalog_cache.stats()["not_modified"], 2)
+
+    def test_version_moves_with_the_data(self):
+        first = self.get("/data-download?stream=0")
+        views.catalog_cache.invalidate(store="pktc")
+        # a rebuild of the same bytes keeps the ETag, so devices still get their 304
+        self.assertEqual(self.get("/data-download", HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+        self.addCleanup(self.execute, "UPDATE acc_master SET place = 'Place 0' WHERE code = 'S00000'")
+        self.execute("UPDATE acc_master SET place = 'Moved' WHERE code = 'S00000'")
+        views.catalog_cache.invalidate(store="pktc")
+        changed = self.get("/data-download?stream=0")
+        self.assertNotEqual(changed["ETag"], first["ETag"])
+        self.assertGreater(int(changed["X-Snapshot-Version"]), int(first["X-Snapshot-Version"]))
+        self.assertIn(b'"Moved"', changed.content)
+        self.assertEqual(self.get("/data-download", HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 200)
+
+    def test_variant_etags(self):
+        plain = self.get("/data-download?stream=0", HTTP_ACCEPT_ENCODING="identity")
+        self.assertNotIn("Content-Encoding", plain)
+        etags = {plain["ETag"]}
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)):
+            with self.subTest(encoding=encoding):
+                response = self.get("/data-download?stream=0", HTTP_ACCEPT_ENCODING=encoding)
+                self.assertEqual(response["Content-Encoding"], encoding)
+                self.assertEqual(response["ETag"], plain["ETag"][:-1] + f'-{encoding}"')
+                self.assertIn("Accept-Encoding", response["Vary"])
+                self.assertEqual(zlib.decompress(response.content, wbits), plain.content)
+                etags.add(response["ETag"])
+        self.assertEqual(len(etags), 3)
+
+class PagedDownloadTests(CatalogTestCase):
+
+    def pages(self, path):
+        pages, after = [], ""
+        while True:
+            page = self.get_json(f"{path}&after={after}" if after else path)
+            pages.append(page)
+            if page["next"] is None:
+                return pages
+            after = page["next"]
+
+    def test_pages_cover_the_catalog(self):
+        pages = self.pages("/data-download?limit=9")
+        self.assertEqual(len(pages), 7)
+        self.assertEqual([len({r["code"] for r in p["product_data"]}) for p in pages], [9] * 6 + [6])
+        self.assertEqual(len(pages[0]["master_data"]), self.masters)
+        self.assertTrue(all("master_data" not in p for p in pages[1:]))
+        rows = [r for p in pages for r in p["product_data"]]
+        self.assertEqual(len({r["code"] for r in rows}), self.products)
+        self.assertEqual(rows, self.get_json("/data-download?stream=0")["product_data"])
+
+    def test_cursor_resumes_after_the_last_code(self):
+        first = self.get_json("/data-download/products?limit=5&fields=code")
+        self.assertEqual([r["code"] for r in first["product_data"]], [f"P{i:07d}" for i in range(5)])
+        second = self.get_json(f"/data-download/products?limit=5&fields=code&after={first['next']}")
+        self.assertEqual([r["code"] for r in second["product_data"]], [f"P{i:07d}" for i in range(5, 10)])
+
+    def test_last_page(self):
+        page = self.get_json(f"/data-download/products?limit={self.products + 1}&fields=code")
+        self.assertEqual(len(page["product_data"]), self.products)
+        self.assertIsNone(page["next"])
+
+    def test_bad_cursor(self):
+        other_store = views._page_token("elsewhere", "P0000005")
+        for query in ("after=not-a-token", f"after={other_store}", "limit=ten"):
+            with self.subTest(query=query):
+                response = self.get("/data-download/products?" + query)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()["detail"], "Invalid limit or continuation token")
+
+class EncodingTests(CatalogTestCase):
+    """Content-Encoding, format=columnar and the binary codecs"""
+
+    def test_gzip_and_deflate(self):
+        plain = self.get("/data-download?stream=0")
+        self.assertNotIn("Content-Encoding", plain)
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)):
+            for stream in ("0", "1"):
+                with self.subTest(encoding=encoding, stream=stream):
+                    response = self.get(f"/data-download?stream={stream}", HTTP_ACCEPT_ENCODING=encoding)
+                    self.assertEqual(response["Content-Encoding"], encoding)
+                    self.assertIn("Accept-Encoding", response["Vary"])
+                    body = response.getvalue() if response.streaming else response.content
+                    self.assertEqual(zlib.decompress(body, wbits), plain.content)
+
+    def test_encoding_negotiation(self):
+        response = self.get("/data-download?stream=0", HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        self.assertEqual(response["Content-Encoding"], "deflate")
+        # br/zstd without their library installed are skipped, not an error
+        accept = "br, zstd" if "br" not in compression.CODECS else "identity"
+        response = self.get("/data-download?stream=0", HTTP_ACCEPT_ENCODING=accept)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Content-Encoding", response)
+
+    def test_columnar_matches_rows(self):
+        rows = self.get_json("/data-download?stream=0")
+        for query in ("format=columnar&stream=0", "format=columnar&stream=1", "format=columnar&limit=1000"):
+            with self.subTest(query=query):
+                columnar = self.get_json("/data-download?" + query)
+                self.assertEqual(columnar["format"], "columnar")
+                for part in ("master_data", "product_data"):
+                    table = columnar[part]
+                    self.assertEqual(len(table["data"]), len(table["columns"]))
+                    self.assertEqual([dict(zip(table["columns"], values)) for values in zip(*table["data"])],
+                                     rows[part])
+
+    def test_unavailable_codec_is_not_acceptable(self):
+        with mock.patch.dict(serializers.CODECS, clear=True, values={serializers.JSON: serializers.JSONCodec()}):
+            for path in ("/data-download", "/data-download/products?limit=5", "/data-download/reconcile"):
+                for accept in (serializers.MSGPACK, "application/x-msgpack", serializers.CBOR):
+                    with self.subTest(path=path, accept=accept):
+                        response = self.get(path, HTTP_ACCEPT=accept)
+                        self.assertEqual(response.status_code, 406)
+                        self.assertEqual(response.json()["available"], [serializers.JSON])
+            # JSON is still sent when the client also takes it
+            response = self.get("/data-download?stream=0", HTTP_ACCEPT=f"{serializers.MSGPACK}, */*;q=0.1")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], serializers.JSON)
+            response = self.client.post("/upload-orders", b"\x81\xa6orders\x90", content_type=serializers.MSGPACK,
+                                        **self.auth)
+            self.assertEqual(response.status_code, 415)
+
+    def test_cbor_headers(self):
+        head = serializers._cbor_head
+        self.assertEqual((head(4, 3), head(4, 23), head(4, 24), head(5, 500), head(4, 70000)),
+                         (b"\x83", b"\x97", b"\x98\x18", b"\xb9\x01\xf4", b"\x9a\x00\x01\x11\x70"))
+
+    @unittest.skipUnless(serializers.msgpack is not None, "msgpack is not installed")
+    def test_msgpack(self):
+        rows = self.get_json("/data-download?stream=0")
+        for fmt in ("rows", "columnar"):
+            response = self.get(f"/data-download?stream=1&format={fmt}", HTTP_ACCEPT=serializers.MSGPACK)
+            self.assertEqual(response["Content-Type"], serializers.MSGPACK)
+            data = serializers.CODECS[serializers.MSGPACK].loads(response.getvalue())
+            self.assertEqual(len(data["master_data"] if fmt == "rows" else data["master_data"]["data"][0]),
+                             len(rows["master_data"]))
+
+    @unittest.skipUnless(serializers.cbor2 is not None, "cbor2 is not installed")
+    def test_cbor(self):
+        rows = self.get_json("/data-download?stream=0")
+        response = self.get("/data-download?stream=1", HTTP_ACCEPT=serializers.CBOR)
+        self.assertEqual(response["Content-Type"], serializers.CBOR)
+        data = serializers.CODECS[serializers.CBOR].loads(response.getvalue())
+        self.assertEqual([m["code"] for m in data["master_data"]], [m["code"] for m in rows["master_data"]])
+
+class RangeTests(CatalogTestCase):
+    settings = {"catalog_cache": {"enabled": True, "chunk_size": 1024}, "compression": {"enabled": False}}
+
+    def setUp(self):
+        super().setUp()
+        views.catalog_cache.invalidate()
+        self.full = self.get("/data-download?stream=0")
+        self.body = self.full.content
+
+    def test_resume_from_an_offset(self):
+        response = self.get("/data-download", HTTP_RANGE="bytes=100-", HTTP_IF_RANGE=self.full["ETag"])
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.body[100:])
+        self.assertEqual(response["Content-Range"], f"bytes 100-{len(self.body) - 1}/{len(self.body)}")
+
+    def test_suffix_range(self):
+        response = self.get("/data-download", HTTP_RANGE="bytes=-50")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.body[-50:])
+
+    def test_past_the_end(self):
+        response = self.get("/data-download", HTTP_RANGE=f"bytes={len(self.body)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.body)}")
+
+    def test_invalid_range_is_ignored(self):
+        for header in ("bytes=5-3", "bytes=a-", "bytes=-", "bytes=--5", "bytes=1-2,4-5"):
+            with self.subTest(range=header):
+                response = self.get("/data-download?stream=0", HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, self.body)
+
+    def test_unsatisfiable_range(self):
+        for header in (f"bytes={len(self.body) + 10}-{len(self.body) + 20}", "bytes=-0"):
+            with self.subTest(range=header):
+                self.assertEqual(self.get("/data-download", HTTP_RANGE=header).status_code, 416)
+
+    def test_stale_if_range_gets_the_whole_body(self):
+        response = self.get("/data-download?stream=0", HTTP_RANGE="bytes=100-", HTTP_IF_RANGE='"v0-stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.body)
+
+    def test_snapshot_version_header(self):
+        self.assertNotIn("X-Catalog-Version", self.full)
+        self.assertTrue(self.full["X-Snapshot-Version"].isdigit())
+
+    def test_manifest(self):
+        manifest = self.get_json("/data-download?manifest=1")
+        self.assertEqual(manifest["etag"], self.full["ETag"])
+        self.assertEqual(manifest["size"], len(self.body))
+        self.assertEqual(manifest["sha256"], hashlib.sha256(self.body).hexdigest())
+        self.assertEqual(manifest["chunks"], [hashlib.sha256(self.body[i:i + 1024]).hexdigest()
+                                              for i in range(0, len(self.body), 1024)])
+
+class BreakerTests(SimpleTestCase):
+
+    def test_opens_after_the_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure(OSError("down"))
+        breaker.before_call()
+        breaker.record_failure(OSError("down"))
+        with self.assertRaises(CircuitOpen) as raised:
+            breaker.before_call()
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+    def test_half_open_probe_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0, half_open_probes=1)
+        breaker.record_failure(OSError("down"))
+        breaker.before_call()               # the one probe
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+        breaker.record_success()
+        breaker.before_call()
+
+class StatsScopeTests(CatalogTestCase):
+    """A token only sees the statistics of its own store"""
+    settings = {"stores": {"main": "pktc", "branch": "pktc_b2"}, "default_store": "main",
+                "catalog_cache": {"enabled": True}}
+
+    def test_other_store_is_forbidden(self):
+        for path in ("/pool-stats?store=branch", "/query-stats?store=branch"):
+            with self.subTest(path=path):
+                self.assertEqual(self.get(path).status_code, 403)
+        self.assertEqual(self.get_json("/pool-stats?store=main")["pool"]["store"], "main")
+
+    def test_cache_stats_are_filtered(self):
+        opts = dict(CATALOG_CACHE_DEFAULTS)
+        self.addCleanup(views.catalog_cache.invalidate)
+        views.catalog_cache.get(("branch", "catalog"), opts, build=lambda: [b"branch"])
+        self.get_json("/data-download?stream=0")
+        stats = self.get_json("/query-stats")
+        self.assertEqual(stats["store"], "main")
+        self.assertNotIn("stores", stats)
+        self.assertTrue(stats["catalog_cache"]["snapshots"])
+        self.assertTrue(all(k.startswith("main/") for k in stats["catalog_cache"]["snapshots"]))
+
+class DatabaseUnavailableTests(CatalogTestCase):
+    settings = {"breaker": {"failure_threshold": 1, "reset_timeout": 60}}
+
+    def setUp(self):
+        super().setUp()
+        breaker = sql_helper.get_store("pktc").breaker
+        breaker.record_failure(OSError("down"))
+        self.addCleanup(breaker.record_success)
+
+    def test_download_fails_fast(self):
+        response = self.get("/data-download")
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+    def test_upload_is_not_swallowed(self):
+        response = self.client.post("/upload-orders", json.dumps({"orders": [{
+            "supplier_code": "S00001", "order_date": "2026-01-05",
+            "products": [{"barcode": "8900000000100", "quantity": 1, "rate": 1, "mrp": 1}]}]}),
+                                    content_type="application/json", **self.auth)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+class PoolTestCase(SimpleTestCase):
+    """ConnectionPools over a seeded SQLite file, without the app's config"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.backend = SQLiteBackend({"dir": self.dir})
+        conn = self.backend.connect("pktc")
+        seed(conn, 20, 1, 3)
+        conn.close()
+
+    def pool(self, **options):
+        options = dict({"min_size": 0, "max_size": 2, "maintenance_interval": 0}, **options)
+        pool = sql_helper.ConnectionPool(lambda: self.backend.connect("pktc"), **options)
+        self.addCleanup(pool.close)
+        return pool
+
+class PoolTests(PoolTestCase):
+
+    def test_acquire_and_release(self):
+        pool = self.pool(max_size=1)
+        pc = pool.acquire()
+        self.assertEqual((pool.stats()["in_use"], pool.stats()["idle"]), (1, 0))
+        self.assertEqual(pc.execute("SELECT COUNT(*) FROM acc_product").fetchone(), (20,))
+        pool.release(pc)
+        self.assertEqual((pool.stats()["in_use"], pool.stats()["idle"]), (0, 1))
+        with pool.connection() as again:
+            self.assertIs(again, pc)
+        stats = pool.stats()
+        self.assertEqual((stats["acquired"], stats["connects"], stats["timeouts"]), (2, 1, 0))
+
+    def test_timeout_when_exhausted(self):
+        pool = self.pool(max_size=1, acquire_timeout=0.05)
+        with pool.connection():
+            with self.assertRaises(sql_helper.PoolTimeout):
+                pool.acquire()
+        stats = pool.stats()
+        self.assertEqual((stats["timeouts"], stats["waits"], stats["in_use"]), (1, 1, 0))
+
+    def test_dead_connection_is_replaced_on_borrow(self):
+        pool = self.pool(max_size=1, validate_after=0)
+        with pool.connection() as pc:
+            pass
+        pc.raw.close()                  # the server dropped it while it sat idle
+        time.sleep(0.01)
+        with pool.connection() as conn:
+            self.assertIsNot(conn, pc)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM acc_master").fetchone(), (3,))
+        stats = pool.stats()
+        self.assertEqual((stats["failed_validations"], stats["connects"]), (1, 2))
+
+    def test_recently_used_connection_is_not_pinged(self):
+        pool = self.pool(max_size=1, validate_after=60)
+        with pool.connection() as pc:
+            pass
+        with mock.patch.object(sql_helper.ConnectionPool, "_is_alive") as is_alive:
+            with pool.connection() as conn:
+                self.assertIs(conn, pc)
+        is_alive.assert_not_called()
+
+    def test_warm_and_maintain(self):
+        pool = self.pool(min_size=2, max_size=3, idle_timeout=0.05)
+        self.assertEqual(pool.warm(), 2)
+        self.assertEqual(pool.stats()["idle"], 2)
+        held = [pool.acquire() for _ in range(3)]
+        for pc in held:
+            pool.release(pc)
+        time.sleep(0.1)
+        pool.maintain()                 # idle past idle_timeout, but keep min_size
+        stats = pool.stats()
+        self.assertEqual((stats["idle"], stats["evicted_idle"], stats["connects"]), (2, 1, 3))
+
+    def test_maintain_recycles_and_refills(self):
+        pool = self.pool(min_size=1, max_lifetime=0.05)
+        pool.warm()
+        time.sleep(0.1)
+        pool.maintain()
+        stats = pool.stats()
+        self.assertEqual((stats["idle"], stats["recycled"], stats["connects"]), (1, 1, 2))
+
+    def test_cursors_are_closed_on_release(self):
+        pool = self.pool(max_size=1, statement_cache_size=0)
+        with pool.connection() as pc:
+            cur = pc.cursor()
+            cur.execute("SELECT code FROM acc_product")
+            executed = pc.execute("SELECT code FROM acc_master")
+            self.assertEqual(len(pc.cursors), 2)
+        self.assertEqual((pc.cursors, pc.executed), ([], []))
+        for c in (cur, executed):
+            with self.assertRaises(sqlite3.ProgrammingError):
+                c.fetchone()
+
+class StatementCacheTests(PoolTestCase):
+
+    def test_repeated_statements_reuse_their_cursor(self):
+        pool = self.pool(statement_cache_size=2)
+        with pool.connection() as conn:
+            first = conn.execute(views.SQL_MAX_MASTER_SLNO)
+            first.fetchone()
+            again = conn.execute(views.SQL_MAX_MASTER_SLNO)
+            self.assertIs(again, first)
+            conn.execute(views.SQL_MASTER_EXISTS, (1,)).fetchone()
+            conn.execute(views.SQL_DETAIL_EXISTS, (1,)).fetchone()      # evicts MAX(slno)
+            self.assertIsNot(conn.execute(views.SQL_MAX_MASTER_SLNO), first)
+        self.assertEqual(pool.stats()["statement_cache"],
+                         {"hits": 1, "misses": 4, "evictions": 2, "hit_ratio": 0.2, "size": 2})
+
+    def test_cache_survives_the_borrow(self):
+        pool = self.pool(max_size=1)
+        with pool.connection() as conn:
+            first = conn.execute(views.SQL_MAX_MASTER_SLNO)
+        with pool.connection() as conn:
+            self.assertIs(conn.execute(views.SQL_MAX_MASTER_SLNO), first)
+            self.assertEqual(first.fetchone(), (None,))
+
+    def test_disabled(self):
+        pool = self.pool(statement_cache_size=0)
+        with pool.connection() as conn:
+            self.assertIsNot(conn.execute(views.SQL_MAX_MASTER_SLNO), conn.execute(views.SQL_MAX_MASTER_SLNO))
+        self.assertEqual(pool.stats()["statement_cache"]["misses"], 0)
+
+class StatementDeadlineTests(PoolTestCase):
+    """The deadline covers each statement, not the whole borrow"""
+
+    def pool(self, **options):
+        return super().pool(cancel=self.backend.cancel, timeout_for=lambda endpoint: 0.2, **options)
+
+    def run_lookups(self, pool, endpoint):
+        instrumentation.set_endpoint(endpoint)
+        self.addCleanup(instrumentation.end_request)
+        with pool.connection() as conn:
+            for i in range(25):
+                conn.execute(views.SQL_MAX_MASTER_SLNO).fetchone()
+                conn.execute(views.SQL_MASTER_EXISTS, (i,)).fetchone()
+                time.sleep(0.02)        # app work between statements, 0.5 s in all
+            open_cursors = len(conn.cursors)
+        return watchdog.stats()[endpoint], open_cursors
+
+    def test_many_fast_lookups_with_the_cache(self):
+        counters, _ = self.run_lookups(self.pool(), "test_cached_lookups")
+        self.assertEqual(counters, {"statements": 50, "timed_out": 0, "cancelled": 0, "closed": 0})
+
+    def test_many_fast_lookups_without_the_cache(self):
+        counters, open_cursors = self.run_lookups(self.pool(statement_cache_size=0), "test_uncached_lookups")
+        self.assertEqual(counters["timed_out"], 0)
+        self.assertLessEqual(open_cursors, 1)
+
+    def test_a_slow_statement_still_times_out(self):
+        pool = self.pool()
+        instrumentation.set_endpoint("test_slow_statement")
+        self.addCleanup(instrumentation.end_request)
+        with self.assertRaises(StatementTimeout), pool.connection() as conn:
+            cur = conn.execute("SELECT code FROM acc_product")
+            cur.fetchmany(1)
+            time.sleep(0.3)
+            cur.fetchmany(1)
+
+class SingleFlightTests(SimpleTestCase):
+    """Concurrent callers for one key share a single build"""
+    followers = 4
+
+    def run_concurrently(self, flight, fn):
+        """Call ``fn`` from 1 + followers threads, holding the leader until every follower has joined"""
+        release = threading.Event()
+        builds = []
+
+        def build():
+            builds.append(1)
+            release.wait(5)
+            return fn()
+
+        results = [None] * (self.followers + 1)
+
+        def call(i):
+            try:
+                results[i] = ("ok", flight.do("catalog", build))
+            except Exception as e:
+                results[i] = ("error", e)
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(self.followers + 1)]
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while flight.stats()["coalesced"] < self.followers and time.monotonic() < deadline:
+            time.sleep(0.005)
+        release.set()
+        for t in threads:
+            t.join(5)
+        return len(builds), results
+
+    def test_one_build_for_concurrent_misses(self):
+        flight = SingleFlight()
+        body = object()
+        builds, results = self.run_concurrently(flight, lambda: body)
+        self.assertEqual(builds, 1)
+        self.assertEqual(results, [("ok", body)] * (self.followers + 1))
+        self.assertEqual(flight.stats(), {"in_flight": 0, "builds": 1, "coalesced": self.followers})
+
+    def test_leader_error_reaches_followers(self):
+        flight = SingleFlight()
+        error = ConnectionError("database went away")
+
+        def fail():
+            raise error
+
+        builds, results = self.run_concurrently(flight, fail)
+        self.assertEqual(builds, 1)
+        self.assertEqual(results, [("error", error)] * (self.followers + 1))
+        self.assertEqual(flight.stats()["in_flight"], 0)
+        # the failed flight is gone: the next caller builds again
+        self.assertEqual(flight.do("catalog", lambda: "rebuilt"), "rebuilt")
+        self.assertEqual(flight.stats()["builds"], 2)
+
+    def test_streamed_build_is_shared(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        produced = []
+
+        def produce():
+            produced.append(1)
+            release.wait(5)
+            yield from (b"a", b"b", b"c")
+
+        readers = [flight.join("catalog", produce) for _ in range(self.followers + 1)]
+        release.set()
+        self.assertEqual([leader for _, leader in readers], [True] + [False] * self.followers)
+        self.assertEqual([b"".join(chunks) for chunks, _ in readers], [b"abc"] * (self.followers + 1))
+        self.assertEqual(produced, [1])
+        self.assertEqual(flight.stats(), {"in_flight": 0, "builds": 1, "coalesced": self.followers})
+
+class SnapshotCacheTests(SimpleTestCase):
+    opts = dict(CATALOG_CACHE_DEFAULTS, max_entries=2)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = SnapshotCache()
+        for key in ("a", "b"):
+            cache.get(key, self.opts, lambda: [key.encode() * 10])
+        cache.get("a", self.opts, lambda: [b"rebuilt"])         # a hit, now the most recent
+        cache.get("c", self.opts, lambda: [b"c" * 10])
+        self.assertEqual(sorted(cache.stats()["snapshots"]), ["a", "c"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_byte_limit_counts_variants(self):
+        cache = SnapshotCache()
+        opts = dict(self.opts, max_entries=10, max_bytes=3000)
+        first = cache.get("a", opts, lambda: [os.urandom(1000)])
+        cache.variant(first, "gzip", 6)
+        cache.get("b", opts, lambda: [os.urandom(1000)])
+        self.assertEqual(sorted(cache.stats()["snapshots"]), ["b"])
+
+    def test_versions_never_go_back(self):
+        cache = SnapshotCache()
+        v1 = cache.get("a", self.opts, lambda: [b"one"]).version
+        cache.get("b", self.opts, lambda: [b"b"])
+        cache.get("c", self.opts, lambda: [b"c"])                # evicts a
+        self.assertGreater(cache.get("a", self.opts, lambda: [b"two"]).version, v1)
@@ -6,6 +6,12 @@ urlpatterns = [
     path("login",         views.login,         name="login"),
     path("verify-token",  views.verify_token,  name="verify_token"),
     path("data-download", views.data_download, name="data_download"),
+    path("data-download/masters",  views.data_download_masters,  name="data_download_masters"),
+    path("data-download/products", views.data_download_products, name="data_download_products"),
+    path("data-download/sqlite",   views.data_download_sqlite,   name="data_download_sqlite"),
+    path("data-download/reconcile", views.data_download_reconcile, name="data_download_reconcile"),
     path("upload-orders", views.upload_orders, name="upload_orders"),
     path("status",        views.get_status,    name="get_status"),
+    path("pool-stats",    views.get_pool_stats, name="get_pool_stats"),
+    path("query-stats",   views.get_query_stats, name="get_query_stats"),
 ]
\ No newline at end of file
@@ -10,13 +10,30 @@ import psutil
 import subprocess
 import sys
 import json
+import base64
 import logging
+import time
 from datetime import datetime, timedelta
+from decimal import Decimal
 from functools import wraps
-from django.http import JsonResponse
+from contextlib import contextmanager
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from .sql_helper import get_connection, _get_config
+from . import compression, instrumentation, serializers
+from .breaker import CircuitOpen
+from .catalog_file import CatalogFiles, CATALOG_FILE_DEFAULTS, SQLITE_MEDIA_TYPE
+from .changelog import ChangelogFeed, CHANGELOG_DEFAULTS, installed as changelog_installed
+from .config import get_config
+from .delta import DeltaTracker, DELTA_SYNC_DEFAULTS, bucket_hex, root_hash
+from .singleflight import SingleFlight
+from .snapshot import SnapshotCache, CATALOG_CACHE_DEFAULTS
+from .sql_helper import (get_connection, get_read_connection, pool_stats, query_stats,
+                         driver_errors, fetch_columnar, prefetch, row_hash_sql)
+from .watchdog import StatementTimeout
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
@@ -24,6 +41,233 @@ PAIR_PASSWORD = os.getenv("PAIR_PASSWORD", "IMC-MOBILE")
 JWT_SECRET    = os.getenv("JWT_SECRET")
 JWT_ALGO      = os.getenv("JWT_ALGO", "HS256")
 
+# "reconcile" section of config.json
+RECONCILE_DEFAULTS = {
+    "buckets": 1024,         # product buckets by code; devices must use the same count
+}
+
+# "download" section of config.json
+DOWNLOAD_DEFAULTS = {
+    "stream": True,          # stream /data-download instead of building it in memory (?stream=0/1 overrides;
+                             # with catalog_cache enabled a miss is still built in full first)
+    "batch_size": 2000,      # rows per fetchmany batch / emitted chunk
+    "coalesce": True,        # concurrent downloads of one store share a single build (held in memory until done)
+    "page_size": 5000,       # products per page for ?limit= / ?after= when limit is omitted
+    "max_page_size": 20000,
+    "super_code": "SUNCR",   # acc_master.super_code of the masters sent when ?super_code= is omitted
+}
+
+_catalog_flights = SingleFlight("catalog")
+catalog_cache = SnapshotCache()
+
+MASTER_KEYS = ("code", "name", "place")
+PRODUCT_KEYS = ("code", "name", "barcode", "quantity", "salesprice", "bmrp", "cost")
+HEAD_KEYS = PRODUCT_KEYS[:2]           # acc_product columns; the rest come from acc_productbatch
+BATCH_KEYS = PRODUCT_KEYS[2:]          # format=nested: one value array per batch
+# fetch_columnar kinds for format=columnar: text interned, numbers as float64
+MASTER_KINDS = {"code": "s", "name": "s", "place": "s"}
+PRODUCT_KINDS = {"code": "s", "name": "s", "barcode": "s",
+                 "quantity": "f", "salesprice": "f", "bmrp": "f", "cost": "f"}
+
+# ------------------ SQL ------------------
+# qmark parameters, run through conn.execute
+SQL_LOGIN = "SELECT id, pass FROM acc_users WHERE id = ? AND pass = ?"
+# the full catalog (SQLite file, delta sync) with download.super_code as the
+# parameter (_catalog_params); downloads build theirs in CatalogSelection
+SQL_MASTERS = "SELECT code, name, place FROM acc_master WHERE super_code = ?"
+SQL_PRODUCTS = """
+        SELECT p.code, p.name, pb.barcode, pb.quantity, pb.salesprice, pb.bmrp, pb.cost
+        FROM acc_product p
+        LEFT JOIN acc_productbatch pb ON p.code = pb.productcode
+    """
+# the same rows for a set of codes (delta sync, fed by the changelog)
+SQL_MASTERS_FOR = SQL_MASTERS + " AND code IN ({})"
+SQL_PRODUCTS_FOR = SQL_PRODUCTS.rstrip() + "\n        WHERE p.code IN ({})\n    "
+# ?super_code= must be one of these (the value goes into the snapshot cache key)
+SQL_SUPER_CODES = "SELECT DISTINCT super_code FROM acc_master"
+# ?in_stock=1 on product-only scans: keep products with a batch in stock
+SQL_IN_STOCK = "EXISTS (SELECT 1 FROM acc_productbatch s WHERE s.productcode = p.code AND s.quantity > 0)"
+# change signature for catalog_cache.policy = "change": row counts plus the sum
+# of a per-row hash of every catalog column (the backend's row_hash)
+SQL_CATALOG_SIGNATURE = """
+        SELECT (SELECT COUNT(*) FROM acc_master), (SELECT SUM({masters}) FROM acc_master),
+               (SELECT COUNT(*) FROM acc_product), (SELECT SUM({products}) FROM acc_product),
+               (SELECT COUNT(*) FROM acc_productbatch), (SELECT SUM({batches}) FROM acc_productbatch)
+    """
+SQL_MASTER_COUNT_TODAY = "SELECT COUNT(*) FROM acc_purchaseordermaster WHERE orderdate = TODAY()"
+SQL_DETAIL_COUNT_TODAY = """
+            SELECT COUNT(*)
+            FROM acc_purchaseordermaster po
+            JOIN acc_purchaseorderdetails pd ON pd.masterslno = po.slno
+            WHERE po.orderdate = TODAY()
+        """
+SQL_MAX_MASTER_SLNO = "SELECT MAX(slno) FROM acc_purchaseordermaster"
+SQL_MAX_DETAIL_SLNO = "SELECT MAX(slno) FROM acc_purchaseorderdetails"
+SQL_INSERT_MASTER = """
+                INSERT INTO acc_purchaseordermaster
+                       (slno, orderno, supplier, otype, userid, orderdate)
+                VALUES (?,    ?,       ?,        ?,    ?,      ?)
+            """
+SQL_INSERT_DETAIL = """
+                    INSERT INTO acc_purchaseorderdetails
+                           (slno, masterslno, barcode, qty, rate, mrp)
+                    VALUES (?,    ?,          ?,       ?,  ?,    ?)
+                """
+SQL_MASTER_EXISTS = "SELECT COUNT(*) FROM acc_purchaseordermaster WHERE slno = ?"
+SQL_DETAIL_EXISTS = "SELECT COUNT(*) FROM acc_purchaseorderdetails WHERE slno = ?"
+
+# the catalog parts, in payload order: /data-download has both, /data-download/<part> one
+CATALOG_PARTS = ("masters", "products")
+CATALOG_DATA = {"masters": "master_data", "products": "product_data"}
+CATALOG_KEYS = {"masters": MASTER_KEYS, "products": PRODUCT_KEYS}
+CATALOG_KINDS = {"masters": MASTER_KINDS, "products": PRODUCT_KINDS}
+
+def _catalog_params(part):
+    """Parameters of the full-catalog SQL, read per scan so a config edit applies"""
+    if part == "masters":
+        return (get_config().section("download", DOWNLOAD_DEFAULTS)["super_code"],)
+    return ()
+
+# prebuilt SQLite files for /data-download/sqlite, one table per part
+# rows in a fixed order, so identical catalogs make byte-identical files
+catalog_files = CatalogFiles({"masters": (SQL_MASTERS + " ORDER BY code", MASTER_KEYS),
+                              "products": (SQL_PRODUCTS.rstrip() + "\n        ORDER BY p.code, pb.barcode\n    ",
+                                           PRODUCT_KEYS)},
+                             params=_catalog_params)
+# ?since= deltas, rows keyed by master code / product code + barcode
+catalog_deltas = DeltaTracker({"masters": (SQL_MASTERS, MASTER_KEYS, ("code",), SQL_MASTERS_FOR),
+                               "products": (SQL_PRODUCTS, PRODUCT_KEYS, ("code", "barcode"), SQL_PRODUCTS_FOR)},
+                              params=_catalog_params)
+
+# ------------------ projection and filters ------------------
+SELECTION_PARAMS = ("fields", "super_code", "in_stock")
+
+class CatalogSelection:
+    """What a catalog download asks for: the columns of each part (?fields=),
+    the masters' super_code (?super_code=) and in-stock batches only
+    (?in_stock=1). All three go into the generated SQL, so the database scans
+    and the server encodes only what the device keeps, and into ``key`` for
+    the snapshot cache.
+
+    Columns come back in their usual order whatever order ``fields`` lists
+    them in. A product projection without batch columns reads acc_product
+    alone: one row per product instead of one per batch.
+    """
+
+    __slots__ = ("parts", "keys", "super_code", "in_stock")
+
+    def __init__(self, parts, fields=None, super_code=None, in_stock=False):
+        self.parts = parts
+        self.keys = {part: tuple(k for k in CATALOG_KEYS[part] if fields is None or k in fields) for part in parts}
+        if super_code is None:
+            super_code = get_config().section("download", DOWNLOAD_DEFAULTS)["super_code"]
+        self.super_code = super_code
+        self.in_stock = in_stock
+
+    @classmethod
+    def from_request(cls, request, parts):
+        """Raises ValueError with a message for the device on bad parameters"""
+        fields = request.GET.get("fields")
+        if fields is not None:
+            fields = {f.strip() for f in fields.split(",") if f.strip()}
+            known = tuple(dict.fromkeys(k for part in parts for k in CATALOG_KEYS[part]))
+            if not fields or fields.difference(known):
+                raise ValueError(f"Unknown fields {', '.join(sorted(fields.difference(known))) or '(none)'} "
+                                 f"(use any of {', '.join(known)})")
+        in_stock = request.GET.get("in_stock", "0").lower()
+        if in_stock not in ("0", "1", "false", "true"):
+            raise ValueError("in_stock must be 1 or 0")
+        super_code = request.GET.get("super_code")
+        if super_code is not None and not super_code.strip():
+            raise ValueError("super_code must not be empty")
+        selection = cls(parts, fields, super_code and super_code.strip(), in_stock in ("1", "true"))
+        for part, keys in selection.keys.items():
+            if not keys:
+                other = next(p for p in parts if p != part)
+                raise ValueError(f"fields= selects no {part} columns (use /data-download/{other})")
+        return selection
+
+    @property
+    def key(self):
+        return tuple(self.keys.values()), self.super_code, self.in_stock
+
+    def kinds(self, part):
+        return {k: CATALOG_KINDS[part][k] for k in self.keys[part]}
+
+    def batch_keys(self):
+        return tuple(k for k in self.keys.get("products", ()) if k in BATCH_KEYS)
+
+    def nested_heads(self):
+        """format=nested product columns: code always, it is what batches are grouped by"""
+        return ("code",) + tuple(k for k in self.keys["products"] if k in HEAD_KEYS[1:])
+
+    def page_keys(self, nested):
+        """Keyset page columns: product code first (the page token needs it)"""
+        if nested:
+            return self.nested_heads() + self.batch_keys()
+        return ("code",) + tuple(k for k in self.keys["products"] if k != "code")
+
+    @staticmethod
+    def _columns(keys):
+        return ", ".join(("p." if k in HEAD_KEYS else "pb.") + k for k in keys)
+
+    def _product_rows(self, keys, products="acc_product", params=(), order=""):
+        """SELECT ``keys`` from ``products`` (a table or subquery aliased p),
+        joined to its batches when a batch column is wanted"""
+        sql = f"SELECT {self._columns(keys)} FROM {products} p"
+        if any(k in BATCH_KEYS for k in keys):
+            sql += " LEFT JOIN acc_productbatch pb ON p.code = pb.productcode"
+            if self.in_stock:
+                sql += " AND pb.quantity > 0"
+        # a subquery already did the in-stock filter (keyset pages)
+        if self.in_stock and products == "acc_product":
+            sql += " WHERE " + SQL_IN_STOCK
+        return sql + order, params
+
+    def sql(self, part):
+        """(SQL, params) for one part of a full download"""
+        if part == "masters":
+            return f"SELECT {', '.join(self.keys[part])} FROM acc_master WHERE super_code = ?", (self.super_code,)
+        return self._product_rows(self.keys[part])
+
+    def nested_sql(self):
+        """(heads SQL, params), (batches SQL, params) or None when no batch column is wanted"""
+        heads = self._product_rows(self.nested_heads(), order=" ORDER BY p.code")
+        keys = self.batch_keys()
+        if not keys:
+            return heads, None
+        where = " WHERE pb.quantity > 0" if self.in_stock else ""
+        return heads, (f"SELECT p.code, {self._columns(keys)} FROM acc_product p "
+                       f"JOIN acc_productbatch pb ON p.code = pb.productcode{where} ORDER BY p.code, pb.barcode", ())
+
+    def page_sql(self, after, limit, nested):
+        """The next ``limit`` products after a code, with all their (wanted) batches"""
+        inner = "SELECT code, name FROM acc_product p WHERE p.code > ?"
+        if self.in_stock:
+            inner += " AND " + SQL_IN_STOCK
+        inner += " ORDER BY p.code LIMIT ?"
+        return self._product_rows(self.page_keys(nested), f"({inner})", (after, limit),
+                                  " ORDER BY p.code, pb.barcode" if self.batch_keys() else " ORDER BY p.code")
+
+SUPER_CODES_TTL = 60          # seconds the known super codes of a store are reused
+_super_codes = {}             # store -> (read at, frozenset of codes)
+
+def _known_super_codes(store):
+    """acc_master's super codes, read again at most every SUPER_CODES_TTL seconds"""
+    entry = _super_codes.get(store)
+    if entry is None or time.monotonic() - entry[0] >= SUPER_CODES_TTL:
+        with get_read_connection(store=store) as conn:
+            codes = frozenset(r[0] for r in conn.execute(SQL_SUPER_CODES).fetchall())
+        entry = _super_codes[store] = (time.monotonic(), codes)
+    return entry[1]
+
+def _catalog_changed(store, codes):
+    """Changelog feed: refetch the changed rows for delta sync, drop cached bodies"""
+    catalog_deltas.apply(store, codes)
+    catalog_cache.invalidate(store=store)
+
+changelog_feed = ChangelogFeed(_catalog_changed, on_follow=catalog_deltas.set_fed)
+
 # ------------------ JWT helpers ------------------
 def _extract_token(request):
     hdr = request.headers.get("Authorization", "")
@@ -45,6 +289,11 @@ def jwt_required(view_func):
             request.userid = payload["sub"]
         except jwt.PyJWTError as e:
             return JsonResponse({"detail": "Invalid or expired token"}, status=401)
+        # tokens issued before multi-store support carry no "store" claim
+        cfg = get_config()
+        request.store = payload.get("store") or cfg.default_store
+        if request.store not in cfg.stores:
+            return JsonResponse({"detail": "Unknown store, please log in again"}, status=401)
         return view_func(request, *args, **kwargs)
     return _wrapped
 
@@ -97,51 +346,643 @@ def login(request):
     except Exception:
         return JsonResponse({"detail": "userid & password required"}, status=400)
 
-    logging.info("🔐 Login attempt for user: %s", userid)
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, pass FROM acc_users WHERE id = ? AND pass = ?", (userid, password))
-    row = cur.fetchone()
-    cur.close(); conn.close()
+    cfg = get_config()
+    store = data.get("store") or cfg.default_store
+    if store not in cfg.stores:
+        return JsonResponse({"detail": f"Unknown store {store!r}"}, status=400)
+
+    logging.info("🔐 Login attempt for user: %s (store %s)", userid, store)
+    with get_connection(store=store) as conn:
+        row = conn.execute(SQL_LOGIN, (userid, password)).fetchone()
 
     if not row:
         logging.warning("❌ Invalid credentials")
         return JsonResponse({"detail": "Invalid credentials"}, status=401)
 
-    token = jwt.encode({"sub": userid, "exp": datetime.utcnow() + timedelta(days=7)}, JWT_SECRET, algorithm=JWT_ALGO)
+    token = jwt.encode({"sub": userid, "store": store, "exp": datetime.utcnow() + timedelta(days=7)},
+                       JWT_SECRET, algorithm=JWT_ALGO)
     logging.info("✅ Login successful")
-    return JsonResponse({"status": "success", "message": "Login successful", "user_id": row[0], "token": token})
+    return JsonResponse({"status": "success", "message": "Login successful", "user_id": row[0],
+                         "store": store, "token": token})
 
 @jwt_required
 @require_http_methods(["GET"])
 def verify_token(request):
     logging.info("✅ Token verified for user: %s", request.userid)
-    return JsonResponse({"status": "success", "userid": request.userid})
+    return JsonResponse({"status": "success", "userid": request.userid, "store": request.store})
 
 @jwt_required
 @require_http_methods(["GET"])
 def data_download(request):
     logging.info("📥 Data download request")
-    conn = get_connection()
-    cur = conn.cursor()
+    return _download(request, CATALOG_PARTS)
 
-    cur.execute("SELECT code, name, place FROM acc_master WHERE super_code = 'SUNCR'")
-    master_rows = cur.fetchall()
-    master_data = [{"code": r[0], "name": r[1], "place": r[2]} for r in master_rows]
+@jwt_required
+@require_http_methods(["GET"])
+def data_download_masters(request):
+    logging.info("📥 Masters download request")
+    return _download(request, ("masters",))
 
-    cur.execute("""
-        SELECT p.code, p.name, pb.barcode, pb.quantity, pb.salesprice, pb.bmrp, pb.cost
-        FROM acc_product p
-        LEFT JOIN acc_productbatch pb ON p.code = pb.productcode
-    """)
-    product_rows = cur.fetchall()
-    product_data = [
-        {"code": r[0], "name": r[1], "barcode": r[2], "quantity": r[3],
-         "salesprice": r[4], "bmrp": r[5], "cost": r[6]} for r in product_rows
-    ]
-    cur.close(); conn.close()
-    logging.info("✅ Downloaded %s masters, %s products", len(master_data), len(product_data))
-    return JsonResponse({"status": "success", "master_data": master_data, "product_data": product_data})
+@jwt_required
+@require_http_methods(["GET"])
+def data_download_products(request):
+    logging.info("📥 Products download request")
+    return _download(request, ("products",))
+
+@jwt_required
+@require_http_methods(["GET"])
+def data_download_sqlite(request):
+    """The catalog as a ready-made SQLite file (tables masters and products),
+    sent straight from disk"""
+    logging.info("📥 SQLite catalog download request")
+    opts = get_config().section("catalog_file", CATALOG_FILE_DEFAULTS)
+    if not opts["enabled"]:
+        return JsonResponse({"detail": "SQLite catalog download is disabled"}, status=404)
+    for attempt in range(2):
+        f = catalog_files.current(request.store)
+        if f.etag in parse_etags(request.headers.get("If-None-Match", "")):
+            catalog_files.bump("not_modified")
+            response = HttpResponseNotModified()
+            break
+        try:
+            body = open(f.path, "rb")
+        except FileNotFoundError:
+            # pruned after a newer build (or removed by hand): go again with the new current file
+            catalog_files.discard(f)
+            if attempt:
+                raise
+            continue
+        catalog_files.bump("served")
+        response = FileResponse(body, as_attachment=True, filename=f.filename, content_type=SQLITE_MEDIA_TYPE)
+        break
+    response["ETag"] = f.etag
+    response["Cache-Control"] = opts["cache_control"]
+    response["X-Catalog-File-Version"] = str(f.version)
+    response["X-Content-SHA256"] = f.sha256
+    return response
+
+def _download(request, parts):
+    opts = get_config().section("download", DOWNLOAD_DEFAULTS)
+    stream = request.GET.get("stream")
+    stream = stream == "1" or (stream is None and opts["stream"])
+    batch_size = max(1, int(opts["batch_size"]))
+    fmt = request.GET.get("format", "rows")
+    if fmt not in CATALOG_FORMATS:
+        return JsonResponse({"detail": f"Unknown format {fmt!r} (use one of {', '.join(CATALOG_FORMATS)})"},
+                            status=400)
+    try:
+        codec = serializers.for_response(request.headers.get("Accept"))
+    except serializers.NotAcceptable as e:
+        return _not_acceptable(e)
+    content_type = codec.media_type
+    if "since" in request.GET:
+        if any(name in request.GET for name in SELECTION_PARAMS):
+            return JsonResponse({"detail": "since= always covers the whole catalog; "
+                                           f"drop {', '.join(SELECTION_PARAMS)}"}, status=400)
+        if fmt != "rows":
+            return JsonResponse({"detail": "since= sends rows; drop format= or use format=rows"}, status=400)
+        return _download_delta(request, parts, codec)
+    try:
+        selection = CatalogSelection.from_request(request, parts)
+    except ValueError as e:
+        return JsonResponse({"detail": str(e)}, status=400)
+    # only known codes, so a client cannot fill the snapshot cache with made-up keys
+    if "masters" in parts and "super_code" in request.GET and \
+            selection.super_code not in _known_super_codes(request.store):
+        return JsonResponse({"detail": f"Unknown super_code {selection.super_code!r}"}, status=400)
+    if "products" in parts and ("after" in request.GET or "limit" in request.GET):
+        return _download_page(request, opts, fmt, codec, selection)
+    key = (request.store, "catalog" if len(parts) > 1 else parts[0], fmt, content_type) + selection.key
+    if content_type == serializers.JSON:
+        build = lambda: CATALOG_FORMATS[fmt](request.store, batch_size, selection)
+    else:
+        build = lambda: _binary_chunks(request.store, batch_size, fmt, codec, selection)
+
+    cache = get_config().section("catalog_cache", CATALOG_CACHE_DEFAULTS)
+    if request.GET.get("manifest") == "1":
+        if not cache["enabled"]:
+            return JsonResponse({"detail": "Chunk manifests need catalog_cache enabled"}, status=404)
+        return _catalog_manifest(request, cache, key, build)
+    if cache["enabled"]:
+        return _cached_download(request, cache, stream, key, build, content_type)
+
+    ctx = instrumentation.request_context()
+    # the body runs after the middleware has ended the request (and on the
+    # builder thread when coalesced); keep the request's tag and deadline
+    produce = lambda: instrumentation.bind_iter(build(), ctx)
+    if opts["coalesce"]:
+        chunks, leader = _catalog_flights.join(key, produce)
+        if not leader:
+            logging.info("🔗 Joined an in-flight catalog build")
+    else:
+        chunks = produce()
+    # wait for the connection and the first query, so a busy pool or a dead
+    # database still becomes a 503 instead of a truncated 200
+    next(chunks)
+    if stream:
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+    else:
+        response = HttpResponse(b"".join(chunks), content_type=content_type)
+    patch_vary_headers(response, ("Accept",))
+    return response
+
+# ------------------ keyset pages ------------------
+def _page_token(store, code):
+    raw = json.dumps({"s": store, "k": code}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def _page_after(store, token):
+    """The product code a continuation token points after ("" for the first page)"""
+    if not token:
+        return ""
+    data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    if data.get("s") != store:
+        raise ValueError("token belongs to another store")
+    return str(data["k"])
+
+def _download_page(request, opts, fmt, codec, selection):
+    """One bounded page of products (plus masters on the first page of the
+    combined download) and a ``next`` token, or ``null`` when the catalog is
+    exhausted"""
+    try:
+        limit = int(request.GET.get("limit") or opts["page_size"])
+        after = _page_after(request.store, request.GET.get("after"))
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"detail": "Invalid limit or continuation token"}, status=400)
+    limit = max(1, min(limit, int(opts["max_page_size"])))
+    # JSON rows keep the driver's values (same as the full download); other shapes use floats
+    plain = fmt != "columnar" and codec.media_type == serializers.JSON
+    product_kinds = {k: ("o" if plain and v == "f" else v) for k, v in PRODUCT_KINDS.items()}
+    nested = fmt == "nested"
+    queries = [("products",) + selection.page_sql(after, limit, nested)]
+    if "masters" in selection.parts and not after:
+        queries.insert(0, ("masters",) + selection.sql("masters"))
+
+    results = {}
+    with get_read_connection(store=request.store) as conn, \
+            _catalog_cursors(conn, request.store, queries, int(opts["batch_size"])) as cursors:
+        for part, cur in cursors:
+            results[part] = fetch_columnar(cur, product_kinds if part == "products" else MASTER_KINDS)
+    masters, products = results.get("masters"), results["products"]
+
+    codes = products["code"]
+    distinct = sum(1 for i, c in enumerate(codes) if i == 0 or c != codes[i - 1])
+    keys = selection.keys["products"]
+    if "code" not in keys and not nested:
+        products = products.select(keys)       # fetched only for the page token
+    payload = {"status": "success"}
+    if fmt != "rows":
+        payload["format"] = fmt
+    if masters is not None:
+        payload["master_data"] = (_columnar_values(masters) if fmt == "columnar"
+                                  else [dict(zip(selection.keys["masters"], r)) for r in masters.rows()])
+    if nested:
+        heads = selection.nested_heads()
+        if selection.batch_keys():
+            payload["batch_columns"] = list(selection.batch_keys())
+        payload["product_data"] = list(_group_joined(products.rows(), heads, bool(selection.batch_keys())))
+    else:
+        payload["product_data"] = (_columnar_values(products) if fmt == "columnar"
+                                   else [dict(zip(keys, r)) for r in products.rows()])
+    payload["next"] = _page_token(request.store, codes[-1]) if distinct >= limit else None
+    logging.info("✅ Catalog page after %r: %s products, %s rows", after, distinct, len(products))
+    response = HttpResponse(codec.dumps(payload), content_type=codec.media_type)
+    patch_vary_headers(response, ("Accept",))
+    return response
+
+def _download_delta(request, parts, codec):
+    """?since=<version>: rows inserted, updated and deleted since that version,
+    or the full catalog ("mode": "full") when the delta cannot be served"""
+    opts = get_config().section("delta_sync", DELTA_SYNC_DEFAULTS)
+    if not opts["enabled"]:
+        return JsonResponse({"detail": "Delta sync is disabled"}, status=404)
+    try:
+        since = int(request.GET["since"] or 0)
+    except ValueError:
+        return JsonResponse({"detail": "since must be a catalog version number"}, status=400)
+    # the registry is per device; fall back to the user for clients that send no id
+    device = request.headers.get("X-Device-Id") or request.userid
+    binary = codec.media_type != serializers.JSON
+    keys = {part: CATALOG_KEYS[part] for part in parts}
+    row_dict = lambda part, row: dict(zip(keys[part], _binary_values(row) if binary else row))
+    payload = catalog_deltas.payload(request.store, since, device,
+                                     {part: CATALOG_DATA[part] for part in parts}, row_dict)
+    logging.info("✅ Catalog %s for %s: v%s -> v%s", payload["mode"], device, since, payload["version"])
+    response = HttpResponse(codec.dumps(payload), content_type=codec.media_type)
+    response["X-Catalog-Version"] = str(payload["version"])
+    patch_vary_headers(response, ("Accept", "X-Device-Id"))
+    return response
+
+@csrf_exempt
+@jwt_required
+@require_http_methods(["GET", "POST"])
+def data_download_reconcile(request):
+    """Bucket reconciliation for devices that don't know their catalog version.
+
+    GET returns the server's product bucket hashes. POST {"hashes": [...]} (or
+    {"root": ...}) returns the rows of every bucket whose hash differs, which
+    replace everything the device holds in those buckets.
+    """
+    try:
+        reply = serializers.for_response(request.headers.get("Accept"))
+    except serializers.NotAcceptable as e:
+        return _not_acceptable(e)
+
+    def respond(data, status=200):
+        response = HttpResponse(reply.dumps(data), content_type=reply.media_type, status=status)
+        patch_vary_headers(response, ("Accept",))
+        return response
+
+    n = max(1, int(get_config().section("reconcile", RECONCILE_DEFAULTS)["buckets"]))
+    version, sums = catalog_deltas.buckets(request.store, "products", n)
+    hexes = bucket_hex(sums)
+    root = root_hash(hexes)
+    if request.method == "GET":
+        return respond({"status": "success", "version": version, "buckets": n, "root": root, "hashes": hexes})
+
+    try:
+        body = serializers.for_request(request.content_type).loads(request.body)
+        theirs = body.get("hashes")
+        if theirs is not None and (len(theirs) != n or not all(isinstance(h, str) for h in theirs)):
+            raise ValueError
+    except serializers.UnsupportedMediaType as e:
+        return respond({"detail": f"Unsupported Content-Type {e}"}, status=415)
+    except Exception:
+        return respond({"detail": f"Expected {{\"hashes\": [{n} bucket hashes]}} or {{\"root\": ...}}",
+                        "buckets": n}, status=400)
+
+    if body.get("root") == root or theirs == hexes:
+        differing = []
+    elif theirs is None:
+        differing = list(range(n))
+    else:
+        differing = [i for i, (a, b) in enumerate(zip(hexes, theirs)) if a != b.lower()]
+    rows = catalog_deltas.bucket_rows(request.store, "products", n, set(differing), version)
+    if rows is None:
+        return respond({"detail": "Catalog changed during reconciliation, retry"}, status=409)
+    binary = reply.media_type != serializers.JSON
+    device = request.headers.get("X-Device-Id") or request.userid
+    catalog_deltas.registry.record(request.store, device, sent=version)
+    logging.info("✅ Reconciled %s: %s of %s buckets differ, %s rows", device, len(differing), n, len(rows))
+    return respond({"status": "success", "version": version, "buckets": n, "root": root, "differing": differing,
+                    "product_data": [dict(zip(PRODUCT_KEYS, _binary_values(r) if binary else r)) for r in rows]})
+
+def _not_acceptable(e):
+    return JsonResponse({"detail": f"Cannot encode {e} on this server (use application/json)",
+                         "available": list(serializers.CODECS)}, status=406)
+
+def _binary_values(values):
+    """Decimals as floats – MessagePack/CBOR have no decimal type"""
+    return [float(v) if isinstance(v, Decimal) else v for v in values]
+
+def _cached_download(request, cache, stream, key, build, content_type):
+    store = request.store
+    snap = catalog_cache.get(key, cache, build=build, signature=lambda: _catalog_signature(store))
+    # precompressed variants live on the snapshot, so a repeat download costs no compression
+    comp = get_config().section("compression", compression.COMPRESSION_DEFAULTS)
+    encoding = None
+    if comp["enabled"] and snap.size >= int(comp["min_size"]):
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding", ""), comp["encodings"])
+    headers = {"ETag": compression.variant_etag(snap.etag, encoding), "Cache-Control": cache["cache_control"],
+               "X-Snapshot-Version": str(snap.version)}
+    if snap.etag in map(compression.base_etag, parse_etags(request.headers.get("If-None-Match", ""))):
+        catalog_cache.bump("not_modified")
+        logging.info("✅ Catalog unchanged (v%s) – 304", snap.version)
+        response = HttpResponseNotModified()
+    else:
+        body = None
+        if encoding is not None:
+            body = catalog_cache.variant(snap, encoding, compression.level_for(encoding, comp["levels"]))
+        size = snap.size if body is None else len(body)
+        byte_range = _byte_range(request, headers["ETag"], size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+        elif byte_range is not None:
+            # resuming: the device already has everything before ``start``
+            start, end = byte_range
+            part = snap.slice(start, end) if body is None else body[start:end + 1]
+            response = HttpResponse(part, content_type=content_type, status=206)
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        elif body is not None:
+            response = HttpResponse(body, content_type=content_type)
+        elif stream:
+            response = StreamingHttpResponse(iter(snap.chunks), content_type=content_type)
+        else:
+            response = HttpResponse(snap.body(), content_type=content_type)
+        if encoding is not None and byte_range is not False:
+            response["Content-Encoding"] = encoding
+        response["Accept-Ranges"] = "bytes"
+    patch_vary_headers(response, ("Accept", "Accept-Encoding") if comp["enabled"] else ("Accept",))
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+def _byte_range(request, etag, size):
+    """(start, end) of a single-range "Range: bytes=..." request, None to send
+    the whole body (no range, or one that is not valid syntax, like bytes=5-3),
+    or False if a valid range is past the end"""
+    header = request.headers.get("Range", "").strip()
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range.strip() != etag:
+        return None          # the body changed since the device started: send it whole
+    first, _, last = (p.strip() for p in header[6:].partition("-"))
+    if not all(p.isdigit() for p in (first, last) if p) or not (first or last):
+        return None
+    if first:
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None
+    else:
+        start, end = max(size - int(last), 0), size - 1
+        if not int(last):
+            return False     # a zero-length suffix cannot be satisfied
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+def _catalog_manifest(request, cache, key, build):
+    """?manifest=1: size, sha256 and per-chunk sha256 of the uncompressed body the
+    same URL returns, for resuming with Range and verifying each chunk"""
+    store = request.store
+    snap = catalog_cache.get(key, cache, build=build, signature=lambda: _catalog_signature(store))
+    chunk_size = max(1024, int(cache["chunk_size"]))
+    return JsonResponse({"status": "success", "version": snap.version, "etag": snap.etag, "size": snap.size,
+                         "sha256": snap.sha256, "chunk_size": chunk_size, "chunks": snap.manifest(chunk_size)})
+
+def _catalog_signature(store):
+    """The changelog position while the feed follows the store, else a checksum of the catalog"""
+    if get_config().section("changelog", CHANGELOG_DEFAULTS)["enabled"]:
+        seq = changelog_installed(store)
+        if seq is not None:
+            return ("changelog", seq)
+    sql = SQL_CATALOG_SIGNATURE.format(masters=row_hash_sql("code", "name", "place", "super_code"),
+                                       products=row_hash_sql("code", "name"),
+                                       batches=row_hash_sql("productcode", "barcode", "quantity",
+                                                            "salesprice", "bmrp", "cost"))
+    with get_read_connection(store=store) as conn:
+        return tuple(conn.execute(sql).fetchone())
+
+def _json_rows(cur, keys, batch_size, counts, encode):
+    """Encode a cursor as the items of a JSON array, one chunk per fetchmany batch"""
+    sep = b""
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        counts.append(len(rows))
+        yield sep + ", ".join([encode(dict(zip(keys, r))) for r in rows]).encode()
+        sep = b", "
+
+def _catalog_queries(selection):
+    return [(part,) + selection.sql(part) for part in selection.parts]
+
+@contextmanager
+def _catalog_cursors(conn, store, queries, batch_size, local=1):
+    """Executed cursors for ``queries`` ((part, sql, params) in payload order).
+
+    The first ``local`` queries run on ``conn``; the others are started up
+    front on their own read connections (sql_helper.prefetch) so they run
+    while the first one is read, and a combined download takes as long as its
+    slowest query rather than the sum. With no spare connection they run on
+    ``conn`` after it, as before.
+    """
+    ahead = {}
+    try:
+        for part, sql, params in queries[local:]:
+            ahead[part] = prefetch(sql, params, store=store, batch_size=batch_size)
+        yield ((part, ahead.get(part) or conn.execute(sql, params)) for part, sql, params in queries)
+    finally:
+        for cur in ahead.values():
+            if cur is not None:
+                cur.close()
+
+def _catalog_chunks(store, batch_size, selection):
+    """The /data-download JSON body, produced batch by batch from the cursors.
+
+    Yields b"" once the connection is held and the first query has run.
+    """
+    encode = DjangoJSONEncoder().encode
+    counts = {part: [] for part in selection.parts}
+    # snapshot reader: order inserts never block the download
+    with get_read_connection(store=store) as conn, \
+            _catalog_cursors(conn, store, _catalog_queries(selection), batch_size) as cursors:
+        head = b'{"status": "success"'
+        for part, cur in cursors:
+            if head:
+                yield b""
+            try:
+                yield head + b', "' + CATALOG_DATA[part].encode() + b'": ['
+                head = b""
+                yield from _json_rows(cur, selection.keys[part], batch_size, counts[part], encode)
+                yield b"]"
+            except GeneratorExit:
+                logging.warning("⚠️ Data download aborted by the client")
+                raise
+            except Exception as e:
+                logging.error("❌ Data download failed mid-stream: %s", e)
+                raise
+        yield b"}"
+    logging.info("✅ Downloaded %s", ", ".join(f"{sum(n)} {part}" for part, n in counts.items()))
+
+def _json_column(values, kind):
+    if kind == "f":
+        values = [None if v != v else v for v in values]     # NaN marks NULL
+    return json.dumps(list(values)).encode()
+
+def _json_columnar(result):
+    """{"columns": [...], "data": [[column 0 values], [column 1 values], ...]}"""
+    yield b'{"columns": ' + json.dumps(result.columns).encode() + b', "data": ['
+    for i, name in enumerate(result.columns):
+        yield (b", " if i else b"") + _json_column(result[name], result.kinds[name])
+    yield b"]}"
+
+def _fetch_catalog(store, batch_size, selection):
+    """Every requested part as a ColumnarResult, yielding b"" once the first query has run"""
+    results = {}
+    with get_read_connection(store=store) as conn, \
+            _catalog_cursors(conn, store, _catalog_queries(selection), batch_size) as cursors:
+        for part, cur in cursors:
+            if not results:
+                yield b""
+            results[part] = fetch_columnar(cur, selection.kinds(part), batch_size)
+    return results
+
+def _columnar_chunks(store, batch_size, selection):
+    """format=columnar: column names plus one value array per column, no per-row keys.
+
+    Rows are fetched into compact columns (fetch_columnar) and each column is
+    encoded with a single json.dumps call.
+    """
+    results = yield from _fetch_catalog(store, batch_size, selection)
+    yield b'{"status": "success", "format": "columnar"'
+    for part, result in results.items():
+        yield b', "' + CATALOG_DATA[part].encode() + b'": '
+        yield from _json_columnar(result)
+    yield b"}"
+    logging.info("✅ Downloaded %s (columnar)", ", ".join(f"{len(r)} {p}" for p, r in results.items()))
+
+# ------------------ format=nested ------------------
+# Each product once, with its batches as a compact list of value arrays, instead
+# of the LEFT JOIN's code/name repeated on every batch row. Built from two scans
+# in the same order (products; batches joined to their product) merged in one
+# pass: batches carry p.code, so matching is plain equality and never depends
+# on how the database collates codes. Both scans run on the same connection,
+# i.e. in one snapshot: on two, a batch whose product was deleted in between
+# would stall the merge and leave every later product without batches.
+def _iter_rows(cur, batch_size):
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def _merge_batches(products, batches, heads):
+    """{"code", "name", "batches": [[barcode, quantity, ...], ...]} per product
+    row; no "batches" when ``batches`` is None (no batch column wanted)"""
+    batch = next(batches, None) if batches is not None else None
+    for head in products:
+        product = dict(zip(heads, head))
+        if batches is not None:
+            items = []
+            while batch is not None and batch[0] == head[0]:
+                items.append(list(batch[1:]))
+                batch = next(batches, None)
+            product["batches"] = items
+        yield product
+
+def _group_joined(rows, heads, with_batches=True):
+    """The same shape from LEFT JOIN rows ordered by product code (keyset pages)"""
+    product = None
+    n = len(heads)
+    for row in rows:
+        if product is None or product["code"] != row[0]:
+            if product is not None:
+                yield product
+            product = dict(zip(heads, row))
+            if with_batches:
+                product["batches"] = []
+        batch = list(row[n:])
+        if with_batches and any(v is not None for v in batch):
+            product["batches"].append(batch)
+    if product is not None:
+        yield product
+
+def _nested_queries(selection):
+    """Products and their batches first (both run on the borrowed connection), then masters"""
+    queries = []
+    if "products" in selection.parts:
+        heads, batches = selection.nested_sql()
+        queries.append(("products",) + heads)
+        if batches is not None:
+            queries.append(("batches",) + batches)
+    if "masters" in selection.parts:
+        queries.append(("masters",) + selection.sql("masters"))
+    return queries
+
+@contextmanager
+def _nested_cursors(store, batch_size, selection):
+    """Executed cursors by part; products and batches come back merged as "products" """
+    queries = _nested_queries(selection)
+    local = max(1, sum(1 for part, _, _ in queries if part in ("products", "batches")))
+    with get_read_connection(store=store) as conn, \
+            _catalog_cursors(conn, store, queries, batch_size, local) as cursors:
+        cursors = dict(cursors)
+        if "products" in cursors:
+            batches = cursors.pop("batches", None)
+            cursors["products"] = _merge_batches(_iter_rows(cursors["products"], batch_size),
+                                                 batches and _iter_rows(batches, batch_size),
+                                                 selection.nested_heads())
+        yield cursors
+
+def _nested_chunks(store, batch_size, selection):
+    """format=nested as JSON, streamed batch_size products at a time"""
+    encode = DjangoJSONEncoder().encode
+    counts = {part: [] for part in selection.parts}
+    with _nested_cursors(store, batch_size, selection) as cursors:
+        yield b""
+        yield b'{"status": "success", "format": "nested"'
+        if "masters" in cursors:
+            yield b', "master_data": ['
+            yield from _json_rows(cursors["masters"], selection.keys["masters"], batch_size,
+                                  counts["masters"], encode)
+            yield b"]"
+        if "products" in cursors:
+            if selection.batch_keys():
+                yield b', "batch_columns": ' + json.dumps(selection.batch_keys()).encode()
+            yield b', "product_data": ['
+            sep, group = b"", []
+            for product in cursors["products"]:
+                group.append(encode(product))
+                if len(group) >= batch_size:
+                    counts["products"].append(len(group))
+                    yield sep + ", ".join(group).encode()
+                    sep, group = b", ", []
+            if group:
+                counts["products"].append(len(group))
+                yield sep + ", ".join(group).encode()
+            yield b"]"
+        yield b"}"
+    logging.info("✅ Downloaded %s (nested)", ", ".join(f"{sum(n)} {part}" for part, n in counts.items()))
+
+CATALOG_FORMATS = {"rows": _catalog_chunks, "columnar": _columnar_chunks, "nested": _nested_chunks}
+
+def _columnar_values(result):
+    return {"columns": result.columns,
+            "data": [[None if v != v else v for v in result[name]] if result.kinds[name] == "f"
+                     else list(result[name]) for name in result.columns]}
+
+def _binary_rows(result, keys, batch_size, codec):
+    """Array header, then one chunk of encoded row maps per batch"""
+    yield codec.array_header(len(result))
+    batch = []
+    for row in result.rows():
+        batch.append(codec.dumps(dict(zip(keys, row))))
+        if len(batch) >= batch_size:
+            yield b"".join(batch)
+            batch = []
+    if batch:
+        yield b"".join(batch)
+
+def _binary_chunks(store, batch_size, fmt, codec, selection):
+    """The catalog as MessagePack/CBOR, same structure as the JSON formats.
+
+    Numbers are floats; the row count is known from the columnar fetch, so
+    rows can still be encoded batch by batch under a definite-length array.
+    """
+    if fmt == "nested":
+        with _nested_cursors(store, batch_size, selection) as cursors:
+            yield b""
+            payload = {"status": "success", "format": "nested"}
+            if "masters" in cursors:
+                payload["master_data"] = [dict(zip(selection.keys["masters"], r))
+                                          for r in _iter_rows(cursors["masters"], batch_size)]
+            if "products" in cursors:
+                if selection.batch_keys():
+                    payload["batch_columns"] = list(selection.batch_keys())
+                # numbers as floats, as in the other binary shapes
+                payload["product_data"] = products = list(cursors["products"])
+                for product in products:
+                    if "batches" in product:
+                        product["batches"] = [_binary_values(batch) for batch in product["batches"]]
+        yield codec.dumps(payload)
+        logging.info("✅ Downloaded %s (nested, %s)", ", ".join(
+            f"{len(payload[CATALOG_DATA[p]])} {p}" for p in selection.parts), codec.media_type)
+        return
+    results = yield from _fetch_catalog(store, batch_size, selection)
+    if fmt == "columnar":
+        payload = {"status": "success", "format": "columnar"}
+        payload.update((CATALOG_DATA[p], _columnar_values(r)) for p, r in results.items())
+        yield codec.dumps(payload)
+    else:
+        yield codec.map_header(1 + len(results)) + codec.dumps("status") + codec.dumps("success")
+        for part, result in results.items():
+            yield codec.dumps(CATALOG_DATA[part])
+            yield from _binary_rows(result, selection.keys[part], batch_size, codec)
+    logging.info("✅ Downloaded %s (%s)", ", ".join(f"{len(r)} {p}" for p, r in results.items()),
+                 codec.media_type)
 
 # ------------------------------------------------------------------
 #  NEW : helper that returns the next PK for acc_purchaseorderdetails
@@ -158,9 +999,8 @@ def data_download(request):
 # ------------------------------------------------------------------
 #  FIXED helper – always returns int
 # ------------------------------------------------------------------
-def _next_detail_slno(cur):
-    cur.execute("SELECT MAX(slno) FROM acc_purchaseorderdetails")
-    row = cur.fetchone()[0]
+def _next_detail_slno(conn):
+    row = conn.execute(SQL_MAX_DETAIL_SLNO).fetchone()[0]
     return int(row or 0) + 1          # ← cast to int
 
 
@@ -172,137 +1012,129 @@ def _next_detail_slno(cur):
 @require_http_methods(["POST"])
 def upload_orders(request):
     try:
-        payload = json.loads(request.body)
+        reply = serializers.for_response(request.headers.get("Accept"))
+    except serializers.NotAcceptable as e:
+        return _not_acceptable(e)
+
+    def respond(data, status=200):
+        return HttpResponse(reply.dumps(data), content_type=reply.media_type, status=status)
+
+    try:
+        codec = serializers.for_request(request.content_type)
+    except serializers.UnsupportedMediaType as e:
+        return respond({"detail": f"Unsupported Content-Type {e}"}, status=415)
+    try:
+        payload = codec.loads(request.body)
         orders  = payload.get("orders", [])
     except Exception:
-        return JsonResponse({"detail": "Invalid JSON"}, status=400)
+        return respond({"detail": "Invalid JSON" if codec.media_type == serializers.JSON
+                        else f"Invalid {codec.media_type} body"}, status=400)
 
     if not orders:
-        return JsonResponse({"detail": "No orders supplied"}, status=400)
+        return respond({"detail": "No orders supplied"}, status=400)
 
     logging.info("📤 Uploading %s orders", len(orders))
     logging.info("📦 Raw JSON received: %s", payload)
 
-    conn = get_connection()
-    cur  = conn.cursor()
-    conn.autocommit = False
+    with get_connection(store=request.store) as conn:
+        conn.autocommit = False
 
-    try:
-        # ---------- before counts ----------
-        cur.execute("SELECT COUNT(*) FROM acc_purchaseordermaster WHERE orderdate = TODAY()")
-        m_before = int(cur.fetchone()[0])
-        cur.execute("""
-            SELECT COUNT(*)
-            FROM acc_purchaseordermaster po
-            JOIN acc_purchaseorderdetails pd ON pd.masterslno = po.slno
-            WHERE po.orderdate = TODAY()
-        """)
-        d_before = int(cur.fetchone()[0])
-        logging.info("BEFORE – master today: %s  detail today: %s", m_before, d_before)
-
-        # ---------- master seed ----------
-        cur.execute("SELECT MAX(slno) FROM acc_purchaseordermaster")
-        max_masterslno = int(cur.fetchone()[0] or 0)
-
-        for idx, order in enumerate(orders, 1):
-            max_masterslno += 1
-            supplier  = order["supplier_code"]
-            orderdate = order["order_date"]
-            userid    = order.get("userid") or request.userid
-            otype     = order.get("otype", "O")
-
-            # 🔍 fix flat product → array
-            products = order.get("products", [])
-            if not products:                       # mobile sent flat fields
-                products = [{
-                    "barcode":  order["barcode"],
-                    "quantity": order["quantity"],
-                    "rate":     order["rate"],
-                    "mrp":      order["mrp"]
-                }]
-                logging.info("Order #%s – wrapped flat product into array: %s", idx, products)
-
-            # ---- header ----
-            cur.execute("""
-                INSERT INTO acc_purchaseordermaster
-                       (slno, orderno, supplier, otype, userid, orderdate)
-                VALUES (?,    ?,       ?,        ?,    ?,      ?)
-            """, (max_masterslno, max_masterslno, supplier, otype, userid, orderdate))
+        try:
+            # ---------- before counts ----------
+            m_before = int(conn.execute(SQL_MASTER_COUNT_TODAY).fetchone()[0])
+            d_before = int(conn.execute(SQL_DETAIL_COUNT_TODAY).fetchone()[0])
+            logging.info("BEFORE – master today: %s  detail today: %s", m_before, d_before)
 
-            # 🔍 master must exist NOW
-            cur.execute("SELECT COUNT(*) FROM acc_purchaseordermaster WHERE slno = ?", (max_masterslno,))
-            if int(cur.fetchone()[0]) == 0:
-                raise RuntimeError("Master row vanished immediately after insert!")
+            # ---------- master seed ----------
+            max_masterslno = int(conn.execute(SQL_MAX_MASTER_SLNO).fetchone()[0] or 0)
 
-            # ---- details ----
-            for prod in products:
-                det_slno = _next_detail_slno(cur)
+            for idx, order in enumerate(orders, 1):
+                max_masterslno += 1
+                supplier  = order["supplier_code"]
+                orderdate = order["order_date"]
+                userid    = order.get("userid") or request.userid
+                otype     = order.get("otype", "O")
 
-                qty  = float(prod["quantity"])
-                rate = float(prod["rate"])
-                mrp  = float(prod["mrp"])
+                # 🔍 fix flat product → array
+                products = order.get("products", [])
+                if not products:                       # mobile sent flat fields
+                    products = [{
+                        "barcode":  order["barcode"],
+                        "quantity": order["quantity"],
+                        "rate":     order["rate"],
+                        "mrp":      order["mrp"]
+                    }]
+                    logging.info("Order #%s – wrapped flat product into array: %s", idx, products)
 
-                sql = """
-                    INSERT INTO acc_purchaseorderdetails
-                           (slno, masterslno, barcode, qty, rate, mrp)
-                    VALUES (?,    ?,          ?,       ?,  ?,    ?)
-                """
-                params = (det_slno, max_masterslno, prod["barcode"], qty, rate, mrp)
-                logging.info("EXEC detail sql=%s  params=%s", sql, params)
-                cur.execute(sql, params)
-
-                # 🔍 detail must exist NOW
-                cur.execute("SELECT COUNT(*) FROM acc_purchaseorderdetails WHERE slno = ?", (det_slno,))
-                if int(cur.fetchone()[0]) == 0:
-                    raise RuntimeError(f"Detail slno {det_slno} vanished immediately after insert!")
-
-        # ---------- after counts ----------
-        cur.execute("SELECT COUNT(*) FROM acc_purchaseordermaster WHERE orderdate = TODAY()")
-        m_after = int(cur.fetchone()[0])
-        cur.execute("""
-            SELECT COUNT(*)
-            FROM acc_purchaseordermaster po
-            JOIN acc_purchaseorderdetails pd ON pd.masterslno = po.slno
-            WHERE po.orderdate = TODAY()
-        """)
-        d_after = int(cur.fetchone()[0])
-        logging.info("AFTER – master today: %s  detail today: %s", m_after, d_after)
+                # ---- header ----
+                conn.execute(SQL_INSERT_MASTER,
+                             (max_masterslno, max_masterslno, supplier, otype, userid, orderdate))
 
-        if d_after == d_before:
-            raise RuntimeError("Still zero detail rows – nothing was really inserted!")
+                # 🔍 master must exist NOW
+                if int(conn.execute(SQL_MASTER_EXISTS, (max_masterslno,)).fetchone()[0]) == 0:
+                    raise RuntimeError("Master row vanished immediately after insert!")
 
-        # ---------- commit only if everything survived ----------
-        conn.commit()
-        logging.info("✅ COMMITTED – master today: %s  detail today: %s", m_after, d_after)
-        return JsonResponse({"status": "success", "message": "Orders uploaded successfully"})
+                # ---- details ----
+                for prod in products:
+                    det_slno = _next_detail_slno(conn)
 
-    except Exception as exc:
-        conn.rollback()
-        logging.exception("❌ ROLLBACK – %s", exc)
-        return JsonResponse({"detail": f"Upload failed: {exc}"}, status=500)
+                    qty  = float(prod["quantity"])
+                    rate = float(prod["rate"])
+                    mrp  = float(prod["mrp"])
 
-    finally:
-        try:
-            cur.close()
-            conn.close()
-        except Exception:
-            pass
+                    params = (det_slno, max_masterslno, prod["barcode"], qty, rate, mrp)
+                    logging.info("EXEC detail sql=%s  params=%s", SQL_INSERT_DETAIL, params)
+                    conn.execute(SQL_INSERT_DETAIL, params)
 
+                    # 🔍 detail must exist NOW
+                    if int(conn.execute(SQL_DETAIL_EXISTS, (det_slno,)).fetchone()[0]) == 0:
+                        raise RuntimeError(f"Detail slno {det_slno} vanished immediately after insert!")
 
+            # ---------- after counts ----------
+            m_after = int(conn.execute(SQL_MASTER_COUNT_TODAY).fetchone()[0])
+            d_after = int(conn.execute(SQL_DETAIL_COUNT_TODAY).fetchone()[0])
+            logging.info("AFTER – master today: %s  detail today: %s", m_after, d_after)
 
-@require_http_methods(["GET"])
-def get_status(request):
-    cfg = _get_config()
+            if d_after == d_before:
+                raise RuntimeError("Still zero detail rows – nothing was really inserted!")
+
+            # ---------- commit only if everything survived ----------
+            conn.commit()
+            logging.info("✅ COMMITTED – master today: %s  detail today: %s", m_after, d_after)
+            return respond({"status": "success", "message": "Orders uploaded successfully"})
+
+        except (StatementTimeout, CircuitOpen) + driver_errors() as exc:
+            # the pool rolls back (and tells the breaker), the middleware answers 503/504/500
+            logging.error("❌ ROLLBACK – %s", exc)
+            raise
+        except Exception as exc:
+            conn.rollback()
+            logging.exception("❌ ROLLBACK – %s", exc)
+            return respond({"detail": f"Upload failed: {exc}"}, status=500)
+        finally:
+            try:
+                conn.rollback()             # nothing left after a commit
+                conn.autocommit = True      # the next borrower expects autocommit
+            except Exception:
+                pass                        # a dead connection is discarded on release
+
+
+
+# ------------------ /status ------------------
+# Everything but server_time only changes with config.json, so the body is
+# rendered once per config version and the timestamp is spliced on the end.
+_status_cache = (None, b"")
+
+def _render_status_head(cfg):
     primary = cfg.get("ip", "unknown")
     all_ips = cfg.get("all_ips", [])
-    return JsonResponse({
+    body = json.dumps({
         "status": "online",
         "message": "SyncAnywhere server is running",
         "primary_ip": primary,
         "all_available_ips": all_ips,
         "connection_urls": [f"http://{ip}:8000" for ip in all_ips],
         "pair_password_hint": f"Password starts with: {PAIR_PASSWORD[:3]}...",
-        "server_time": datetime.now().isoformat(),
         "instructions": {
             "mobile_setup": "Try connecting to any of the URLs listed in 'connection_urls'",
             "troubleshooting": [
@@ -312,4 +1144,40 @@ def get_status(request):
                 "Verify port 8000 is not blocked"
             ]
         }
-    })
\ No newline at end of file
+    })
+    return body[:-1].encode() + b', "server_time": "'
+
+@require_http_methods(["GET"])
+def get_status(request):
+    global _status_cache
+    cfg = get_config()
+    version, head = _status_cache
+    if version != cfg.version:
+        head = _render_status_head(cfg)
+        _status_cache = (cfg.version, head)
+    body = head + datetime.now().isoformat().encode() + b'"}'
+    return HttpResponse(body, content_type="application/json")
+
+def _other_store(request):
+    """Statistics are only shown for the store the token was issued for"""
+    return JsonResponse({"detail": f"This token is for store {request.store!r}; log in to that store instead"},
+                        status=403)
+
+@jwt_required
+@require_http_methods(["GET"])
+def get_pool_stats(request):
+    if request.GET.get("store", request.store) != request.store:
+        return _other_store(request)
+    return JsonResponse({"status": "success", "pool": pool_stats(request.store)})
+
+@jwt_required
+@require_http_methods(["GET"])
+def get_query_stats(request):
+    if request.GET.get("store", request.store) != request.store:
+        return _other_store(request)
+    store = request.store
+    return JsonResponse(dict(query_stats(recent=request.GET.get("recent") == "1", store=store),
+                             catalog_builds=_catalog_flights.stats(), catalog_cache=catalog_cache.stats(store),
+                             catalog_files=catalog_files.stats(store), delta_sync=catalog_deltas.stats(store),
+                             changelog=changelog_feed.stats(store),
+                             status="success"))
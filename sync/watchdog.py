@@ -0,0 +1,109 @@
+"""
+Statement deadlines.
+
+Every blocking cursor call (execute/fetch) is armed with the deadline of the
+endpoint it runs for; one watchdog thread fires expired deadlines by
+cancelling the statement on its connection (or closing the connection when
+the driver cannot cancel), so no worker thread is pinned by a hung query.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# seconds per endpoint (view name); "default" covers everything else, 0 = no limit
+STATEMENT_TIMEOUT_DEFAULTS = {
+    "default": 30,
+    "login": 10,
+    "data_download": 120,
+    "data_download_masters": 30,
+    "data_download_products": 120,
+    "data_download_reconcile": 120,
+    "upload_orders": 30,
+    "catalog_file": 300,      # background SQLite catalog builds
+}
+
+class StatementTimeout(Exception):
+    """A statement ran past its endpoint's deadline and was cancelled."""
+
+    def __init__(self, endpoint, seconds):
+        self.endpoint = endpoint
+        self.seconds = seconds
+        super().__init__(f"Statement exceeded the {seconds:g}s limit for {endpoint or 'default'}")
+
+class _Timer:
+    __slots__ = ("deadline", "cancel", "endpoint", "done", "fired")
+
+    def __init__(self, deadline, cancel, endpoint):
+        self.deadline = deadline
+        self.cancel = cancel
+        self.endpoint = endpoint
+        self.done = False
+        self.fired = False
+
+class StatementWatchdog:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._counters = {}
+
+    def _bump(self, endpoint, key):
+        row = self._counters.setdefault(endpoint or "default",
+                                        {"statements": 0, "timed_out": 0, "cancelled": 0, "closed": 0})
+        row[key] += 1
+
+    def arm(self, deadline, cancel, endpoint=None, count=True):
+        """Fire ``cancel()`` at monotonic time ``deadline`` unless disarmed first"""
+        timer = _Timer(deadline, cancel, endpoint)
+        with self._cond:
+            if count:
+                self._bump(endpoint, "statements")
+            heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sql-watchdog", daemon=True)
+                self._thread.start()
+            elif self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def disarm(self, timer):
+        """Returns True if the timer had already fired"""
+        with self._cond:
+            timer.done = True
+            return timer.fired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._heap and self._heap[0][2].done:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                _, _, timer = heapq.heappop(self._heap)
+                timer.fired = True
+                timer.done = True
+                self._bump(timer.endpoint, "timed_out")
+            try:
+                how = timer.cancel()
+            except Exception as e:
+                logging.warning("Statement cancel failed: %s", e)
+                how = None
+            with self._cond:
+                if how in ("cancelled", "closed"):
+                    self._bump(timer.endpoint, how)
+            logging.warning("⏱️ Statement deadline passed for %s – %s", timer.endpoint or "default", how)
+
+    def stats(self):
+        with self._cond:
+            return {k: dict(v) for k, v in self._counters.items()}
+
+watchdog = StatementWatchdog()